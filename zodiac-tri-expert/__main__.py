@@ -1,17 +1,47 @@
+import argparse
+import asyncio
 import logging
 import sys
 import signal
 
 from .aqualink   import Aqualink
 from .hass       import ZodiacHomeAssistant
+from .hass_async import AsyncZodiacHomeAssistant
 from .exceptions import *
 
 _LOGGER       = logging.getLogger(__name__)
 
+async def run_async():
+    ha = AsyncZodiacHomeAssistant()
+    await ha.setup()
+    print("All set up!")
+    await ha.loop()
+
 if __name__ == '__main__':
     # logging.basicConfig(level=logging.DEBUG)
 
+    parser = argparse.ArgumentParser(prog = "zodiac-tri-expert", description = "Zodiac TRi Expert integration for Home Assistant.")
+    parser.add_argument("--async", dest = "use_async", action = "store_true", help = "use the asyncio runtime")
+    args = parser.parse_args()
+
     print("Setting up Home Assistant integration!")
+
+    if args.use_async:
+        try:
+            asyncio.run(run_async())
+        except CantConnectToZodiac:
+            print("Can't connect to the Zodiac!")
+            sys.exit(1)
+        except InterruptedError:
+            print("Interrupted, exiting!")
+            sys.exit(130)
+        except FatalError:
+            print("Fatal error, terminating!")
+            sys.exit(1)
+
+        print("Exiting, bye!")
+        sys.exit(0)
+
     try:
         ha = ZodiacHomeAssistant()
     except CantConnectToZodiac:
@@ -28,6 +58,9 @@ if __name__ == '__main__':
 
     try:
         ha.loop()
+    except CantConnectToZodiac:
+        print("Can't connect to the Zodiac!")
+        sys.exit(1)
     except InterruptedError:
         print("Interrupted, exiting!")
         sys.exit(130)
@@ -1,44 +1,105 @@
 import serial
 import logging
+import math
 from pathlib import Path
-from time import sleep
+from time import sleep, monotonic
 import serial.rs485
-from dataclasses import dataclass
+from contextlib import contextmanager
 
 from .constants         import *
 from .aqualink_protocol import *
 from .exceptions        import *
+from .capture           import SerialCapture, DIRECTION_TX, DIRECTION_RX
+from .metrics           import ROUND_TRIP, TIMEOUTS, MALFORMED, JUNK_BYTES, RECONNECTS, RECOVERY
 
 _LOGGER = logging.getLogger(__name__)
 
+# Learns how long the device takes to respond and derives the response timeout from
+# the smoothed response time and its variation, the same way TCP derives its
+# retransmission timeout (RFC 6298). Timeouts double the estimate up to the maximum.
+class ResponseTimeEstimator:
+
+    def __init__(self, minimum : float, maximum : float):
+        self.minimum  = minimum
+        self.maximum  = maximum
+        self.srtt     = None
+        self.rttvar   = None
+        self._timeout = maximum
+
+    def timeout(self) -> float:
+        return self._timeout
+
+    def sample(self, elapsed : float):
+        if self.srtt is None:
+            self.srtt   = elapsed
+            self.rttvar = elapsed / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - elapsed)
+            self.srtt   = 0.875 * self.srtt + 0.125 * elapsed
+        self._timeout = min(max(self.srtt + 4 * self.rttvar, self.minimum), self.maximum)
+
+    def backoff(self):
+        self._timeout = min(self._timeout * 2, self.maximum)
+
 class Aqualink:
 
     PACKET_FOOTER        = bytes([0x10, 0x03])
 
-    @dataclass
-    class OperationalStatus:
-        ph_setpoint  : float
-        ph_current   : float
-        acl_setpoint : int
-        acl_current  : int
+    OperationalStatus = OperationalStatus
+
+    # Turnaround is the time the device may take before it starts to respond.
+    # Traffic is recorded to capture, if given.
+    def __init__(self, device_path : Path, turnaround : float = DEFAULT_TURNAROUND, capture : SerialCapture | None = None):
+        # A response has to be received within the turnaround plus the time needed to transfer the longest frame.
+        # The rest of the frame after the first received bytes has to follow within the inter-byte timeout.
+        frame_time          = AqualinkPacket.MAX_PACKET_LEN * BYTE_TIME
+        self.response_times = ResponseTimeEstimator(frame_time + INTER_BYTE_TIMEOUT, frame_time + turnaround)
+        self.decoder        = AqualinkFrameDecoder()
+        self.port           = str(device_path) # Label in metrics.
+        self.device_path    = str(device_path) # Reopened from here, may be changed to a stable link.
+        self.down_since     = None             # When the port was lost, None while it works.
+        self.capture        = capture
+        self._reopen_needed = False
+        self.device         = self._open_device(device_path)
 
-    def __init__(self, device_path : Path):
-        self.device = serial.Serial(device_path,
+        self.device.reset_output_buffer()
+        self.device.reset_input_buffer()
+
+        _LOGGER.debug("Is open: %s", self.device.is_open)
+        _LOGGER.debug("Device name: %s", self.device.name)
+        _LOGGER.debug("Baudrate: %s", self.device.baudrate)
+
+    def _open_device(self, device_path : Path) -> serial.Serial:
+        return serial.Serial(device_path,
             baudrate = 9600,
             bytesize = serial.EIGHTBITS,
             parity   = serial.PARITY_NONE, 
             stopbits = serial.STOPBITS_ONE,
-            timeout  = 2
+            timeout  = self.response_times.timeout()
         )
 
-        self.device.reset_output_buffer()
-        self.device.reset_input_buffer()
+    # Writes data to the port, recording it if captured.
+    def _write(self, data : bytes):
+        self.device.write(data)
+        if self.capture is not None:
+            self.capture.record(DIRECTION_TX, data, monotonic())
+
+    # Blocks for the first byte, then takes everything that is already waiting.
+    # Returns what was received, recording it if captured, empty on timeout.
+    def _read(self) -> bytes:
+        received_chunk = self.device.read(self.device.in_waiting or 1)
+        if received_chunk and self.capture is not None:
+            self.capture.record(DIRECTION_RX, received_chunk, monotonic())
+        return received_chunk
 
-        _LOGGER.debug(f"Is open: {self.device.is_open}")
-        _LOGGER.debug(f"Device name: {self.device.name}")
-        _LOGGER.debug(f"Baudrate: {self.device.baudrate}")
+    # Changing the port timeout reconfigures the port, so it's rounded up
+    # to 5 ms steps and only set when it changes.
+    def _set_read_timeout(self, timeout : float):
+        timeout = math.ceil(timeout * 200) / 200
+        if timeout != self.device.timeout:
+            self.device.timeout = timeout
 
-    # Sends a packet and receives data until a '0x10 0x03' sequence is received,
+    # Sends a packet and receives data until a complete '0x10 0x02 ... 0x10 0x03' frame is decoded,
     # or skips recv phase if no_recv is true.
     # Raises TimeoutError on timeout, ResponseMalformedException on bad response,
     # IOError on other IO problems.
@@ -48,125 +109,161 @@ class Aqualink:
             self.device.reset_output_buffer()
             self.device.reset_input_buffer()
         
-            self.device.write(data)
+            self._write(data)
             self.device.flush()
         except IOError:
             _LOGGER.error("There was an IO error when writing to device!")
             raise IOError()
         
-        _LOGGER.debug(f"Sent data: {data.hex()}")
-
-        received_data = bytearray()
-        if not no_recv:
-            _LOGGER.debug(f"Waiting for response...")
-
-            header_received = False
-            timeout_count = 0
-            invalid_recv  = 0
-            while len(received_data) < 2 or received_data[-2:] != AqualinkPacket.PACKET_FOOTER:
-                try:
-                    received_byte  = self.device.read(1)
-                except IOError:
-                    _LOGGER.error("There was an IOError when reading a response!")
-                    raise IOError()
-                
-                if len(received_byte) < 1:
-                    _LOGGER.warning(f"Timeout waiting for response byte!")
-                    timeout_count += 1
-
-                    if timeout_count == TIMEOUT_LIMIT:
-                        _LOGGER.error("Communication timed out!")
-                        raise TimeoutError()
-                # This is to sync with packet start.
-                elif not header_received:
-                    _LOGGER.debug(f"Received byte: {received_byte.hex()}")
-                    if received_byte == 0x10.to_bytes():
-                        header_received = True
-                        received_data += received_byte
-                    else:
-                        invalid_recv += 1
-                else:
-                    _LOGGER.debug(f"Received byte: {received_byte.hex()}")
-                    received_data += received_byte
-
-                if len(received_data) > AqualinkPacket.MAX_PACKET_LEN:
-                    raise ResponseMalformedException()
-                if invalid_recv > 20: # Twenty leading zeroes should be enough.
-                    _LOGGER.debug("Too many invalid bytes!")
-                    raise ResponseMalformedException()
-
-            _LOGGER.debug(f"All data received!")
-            _LOGGER.debug(f"Received data: {received_data.hex()}")
-        
+        # Formatting hex costs allocations on every poll, only done when it is logged.
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
+        if debug:
+            _LOGGER.debug("Sent data: %s", data.hex())
+
+        if no_recv:
+            return bytearray()
+
+        _LOGGER.debug("Waiting for response...")
+
+        self.decoder.reset()
+        start    = monotonic()
+        deadline = start + self.response_times.timeout()
+        self._set_read_timeout(deadline - start)
+        while True:
+            try:
+                received_chunk = self._read()
+            except IOError:
+                _LOGGER.error("There was an IOError when reading a response!")
+                raise IOError()
+
+            if len(received_chunk) > 0:
+                if debug:
+                    _LOGGER.debug("Received chunk: %s", received_chunk.hex())
+                frames = self.decoder.feed(received_chunk)
+                if frames:
+                    break
+
+            if len(received_chunk) < 1 or monotonic() > deadline:
+                _LOGGER.error("Communication timed out!")
+                self.response_times.backoff()
+                raise TimeoutError()
+
+            if self.decoder.dropped_frames > 0:
+                _LOGGER.debug("Received frame was malformed!")
+                raise ResponseMalformedException("framing")
+            if self.decoder.discarded > MAX_LEADING_JUNK:
+                _LOGGER.debug("Too many invalid bytes!")
+                raise ResponseMalformedException("junk")
+
+            # The response started, the rest has to follow without gaps.
+            self._set_read_timeout(INTER_BYTE_TIMEOUT)
+
+        self.response_times.sample(monotonic() - start)
+        received_data = frames[0]
+        _LOGGER.debug("All data received!")
+        if debug:
+            _LOGGER.debug("Received data: %s", received_data.hex())
+
         return received_data
 
+    # Records the round trip of the command, or why it failed, in metrics.
+    # Shared by the blocking and the asyncio transport.
+    @contextmanager
+    def _instrumented(self, command : AqualinkCommand):
+        start = monotonic()
+        try:
+            yield
+        except TimeoutError:
+            TIMEOUTS.inc(self.port, command.NAME)
+            raise
+        except ResponseMalformedException as e:
+            MALFORMED.inc(self.port, e.args[0] if e.args else "other")
+            raise
+        finally:
+            if self.decoder.discarded > 0:
+                JUNK_BYTES.inc(self.port, amount = self.decoder.discarded)
+        ROUND_TRIP.observe(monotonic() - start, self.port, command.NAME)
+        self._recovered()
+
+    # Records the time to recover, if the port was lost, once data is received again.
+    def _recovered(self):
+        if self.down_since is None:
+            return
+        recovery        = monotonic() - self.down_since
+        self.down_since = None
+        RECOVERY.observe(recovery, self.port)
+        _LOGGER.info(f"Link to {self.device_path} recovered in {recovery:.1f} s.")
+
     def send_command(self, command : AqualinkCommand):
-        raw_response = self.sendrecv(command.to_bytes())
-        return command.process_response(raw_response)
+        with self._instrumented(command):
+            self._ensure_open()
+            raw_response = self.sendrecv(command.to_bytes())
+            return command.process_response(raw_response)
+
+    # Marks the port to be reopened before the next command, after an IOError or
+    # when the adapter was unplugged. Callers retry with their own backoff.
+    # Safe to call from any thread, the port is only touched by the one sending commands.
+    def _recover(self):
+        if self.down_since is None:
+            _LOGGER.warning(f"Lost {self.device_path}, reopening it before the next command.")
+            self.down_since = monotonic()
+        self._reopen_needed = True
+
+    # Reopens the port if marked by _recover.
+    # Raises IOError if it can't be opened (yet).
+    def _ensure_open(self):
+        if not self._reopen_needed:
+            return
+        try:
+            self.device.close()
+        except IOError:
+            pass
+        self.device.port = self.device_path
+        self.device.open()
+        self._reopen_needed = False
+        RECONNECTS.inc(self.port)
+        _LOGGER.info(f"Reopened {self.device_path}.")
 
     # Try to probe the device.
-    # Raises NoResponseException if timed out or response was malformed.
+    # Raises NoResponseException if timed out, response was malformed or the port was lost.
     def probe(self):
         try:
-            response = self.send_command(ProbeCommand())
+            response = self.send_command(PROBE_COMMAND)
             assert isinstance(response, ProbeResponse), "Probe reponse incorrect type!"
         except (ResponseMalformedException, TimeoutError):
             _LOGGER.error("Error sending probe!")
             raise NoResponseException
         except IOError:
-            _LOGGER.info("Recovering from IOError....")
-            try:
-                if not self.device.is_open:
-                    self.device.open()
-            except IOError:
-                _LOGGER.error("Unable to reconnect!")
-                raise FatalError()
-            _LOGGER.info("OK!")
+            self._recover()
+            raise NoResponseException
 
     # Try to get ID of the device.
-    # Raises NoResponseException if timed out or response was malformed.
+    # Raises NoResponseException if timed out, response was malformed or the port was lost.
     def get_id(self) -> str:
         try:
-            response = self.send_command(IdCommand())
+            response = self.send_command(ID_COMMAND)
             assert isinstance(response, IdResponse), "Get ID reponse incorrect type!"
         except (ResponseMalformedException, TimeoutError):
             _LOGGER.error("Error sending get ID!")
             raise NoResponseException
         except IOError:
-            _LOGGER.info("Recovering from IOError....")
-            try:
-                if not self.device.is_open:
-                    self.device.open()
-            except IOError:
-                _LOGGER.error("Unable to reconnect!")
-                raise FatalError()
-            _LOGGER.info("OK!")
+            self._recover()
+            raise NoResponseException
         return response.id
 
     # Try to set chlorinator output power % and receive operational information.
     # Output power has to be in range [0, 101] (101 for boost).
-    # Raises NoResponseException if timed out or response was malformed.
+    # Raises NoResponseException if timed out, response was malformed or the port was lost.
     def set_output_get_info(self, output_power : int) -> OperationalStatus:
         assert 0 <= output_power <= 101, "Output power out of range!"
         try:
-            response = self.send_command(SetOutputCommand(output_power))
+            response = self.send_command(SET_OUTPUT_COMMANDS[output_power])
             assert isinstance(response, SetOutputResponse), "Set output reponse incorrect type!"
         except (ResponseMalformedException, TimeoutError):
             _LOGGER.error("Error sending output command!")
             raise NoResponseException
         except IOError:
-            _LOGGER.info("Recovering from IOError....")
-            try:
-                if not self.device.is_open:
-                    self.device.open()
-            except IOError:
-                _LOGGER.error("Unable to reconnect!")
-                raise FatalError()
-            _LOGGER.info("OK!")
-            
-        return self.OperationalStatus(
-            response.ph_setpoint,
-            response.ph_current,
-            response.acl_setpoint,
-            response.acl_current
-        )
+            self._recover()
+            raise NoResponseException
+
+        return response.status
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from time import monotonic
+
+from .constants         import *
+from .aqualink_protocol import *
+from .exceptions        import *
+from .aqualink          import Aqualink
+
+_LOGGER = logging.getLogger(__name__)
+
+# Non-blocking transport around an opened Aqualink. Instead of blocking reads,
+# the serial port file descriptor is registered with the event loop and received
+# chunks are fed to the streaming frame decoder as they arrive.
+class AsyncAqualink:
+
+    def __init__(self, aqualink : Aqualink):
+        self.aqualink = aqualink
+        self._lock    = asyncio.Lock()
+
+    # Sends a packet and waits for a complete frame without blocking the event loop.
+    # Raises TimeoutError on timeout, ResponseMalformedException on bad response,
+    # IOError on other IO problems.
+    async def sendrecv(self, data : bytes) -> bytes:
+        device  = self.aqualink.device
+        decoder = self.aqualink.decoder
+        loop    = asyncio.get_running_loop()
+
+        async with self._lock:
+            try:
+                device.reset_output_buffer()
+                device.reset_input_buffer()
+                self.aqualink._write(data)
+            except IOError:
+                _LOGGER.error("There was an IO error when writing to device!")
+                raise IOError()
+
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug("Sent data: %s", data.hex())
+
+            decoder.reset()
+            response = loop.create_future()
+
+            def on_readable():
+                if response.done():
+                    return
+                try:
+                    received_chunk = self.aqualink._read()
+                except IOError:
+                    _LOGGER.error("There was an IOError when reading a response!")
+                    response.set_exception(IOError())
+                    return
+
+                frames = decoder.feed(received_chunk)
+                if frames:
+                    response.set_result(frames[0])
+                elif decoder.dropped_frames > 0:
+                    response.set_exception(ResponseMalformedException("framing"))
+                elif decoder.discarded > MAX_LEADING_JUNK:
+                    response.set_exception(ResponseMalformedException("junk"))
+
+            fd    = device.fileno()
+            start = monotonic()
+            loop.add_reader(fd, on_readable)
+            try:
+                # Unlike the blocking transport, the write isn't flushed, so the transmission time counts too.
+                timeout       = self.aqualink.response_times.timeout() + len(data) * BYTE_TIME
+                received_data = await asyncio.wait_for(response, timeout)
+            except asyncio.TimeoutError:
+                _LOGGER.error("Communication timed out!")
+                self.aqualink.response_times.backoff()
+                raise TimeoutError()
+            finally:
+                loop.remove_reader(fd)
+            self.aqualink.response_times.sample(monotonic() - start)
+
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Received data: %s", received_data.hex())
+        return received_data
+
+    async def send_command(self, command : AqualinkCommand):
+        with self.aqualink._instrumented(command):
+            self.aqualink._ensure_open()
+            raw_response = await self.sendrecv(command.to_bytes())
+            return command.process_response(raw_response)
+
+    # Same as Aqualink.probe.
+    async def probe(self):
+        try:
+            response = await self.send_command(PROBE_COMMAND)
+            assert isinstance(response, ProbeResponse), "Probe reponse incorrect type!"
+        except (ResponseMalformedException, TimeoutError):
+            _LOGGER.error("Error sending probe!")
+            raise NoResponseException
+        except IOError:
+            self.aqualink._recover()
+            raise NoResponseException
+
+    # Same as Aqualink.get_id.
+    async def get_id(self) -> str:
+        try:
+            response = await self.send_command(ID_COMMAND)
+            assert isinstance(response, IdResponse), "Get ID reponse incorrect type!"
+        except (ResponseMalformedException, TimeoutError):
+            _LOGGER.error("Error sending get ID!")
+            raise NoResponseException
+        except IOError:
+            self.aqualink._recover()
+            raise NoResponseException
+        return response.id
+
+    # Same as Aqualink.set_output_get_info.
+    async def set_output_get_info(self, output_power : int) -> Aqualink.OperationalStatus:
+        assert 0 <= output_power <= 101, "Output power out of range!"
+        try:
+            response = await self.send_command(SET_OUTPUT_COMMANDS[output_power])
+            assert isinstance(response, SetOutputResponse), "Set output reponse incorrect type!"
+        except (ResponseMalformedException, TimeoutError):
+            _LOGGER.error("Error sending output command!")
+            raise NoResponseException
+        except IOError:
+            self.aqualink._recover()
+            raise NoResponseException
+
+        return response.status
@@ -1,4 +1,5 @@
 import logging
+import struct
 from abc import ABCMeta, abstractmethod
 
 from .exceptions import *
@@ -18,67 +19,278 @@ class AqualinkPacket:
     def _checksum(self, data : bytes) -> bytes:
         return (sum(data) % 256).to_bytes(1, 'little')
 
+    # A 0x10 byte between the header and the footer is sent as 0x10 0x00.
+    @staticmethod
+    def _escape(body : bytes) -> bytes:
+        return body.replace(b"\x10", b"\x10\x00")
+
+######################################################################
+# Streaming frame decoder
+######################################################################
+
+# Incremental decoder of the Aqualink framing. Accepts received data in chunks
+# of arbitrary size (the state is kept between calls) and returns complete frames
+# as header + unescaped body + footer, ready to be parsed by AqualinkResponse.
+# A 0x10 byte inside of the frame is sent escaped as 0x10 0x00.
+class AqualinkFrameDecoder:
+    DLE = 0x10
+    STX = 0x02
+    ETX = 0x03
+    NUL = 0x00
+
+    STATE_IDLE     = 0 # Waiting for the first header byte (0x10).
+    STATE_HEADER   = 1 # Got 0x10, waiting for 0x02.
+    STATE_BODY     = 2 # Inside of the frame.
+    STATE_BODY_DLE = 3 # Inside of the frame, got 0x10.
+
+    def __init__(self, max_frame_len : int = AqualinkPacket.MAX_PACKET_LEN):
+        self.max_frame_len = max_frame_len
+        self.reset()
+
+    def reset(self):
+        self.state          = self.STATE_IDLE
+        self.frame          = bytearray()
+        self.discarded      = 0 # Bytes received outside of any frame.
+        self.dropped_frames = 0 # Frames abandoned because of bad escape or overflow.
+
+    def _drop_frame(self):
+        self.dropped_frames += 1
+        self.frame.clear()
+        self.state = self.STATE_IDLE
+
+    def feed(self, data : bytes) -> list[bytes]:
+        frames = []
+        i      = 0
+        length = len(data)
+
+        while i < length:
+            if self.state == self.STATE_IDLE:
+                start = data.find(self.DLE, i)
+                if start == -1:
+                    self.discarded += length - i
+                    break
+                self.discarded += start - i
+                self.state = self.STATE_HEADER
+                i = start + 1
+
+            elif self.state == self.STATE_HEADER:
+                byte = data[i]
+                i += 1
+                if byte == self.STX:
+                    self.frame += AqualinkPacket.PACKET_HEADER
+                    self.state = self.STATE_BODY
+                elif byte != self.DLE:
+                    # Not a header, the 0x10 and this byte are junk.
+                    self.discarded += 2
+                    self.state = self.STATE_IDLE
+                else:
+                    # Repeated 0x10, the latter may still start the header.
+                    self.discarded += 1
+
+            elif self.state == self.STATE_BODY:
+                # Copy everything up to the next 0x10 at once.
+                end = data.find(self.DLE, i)
+                if end == -1:
+                    end = length
+                self.frame += data[i:end]
+                i = end
+                if i < length:
+                    self.state = self.STATE_BODY_DLE
+                    i += 1
+                if len(self.frame) > self.max_frame_len:
+                    self._drop_frame()
+
+            else: # STATE_BODY_DLE
+                byte = data[i]
+                i += 1
+                if byte == self.NUL:
+                    self.frame.append(self.DLE)
+                    self.state = self.STATE_BODY
+                elif byte == self.ETX:
+                    self.frame += AqualinkPacket.PACKET_FOOTER
+                    frames.append(bytes(self.frame))
+                    self.frame.clear()
+                    self.state = self.STATE_IDLE
+                elif byte == self.STX:
+                    # Header in the middle of a frame, resync to the new one.
+                    self._drop_frame()
+                    self.frame += AqualinkPacket.PACKET_HEADER
+                    self.state = self.STATE_BODY
+                elif byte == self.DLE:
+                    # Bad escape, the latter 0x10 may still start the header of the next frame.
+                    self._drop_frame()
+                    self.state = self.STATE_HEADER
+                else:
+                    self._drop_frame()
+
+        return frames
+
 ######################################################################
 # Responses
 ######################################################################
 
+# The frame is validated in place, without slicing copies of it, and the payload
+# is a memoryview into the received frame, created only when a response needs it.
 class AqualinkResponse(AqualinkPacket):
+    ERRORS = {
+        "length":   "Response too short!",
+        "header":   "Reponse header malformed!",
+        "footer":   "Reponse footer malformed!",
+        "checksum": "Reponse checksum malformed!",
+    }
+
     def __init__(self, raw_data : bytes):
-        _LOGGER.debug(f"Parsing response: {raw_data.hex()}")
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Parsing response: %s", raw_data.hex())
+        reason = self.malformed(raw_data)
+        if reason is not None:
+            _LOGGER.error(self.ERRORS[reason])
+            raise ResponseMalformedException(reason)
+
+        self.raw_data = raw_data
+
+    @property
+    def payload(self) -> memoryview:
+        return memoryview(self.raw_data)[2:-3]
+
+    # Returns why the frame is malformed (a key of ERRORS), None if it's valid.
+    @classmethod
+    def malformed(cls, raw_data : bytes) -> str | None:
         if len(raw_data) < 5:
-            _LOGGER.error("Response too short!")
-            raise ResponseMalformedException()
-        if raw_data[0:2] != self.PACKET_HEADER:
-            _LOGGER.error("Reponse header malformed!")
-            raise ResponseMalformedException()
-        if raw_data[-2:] != self.PACKET_FOOTER:
-            _LOGGER.error("Reponse footer malformed!")
-            raise ResponseMalformedException()
-        if raw_data[-3].to_bytes() != self._checksum(raw_data[0:-3]):
-            _LOGGER.error("Reponse checksum malformed!")
-            raise ResponseMalformedException()
-        
-        self.payload = raw_data[2:-3]
+            return "length"
+        if not raw_data.startswith(cls.PACKET_HEADER):
+            return "header"
+        if not raw_data.endswith(cls.PACKET_FOOTER):
+            return "footer"
+        if raw_data[-3] != (sum(raw_data) - raw_data[-3] - raw_data[-2] - raw_data[-1]) % 256:
+            return "checksum"
+        return None
 
 class ProbeResponse(AqualinkResponse):
     def __init__(self, raw_data : bytes):
         super().__init__(raw_data)
 
 class IdResponse(AqualinkResponse):
+    NON_PRINTABLE = bytes(byte for byte in range(256) if not 0x20 <= byte < 0x7F)
+
     def __init__(self, raw_data : bytes):
         super().__init__(raw_data)
-        raw_string = self.payload[1:].decode('ascii')
-        self.id = ''.join(c for c in raw_string if c.isprintable())
-        _LOGGER.debug(f"Decoded ID: '{self.id}'")
+        # Drop non-printable bytes in one pass, what is left is plain ASCII.
+        self.id = self.payload[1:].tobytes().translate(None, self.NON_PRINTABLE).decode('ascii')
+        _LOGGER.debug("Decoded ID: '%s'", self.id)
 
 class SetOutputResponse(AqualinkResponse):
     def __init__(self, raw_data : bytes):
         super().__init__(raw_data)
-        if len(raw_data) < 15:
-            raise ResponseMalformedException
-        
-        self.ph_setpoint  = float(raw_data[8]) / 10
-        self.acl_setpoint = raw_data[9] * 10
-        self.ph_current   = float(raw_data[10]) / 10
-        self.acl_current  = raw_data[11] * 10
+        if len(raw_data) < OperationalStatus.OFFSET + OperationalStatus.STRUCT.size + 3:
+            raise ResponseMalformedException("length")
 
-        _LOGGER.debug(f"pH setpoint/current: {self.ph_setpoint}/{self.ph_current}")
-        _LOGGER.debug(f"acl setpoint/current: {self.acl_setpoint}/{self.acl_current}")
+        self.status = OperationalStatus.unpack_from(raw_data, OperationalStatus.OFFSET)
+        _LOGGER.debug("Decoded status: %s", self.status)
+
+######################################################################
+# Operational status
+######################################################################
+
+# Everything the SWG reports in the response to the set output command.
+# The fields are kept as received in slots, a single precompiled struct decodes
+# all of them at once, values in physical units are computed on access.
+class OperationalStatus:
+
+    # Payload layout after the header, destination and command bytes.
+    OFFSET = 4
+    SCHEMA = (
+        ("salt_raw",         "B"), # Salt level in 100 ppm.
+        ("error_flags",      "B"), # See FLAGS.
+        ("status_2",         "B"), # Undocumented.
+        ("status_3",         "B"), # Undocumented.
+        ("ph_setpoint_raw",  "B"), # pH in tenths.
+        ("acl_setpoint_raw", "B"), # ACL in tens of mV.
+        ("ph_current_raw",   "B"),
+        ("acl_current_raw",  "B"),
+    )
+    FIELDS = tuple(name for name, _ in SCHEMA)
+    STRUCT = struct.Struct("<" + "".join(fmt for _, fmt in SCHEMA))
+
+    # Bits of the error flags, same as on AquaPure chlorinators.
+    FLAGS = (
+        ("no_flow",         0x01),
+        ("low_salt",        0x02),
+        ("high_salt",       0x04),
+        ("high_current",    0x08),
+        ("low_voltage",     0x10),
+        ("low_temperature", 0x20),
+        ("check_pcb",       0x40),
+        ("general_fault",   0x80),
+    )
+
+    __slots__ = FIELDS
+
+    def __init__(self, values : tuple):
+        for name, value in zip(self.FIELDS, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset : int = 0) -> "OperationalStatus":
+        return cls(cls.STRUCT.unpack_from(buffer, offset))
+
+    def pack_into(self, buffer, offset : int = 0):
+        self.STRUCT.pack_into(buffer, offset, *(getattr(self, name) for name in self.FIELDS))
+
+    @property
+    def ph_setpoint(self) -> float:
+        return self.ph_setpoint_raw / 10
+
+    @property
+    def ph_current(self) -> float:
+        return self.ph_current_raw / 10
+
+    @property
+    def acl_setpoint(self) -> int:
+        return self.acl_setpoint_raw * 10
+
+    @property
+    def acl_current(self) -> int:
+        return self.acl_current_raw * 10
+
+    @property
+    def salt(self) -> int:
+        return self.salt_raw * 100
+
+    # Values in physical units and flags by name.
+    def as_dict(self) -> dict:
+        values = {
+            "ph_setpoint":  self.ph_setpoint,
+            "ph_current":   self.ph_current,
+            "acl_setpoint": self.acl_setpoint,
+            "acl_current":  self.acl_current,
+            "salt":         self.salt,
+            "status_2":     self.status_2,
+            "status_3":     self.status_3,
+        }
+        for name, _ in self.FLAGS:
+            values[name] = getattr(self, name)
+        return values
+
+    def __repr__(self) -> str:
+        return f"OperationalStatus({self.as_dict()})"
+
+for _name, _bit in OperationalStatus.FLAGS:
+    setattr(OperationalStatus, _name, property(lambda self, bit = _bit: bool(self.error_flags & bit)))
 
 ######################################################################
 # Commands
 ######################################################################
 
 class AqualinkCommand(AqualinkPacket):
+    NAME = "unknown" # Label of the command in metrics.
+
     def __init__(self, payload : bytes):
-        command = bytearray()
-        command += self.PACKET_HEADER + self.PACKET_DEST_AQUALINK
-        command += payload
-        command += self._checksum(command)
-        command += self.PACKET_FOOTER
-        _LOGGER.debug(f"Built command: {command.hex()}")
+        command = self.PACKET_HEADER + self.PACKET_DEST_AQUALINK + payload
+        body    = command[len(self.PACKET_HEADER):] + self._checksum(command)
 
-        self.command_bytes = command
+        self.command_bytes = self.PACKET_HEADER + self._escape(body) + self.PACKET_FOOTER
+        _LOGGER.debug("Built command: %s", self.command_bytes.hex())
 
     def to_bytes(self) -> bytes:
         return self.command_bytes
@@ -88,6 +300,8 @@ class AqualinkCommand(AqualinkPacket):
         pass
 
 class ProbeCommand(AqualinkCommand):
+    NAME = "probe"
+
     def __init__(self):
         super().__init__(bytes([0x00]))
 
@@ -95,6 +309,8 @@ class ProbeCommand(AqualinkCommand):
         return ProbeResponse(raw_data)
 
 class IdCommand(AqualinkCommand):
+    NAME = "id"
+
     def __init__(self):
         super().__init__(bytes([0x14, 0x01]))
 
@@ -102,6 +318,8 @@ class IdCommand(AqualinkCommand):
         return IdResponse(raw_data)
     
 class SetOutputCommand(AqualinkCommand):
+    NAME = "set_output"
+
     def __init__(self, output_percent : int):
         assert 0 <= output_percent <= 101, "Output percent not in range!" # 101 for Boost mode.
         output_bytes = output_percent.to_bytes(1, 'little')
@@ -110,3 +328,12 @@ class SetOutputCommand(AqualinkCommand):
     def process_response(self, raw_data : bytes) -> "SetOutputResponse":
         return SetOutputResponse(raw_data)
 
+######################################################################
+# Command table
+######################################################################
+
+# Every command the integration sends, built once at import and shared, so a
+# transaction allocates no command. The frames are immutable bytes.
+PROBE_COMMAND       = ProbeCommand()
+ID_COMMAND          = IdCommand()
+SET_OUTPUT_COMMANDS = tuple(SetOutputCommand(output_percent) for output_percent in range(102)) # Indexed by output %.
@@ -0,0 +1,95 @@
+import argparse
+import logging
+import tracemalloc
+from time import perf_counter
+
+from ..aqualink_protocol import *
+from ..exceptions        import *
+from .decoder            import BenchAqualink
+from .fake_serial        import FakeSerial, build_set_output_response
+
+# Memory allocated per set output transaction, with commands built for each poll,
+# responses validated on sliced copies and log messages formatted upfront as before,
+# against the command table, in place validation and lazy logging. Both go through
+# Aqualink.send_command, so the transport and metrics are the same. CPython has no
+# allocation counter, tracemalloc gives the peak of memory held during a poll.
+# Debug logging is off, as in production. Run with:
+#   python3 -m zodiac-tri-expert.benchmarks.allocations
+
+_LOGGER = logging.getLogger(__name__)
+
+OUTPUT_POWER = 70
+
+# The command and response as they were before, kept for comparison.
+class LegacySetOutputCommand(SetOutputCommand):
+    def __init__(self, output_percent : int):
+        command = bytearray()
+        command += self.PACKET_HEADER + self.PACKET_DEST_AQUALINK
+        command += bytes([0x11]) + output_percent.to_bytes(1, 'little')
+        command += self._checksum(command)
+        command += self.PACKET_FOOTER
+        _LOGGER.debug(f"Built command: {command.hex()}")
+        self.command_bytes = command
+
+    def process_response(self, raw_data : bytes) -> "LegacySetOutputResponse":
+        return LegacySetOutputResponse(raw_data)
+
+class LegacySetOutputResponse(AqualinkPacket):
+    def __init__(self, raw_data : bytes):
+        _LOGGER.debug(f"Parsing response: {raw_data.hex()}")
+        if len(raw_data) < 5:
+            raise ResponseMalformedException("length")
+        if raw_data[0:2] != self.PACKET_HEADER:
+            raise ResponseMalformedException("header")
+        if raw_data[-2:] != self.PACKET_FOOTER:
+            raise ResponseMalformedException("footer")
+        if raw_data[-3].to_bytes() != self._checksum(raw_data[0:-3]):
+            raise ResponseMalformedException("checksum")
+        self.payload = raw_data[2:-3]
+
+        self.status = OperationalStatus.unpack_from(raw_data, OperationalStatus.OFFSET)
+        _LOGGER.debug(f"Decoded status: {self.status}")
+
+def legacy_poll(aqualink : BenchAqualink) -> OperationalStatus:
+    return aqualink.send_command(LegacySetOutputCommand(OUTPUT_POWER)).status
+
+def poll(aqualink : BenchAqualink) -> OperationalStatus:
+    return aqualink.send_command(SET_OUTPUT_COMMANDS[OUTPUT_POWER]).status
+
+# Peak of memory held during a poll above what was held before it, the minimum
+# over the polls to leave out one-off allocations like growing the metrics.
+def measure(poll_function, aqualink : BenchAqualink, polls : int) -> int:
+    peaks = []
+    tracemalloc.start()
+    for _ in range(polls):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        poll_function(aqualink)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+    tracemalloc.stop()
+    return min(peaks)
+
+def run(name : str, poll_function, aqualink : BenchAqualink, polls : int, timed_polls : int):
+    peak = measure(poll_function, aqualink, polls)
+
+    start = perf_counter()
+    for _ in range(timed_polls):
+        poll_function(aqualink)
+    elapsed = perf_counter() - start
+
+    print(f"{name:<8} {peak:>6} B peak per poll  {elapsed / timed_polls * 1e6:>7.1f} us/poll")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Allocations per poll microbenchmark.")
+    parser.add_argument("--polls",       type = int, default = 50,    help = "Polls measured with tracemalloc.")
+    parser.add_argument("--timed-polls", type = int, default = 20000, help = "Polls timed without tracemalloc.")
+    args = parser.parse_args()
+
+    aqualink = BenchAqualink(FakeSerial(build_set_output_response(), arrival_chunk = 64))
+    for _ in range(10):
+        poll(aqualink)
+        legacy_poll(aqualink)
+
+    run("legacy", legacy_poll, aqualink, args.polls, args.timed_polls)
+    run("table",  poll,        aqualink, args.polls, args.timed_polls)
@@ -0,0 +1,88 @@
+import argparse
+import os
+import random
+import tempfile
+from time import monotonic, perf_counter
+
+from ..aqualink_protocol import *
+from ..capture           import SerialCapture, DIRECTION_TX, DIRECTION_RX
+from ..replay            import replay, np
+from .sniffer            import frame
+
+# Cost of capturing serial traffic and speed of the offline replay.
+#  - record:  time SerialCapture takes per poll and bytes of capture per poll
+#  - replay:  a capture of --polls polls (10 s apart) with timeouts, bad checksums,
+#             leading junk and truncated responses injected, decoded with NumPy and
+#             with the streaming decoder, frames/s of both and whether they agree
+# Run with:
+#   python3 -m zodiac-tri-expert.benchmarks.capture
+
+POLL_INTERVAL = 10
+
+def response(i : int) -> bytes:
+    status = bytes([0x12, 35, 0x01 if i % 1000 == 0 else 0x00, 0x00, 0x00, 72, 75, 70 + i % 5, 65 + i % 3])
+    return frame(0x00, status)
+
+def write_capture(path : str, polls : int, faults : float, seed : int = 1) -> tuple[float, int]:
+    rng      = random.Random(seed)
+    capture  = SerialCapture(path, 1 << 40)
+    id_reply = frame(0x00, bytes([0x03]) + b"BOTT\x00Tri Expert 1.0")
+    base     = monotonic()
+
+    elapsed = 0
+    for i in range(polls):
+        now = base + i * POLL_INTERVAL
+        if i % 100 == 0:
+            command, reply = ID_COMMAND.to_bytes(), id_reply
+        else:
+            command, reply = SET_OUTPUT_COMMANDS[i % 102].to_bytes(), response(i)
+
+        fault = rng.random() < faults and rng.choice(("timeout", "checksum", "junk", "truncated"))
+        if fault == "timeout":
+            reply = b""
+        elif fault == "checksum":
+            reply = reply[:-3] + bytes([(reply[-3] + 1) % 256 or 1]) + reply[-2:]
+        elif fault == "junk":
+            reply = b"\x00\xff\x00" + reply
+        elif fault == "truncated":
+            reply = reply[:len(reply) // 2]
+
+        # The response arrives in two chunks, as from a USB adapter.
+        start = perf_counter()
+        capture.record(DIRECTION_TX, command, now)
+        if reply:
+            capture.record(DIRECTION_RX, reply[:6], now + 0.015)
+            capture.record(DIRECTION_RX, reply[6:], now + 0.016)
+        elapsed += perf_counter() - start
+    capture.close()
+    return elapsed / polls, os.path.getsize(path)
+
+def run_replay(path : str, polls : int, use_numpy : bool):
+    start   = perf_counter()
+    report  = replay([path], interval = 86400 * 7, use_numpy = use_numpy)
+    elapsed = perf_counter() - start
+    frames  = report.tx_frames + report.rx_frames
+    print(f"replay {'numpy ' if use_numpy else 'stream'} {elapsed:6.2f} s, {frames / elapsed:>9.0f} frames/s "
+          f"({polls * POLL_INTERVAL / 86400:.0f} days of polls)")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Capture overhead and replay speed.")
+    parser.add_argument("--polls",  type = int,   default = 1000000, help = "Polls in the replayed capture.")
+    parser.add_argument("--faults", type = float, default = 0.02,    help = "Fraction of polls with a fault injected.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "capture.bin")
+        per_poll, size = write_capture(path, args.polls, args.faults)
+        print(f"record {1e6 * per_poll:6.2f} us per poll, {size / args.polls:.1f} B of capture per poll")
+
+        reports = [run_replay(path, args.polls, False)]
+        if np is not None:
+            reports.append(run_replay(path, args.polls, True))
+        print(reports[-1].format())
+
+        if len(reports) == 2:
+            fields = ("tx_frames", "rx_frames", "reasons", "dropped", "commands", "unanswered", "bad_responses", "statuses", "flags", "ids", "intervals")
+            differ = [field for field in fields if getattr(reports[0], field) != getattr(reports[1], field)]
+            print("NumPy and streaming decoder agree." if not differ else f"NumPy and streaming decoder differ in: {', '.join(differ)}")
@@ -0,0 +1,81 @@
+import argparse
+import logging
+from time import perf_counter
+
+from ..aqualink          import Aqualink
+from ..aqualink_protocol import *
+from ..constants         import *
+from ..exceptions        import *
+from .fake_serial        import FakeSerial, build_set_output_response
+
+# Compares the streaming frame decoder in Aqualink.sendrecv with the former
+# byte-at-a-time receive loop. Run with:
+#   python3 -m zodiac-tri-expert.benchmarks.decoder
+
+_LOGGER = logging.getLogger(__name__)
+
+class BenchAqualink(Aqualink):
+    def __init__(self, device : FakeSerial):
+        self.fake_device = device
+        super().__init__("fake")
+
+    def _open_device(self, device_path):
+        return self.fake_device
+
+# The receive loop as it was before the streaming decoder, kept for comparison.
+def legacy_sendrecv(device, data : bytes):
+    device.reset_output_buffer()
+    device.reset_input_buffer()
+    device.write(data)
+    device.flush()
+    _LOGGER.debug(f"Sent data: {data.hex()}")
+
+    received_data = bytearray()
+    header_received = False
+    timeout_count = 0
+    invalid_recv  = 0
+    while len(received_data) < 2 or received_data[-2:] != AqualinkPacket.PACKET_FOOTER:
+        received_byte = device.read(1)
+        if len(received_byte) < 1:
+            timeout_count += 1
+            if timeout_count == 3:
+                raise TimeoutError()
+        elif not header_received:
+            _LOGGER.debug(f"Received byte: {received_byte.hex()}")
+            if received_byte == 0x10.to_bytes():
+                header_received = True
+                received_data += received_byte
+            else:
+                invalid_recv += 1
+        else:
+            _LOGGER.debug(f"Received byte: {received_byte.hex()}")
+            received_data += received_byte
+
+        if len(received_data) > AqualinkPacket.MAX_PACKET_LEN:
+            raise ResponseMalformedException()
+        if invalid_recv > 20:
+            raise ResponseMalformedException()
+    return received_data
+
+def run(name : str, sendrecv, device : FakeSerial, frames : int):
+    command = SET_OUTPUT_COMMANDS[70].to_bytes()
+    device.syscalls = 0
+    start = perf_counter()
+    for _ in range(frames):
+        sendrecv(command)
+    elapsed = perf_counter() - start
+    print(f"{name:<10} {frames / elapsed:>12.0f} frames/s {device.syscalls / frames:>8.1f} syscalls/frame")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Aqualink receive loop microbenchmark.")
+    parser.add_argument("--frames",        type = int, default = 20000)
+    parser.add_argument("--arrival-chunk", type = int, default = 4, help = "Max bytes available per read.")
+    args = parser.parse_args()
+
+    response = build_set_output_response()
+
+    legacy_device = FakeSerial(response, args.arrival_chunk)
+    run("legacy", lambda data: legacy_sendrecv(legacy_device, data), legacy_device, args.frames)
+
+    aqualink = BenchAqualink(FakeSerial(response, args.arrival_chunk))
+    run("streaming", aqualink.sendrecv, aqualink.device, args.frames)
@@ -0,0 +1,181 @@
+import argparse
+import logging
+import tempfile
+import yaml
+from pathlib import Path
+from time import perf_counter
+from ha_mqtt_discoverable import Settings
+
+from ..aqualink   import Aqualink
+from ..constants  import *
+from ..exceptions import *
+from ..hass       import ZodiacHomeAssistant
+from .mqtt_stub   import RecordingMqttClient
+from .simulator   import TriExpertSimulator
+
+# End-to-end benchmarks against the simulated TRi Expert on a pseudo-terminal:
+#  - link:     Aqualink polls in each fault scenario, round-trip latency percentiles,
+#              polls/s and failed polls
+#  - recovery: time from the end of an outage to the first good response, polling
+#              back-to-back (the bridge waits WAIT_BETWEEN_COMMANDS more after a failure)
+#  - bridge:   setup and the poll + publish path of a device, against an MQTT
+#              stand-in, or a real broker with --mqtt-host
+# Run with:
+#   python3 -m zodiac-tri-expert.benchmarks.end_to_end
+
+_LOGGER = logging.getLogger(__name__)
+
+SCENARIOS = {
+    "clean":     {},
+    "latency":   {"latency": 0.05, "jitter": 0.05},
+    "junk":      {"leading_junk": 10},
+    "dropped":   {"drop_rate": 0.05},
+    "corrupted": {"corrupt_rate": 0.05},
+}
+
+OUTPUT_POWER = 70
+
+class BenchBridge(ZodiacHomeAssistant):
+    def __init__(self, config_file_path : Path, mqtt_host : str | None):
+        self.bench_mqtt_host = mqtt_host
+        super().__init__(config_file_path)
+
+    def _connect_mqtt(self):
+        if self.bench_mqtt_host is not None:
+            super()._connect_mqtt()
+            return
+        self.mqtt_client        = RecordingMqttClient()
+        self.mqtt_subscriptions = []
+        self.mqtt_settings      = Settings.MQTT(host = "stand-in", client = self.mqtt_client)
+
+def percentile(values : list[float], fraction : float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def report(name : str, latencies : list[float], failures : int, elapsed : float):
+    if not latencies:
+        print(f"{name:<10} no successful polls, {failures} failed")
+        return
+    print(
+        f"{name:<10} p50 {percentile(latencies, 0.5) * 1000:>6.1f} ms  p90 {percentile(latencies, 0.9) * 1000:>6.1f} ms  "
+        f"p99 {percentile(latencies, 0.99) * 1000:>6.1f} ms  max {max(latencies) * 1000:>6.1f} ms  "
+        f"{len(latencies) / elapsed:>6.1f} polls/s  {failures:>3} failed"
+    )
+
+def poll(aqualink : Aqualink, latencies : list[float]) -> bool:
+    start = perf_counter()
+    try:
+        aqualink.set_output_get_info(OUTPUT_POWER)
+    except NoResponseException:
+        return False
+    latencies.append(perf_counter() - start)
+    return True
+
+def run_link(name : str, params : dict, polls : int):
+    simulator = TriExpertSimulator(seed = 1, **params)
+    aqualink  = Aqualink(simulator.start())
+
+    latencies = []
+    failures  = 0
+    start     = perf_counter()
+    for _ in range(polls):
+        if not poll(aqualink, latencies):
+            failures += 1
+    report(name, latencies, failures, perf_counter() - start)
+
+    aqualink.device.close()
+    simulator.stop()
+
+def run_recovery(outage : float, warmup : int):
+    simulator = TriExpertSimulator(seed = 1)
+    aqualink  = Aqualink(simulator.start())
+
+    for _ in range(warmup):
+        poll(aqualink, [])
+    timeout_before = aqualink.response_times.timeout()
+
+    simulator.silent = True
+    outage_end       = perf_counter() + outage
+    while perf_counter() < outage_end:
+        poll(aqualink, [])
+    timeout_outage = aqualink.response_times.timeout()
+
+    simulator.silent = False
+    restored         = perf_counter()
+    failures         = 0
+    while not poll(aqualink, []):
+        failures += 1
+    recovery = perf_counter() - restored
+
+    # Polls until the timeout estimate is back within 10 % of the one before the outage.
+    settling = 0
+    while aqualink.response_times.timeout() > timeout_before * 1.1 and settling < warmup:
+        poll(aqualink, [])
+        settling += 1
+
+    print(
+        f"recovery   {recovery * 1000:>6.1f} ms to first response after {outage:.1f} s outage ({failures} failed), "
+        f"timeout {timeout_before * 1000:.0f} -> {timeout_outage * 1000:.0f} ms, settled in {settling} polls"
+    )
+
+    aqualink.device.close()
+    simulator.stop()
+
+def run_bridge(mqtt_host : str | None, polls : int):
+    simulator = TriExpertSimulator(seed = 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_file_path = Path(directory) / "config.yaml"
+        config = {
+            "mqtt":   {"host": mqtt_host or "stand-in"},
+            "zodiac": {
+                "serial_port":  simulator.start(),
+                "cache_file":   str(Path(directory) / "cache.yaml"),
+                "backlog_file": str(Path(directory) / "backlog.bin"),
+            },
+        }
+        with open(config_file_path, 'w') as f:
+            yaml.safe_dump(config, f)
+
+        bridge = BenchBridge(config_file_path, mqtt_host)
+        device = bridge.devices[0]
+
+        start = perf_counter()
+        device.setup()
+        setup = perf_counter() - start
+
+        latencies = []
+        failures  = 0
+        start     = perf_counter()
+        for _ in range(polls):
+            poll_start = perf_counter()
+            try:
+                status = device.serial_worker.set_output_get_info(device._output_power).result()
+            except NoResponseException:
+                failures += 1
+                continue
+            device._publish_status(status)
+            latencies.append(perf_counter() - poll_start)
+        report("bridge", latencies, failures, perf_counter() - start)
+
+        sent       = sum(f.sent       for f in device.publish_filters.values())
+        suppressed = sum(f.suppressed for f in device.publish_filters.values())
+        print(f"bridge     setup with handshake {setup * 1000:.1f} ms, state publishes sent/suppressed {sent}/{suppressed}")
+
+        device.shutdown()
+    simulator.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "End-to-end benchmarks against the simulated SWG.")
+    parser.add_argument("--polls",     type = int,   default = 200)
+    parser.add_argument("--outage",    type = float, default = 5, help = "Outage length in seconds for the recovery benchmark.")
+    parser.add_argument("--mqtt-host", default = None, help = "Broker for the bridge benchmark, an in-process stand-in if not set.")
+    parser.add_argument("--log-level", default = "CRITICAL", help = "Faults make the integration log errors, hidden by default.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.log_level)
+
+    for name, params in SCENARIOS.items():
+        run_link(name, params, args.polls)
+    run_recovery(args.outage, args.polls // 10)
+    run_bridge(args.mqtt_host, args.polls)
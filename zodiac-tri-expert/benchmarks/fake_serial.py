@@ -0,0 +1,47 @@
+from ..aqualink_protocol import *
+
+# In-memory stand-in for serial.Serial used by the benchmarks.
+# Every write queues a canned response, reads hand it out in pieces of at most
+# arrival_chunk bytes to mimic data trickling in over the line.
+# Counts the calls which would be syscalls (read, in_waiting ioctl) on a real port.
+class FakeSerial:
+
+    def __init__(self, response : bytes, arrival_chunk : int = 4):
+        self.response      = response
+        self.arrival_chunk = arrival_chunk
+        self.pending       = b""
+        self.is_open       = True
+        self.name          = "fake"
+        self.baudrate      = 9600
+        self.timeout       = None
+        self.syscalls      = 0
+
+    def reset_input_buffer(self):
+        self.pending = b""
+
+    def reset_output_buffer(self):
+        pass
+
+    def write(self, data : bytes):
+        self.syscalls += 1
+        self.pending = self.response
+        return len(data)
+
+    def flush(self):
+        pass
+
+    @property
+    def in_waiting(self) -> int:
+        self.syscalls += 1
+        return min(len(self.pending), self.arrival_chunk)
+
+    def read(self, size : int = 1) -> bytes:
+        self.syscalls += 1
+        size = min(size, self.arrival_chunk)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+# Builds a valid SetOutputResponse frame with some leading junk.
+def build_set_output_response(leading_junk : int = 2) -> bytes:
+    body = bytes([0x10, 0x02, 0x00, 0x12, 0x00, 0x00, 0x00, 0x00, 0x48, 0x4B, 0x49, 0x41])
+    return bytes(leading_junk) + body + AqualinkPacket()._checksum(body) + AqualinkPacket.PACKET_FOOTER
@@ -0,0 +1,71 @@
+import argparse
+import os
+import threading
+from time import sleep
+from ha_mqtt_discoverable import Settings, DeviceInfo
+from ha_mqtt_discoverable.sensors import BinarySensor, BinarySensorInfo, Sensor, SensorInfo, Number, NumberInfo
+from paho.mqtt.client import Client
+from paho.mqtt.enums import CallbackAPIVersion
+
+# Counts MQTT connections and threads needed for the integration's
+# six entities, with a connection per entity (former behaviour) and with the single
+# shared client. Needs a reachable broker:
+#   python3 -m zodiac-tri-expert.benchmarks.mqtt_connections --host 127.0.0.1
+
+# Number of TCP connections of this process to the broker port
+# (paho also keeps a local TCP socketpair per client, those are not counted).
+def count_sockets(port : int) -> int:
+    inodes = set()
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            target = os.readlink(f"/proc/self/fd/{fd}")
+        except FileNotFoundError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(target[8:-1])
+
+    count = 0
+    for table in ("/proc/self/net/tcp", "/proc/self/net/tcp6"):
+        with open(table) as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[9] in inodes and int(fields[2].split(":")[1], 16) == port:
+                    count += 1
+    return count
+
+def build_entities(mqtt_settings : Settings.MQTT, prefix : str) -> list:
+    device_info = DeviceInfo(name = f"Zodiac SWG {prefix}", identifiers = prefix)
+    infos = [
+        (BinarySensor, BinarySensorInfo(name = "Connection state", unique_id = prefix + "_connected", device = device_info)),
+        (Sensor,       SensorInfo(name = "pH setpoint",  unique_id = prefix + "_ph_setpoint",  device = device_info)),
+        (Sensor,       SensorInfo(name = "Current pH",   unique_id = prefix + "_ph_current",   device = device_info)),
+        (Sensor,       SensorInfo(name = "ACL setpoint", unique_id = prefix + "_acl_setpoint", device = device_info)),
+        (Sensor,       SensorInfo(name = "Current ACL",  unique_id = prefix + "_acl_current",  device = device_info)),
+    ]
+    entities = [cls(Settings(mqtt = mqtt_settings, entity = info)) for cls, info in infos]
+    number_info = NumberInfo(name = "Output power", unique_id = prefix + "_output_power", device = device_info)
+    entities.append(Number(Settings(mqtt = mqtt_settings, entity = number_info), lambda c, u, m: None))
+    return entities
+
+def report(name : str, port : int, sockets_before : int, threads_before : int):
+    sleep(1) # Let the network threads connect.
+    print(f"{name:<12} {count_sockets(port) - sockets_before:>3} connections {threading.active_count() - threads_before:>3} threads")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "MQTT connection and thread count per bridge.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 1883)
+    args = parser.parse_args()
+
+    sockets_before, threads_before = count_sockets(args.port), threading.active_count()
+    legacy = build_entities(Settings.MQTT(host = args.host, port = args.port), "bench_legacy")
+    report("per-entity", args.port, sockets_before, threads_before)
+
+    sockets_before, threads_before = count_sockets(args.port), threading.active_count()
+    client = Client(CallbackAPIVersion.VERSION2)
+    client.connect(args.host, args.port)
+    client.loop_start()
+    sleep(1)
+    shared = build_entities(Settings.MQTT(host = args.host, port = args.port, client = client), "bench_shared")
+    report("shared", args.port, sockets_before, threads_before)
@@ -0,0 +1,27 @@
+from time import monotonic
+from paho.mqtt.client import Client, MQTTMessageInfo
+from paho.mqtt.enums import CallbackAPIVersion, MQTTErrorCode
+
+# Stand-in for a connected MQTT client, so the bridge can run without a broker.
+# Publishes complete immediately and are recorded with their time, subscriptions
+# are accepted and ignored.
+class RecordingMqttClient(Client):
+
+    def __init__(self):
+        super().__init__(CallbackAPIVersion.VERSION2)
+        self.published = [] # (time, topic, payload)
+        self._next_mid = 0
+
+    def publish(self, topic : str, payload = None, qos : int = 0, retain : bool = False, properties = None) -> MQTTMessageInfo:
+        self.published.append((monotonic(), topic, payload))
+        self._next_mid += 1
+        message_info    = MQTTMessageInfo(self._next_mid)
+        message_info.rc = 0
+        message_info._set_as_published()
+        return message_info
+
+    def subscribe(self, topic, qos : int = 0, options = None, properties = None):
+        return MQTTErrorCode.MQTT_ERR_SUCCESS, self._next_mid
+
+    def is_connected(self) -> bool:
+        return True
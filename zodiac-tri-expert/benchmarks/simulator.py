@@ -0,0 +1,165 @@
+import argparse
+import os
+import random
+import select
+import threading
+import tty
+from time import sleep
+
+from ..aqualink_protocol import *
+from ..constants         import *
+
+# Simulated TRi Expert behind a pseudo-terminal, for benchmarks and manual testing
+# without the SWG connected. The integration opens the path returned by start() like
+# a real serial port. Answers probe, ID and set output commands with valid frames,
+# faults can be injected (and changed while running):
+#   latency, jitter  - seconds before the response starts (jitter adds up to the given value)
+#   leading_junk     - max number of garbage bytes sent before the frame
+#   drop_rate        - probability that one byte of the response is lost
+#   corrupt_rate     - probability that the response checksum is wrong
+#   silent           - no responses at all, e.g. disconnected cable
+# The reported state (salt_level, error_flags, ...) can be set the same way.
+# Run standalone with:
+#   python3 -m zodiac-tri-expert.benchmarks.simulator
+class TriExpertSimulator:
+
+    DLE = AqualinkFrameDecoder.DLE
+
+    CMD_PROBE      = 0x00
+    CMD_SET_OUTPUT = 0x11
+    CMD_ID         = 0x14
+
+    JUNK_BYTES = [byte for byte in range(256) if byte != AqualinkFrameDecoder.DLE]
+
+    def __init__(self, latency : float = 0.01, jitter : float = 0, leading_junk : int = 0, drop_rate : float = 0,
+                 corrupt_rate : float = 0, line_rate : bool = True, device_id : str = "Tri Expert 1.0", seed : int | None = None):
+        self.latency      = latency
+        self.jitter       = jitter
+        self.leading_junk = leading_junk
+        self.drop_rate    = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.line_rate    = line_rate # Sleep for the transmission time at 9600 Bd.
+        self.silent       = False
+        self.device_id    = device_id
+
+        # Operational state, pH in tenths and ACL in tens of mV as sent on the wire.
+        self.output_power = 0
+        self.ph_setpoint  = 72
+        self.ph_current   = 73
+        self.acl_setpoint = 75
+        self.acl_current  = 65
+        self.salt_level   = 35 # In 100 ppm.
+        self.error_flags  = 0  # See OperationalStatus.FLAGS.
+
+        self.commands  = 0
+        self.responses = 0
+        self.dropped   = 0
+        self.corrupted = 0
+
+        self._random   = random.Random(seed)
+        self._stopping = threading.Event()
+        self._thread   = None
+
+    # Opens the pseudo-terminal and starts answering, returns the path of the port.
+    def start(self) -> str:
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.path    = os.ttyname(self._slave)
+        self._thread = threading.Thread(target = self._run, name = "simulator", daemon = True)
+        self._thread.start()
+        return self.path
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        decoder = AqualinkFrameDecoder()
+        while not self._stopping.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 256)
+            except OSError:
+                return
+            for frame in decoder.feed(data):
+                self._handle(frame)
+
+    def _handle(self, frame : bytes):
+        # Header, destination, command, ..., checksum, footer.
+        if len(frame) < 7 or frame[-3:-2] != AqualinkPacket()._checksum(frame[:-3]):
+            return
+        self.commands += 1
+
+        command = frame[3]
+        if command == self.CMD_PROBE:
+            body = bytes([0x00, 0x01, 0x00, 0x00])
+        elif command == self.CMD_ID:
+            body = bytes([0x00, 0x03, 0x01]) + self.device_id.encode('ascii')
+        elif command == self.CMD_SET_OUTPUT:
+            self.output_power = frame[4]
+            self._drift()
+            body = bytes([0x00, 0x12, self.salt_level, self.error_flags, 0x00, 0x00, self.ph_setpoint, self.acl_setpoint, self.ph_current, self.acl_current])
+        else:
+            return
+
+        if self.silent:
+            return
+        sleep(self.latency + self._random.uniform(0, self.jitter))
+        response = self._encode(body)
+        if self.line_rate:
+            sleep(len(response) * BYTE_TIME)
+        try:
+            os.write(self._master, response)
+        except OSError:
+            return
+        self.responses += 1
+
+    # Slow random walk of pH, ACL rises towards the setpoint while producing chlorine and decays otherwise.
+    def _drift(self):
+        step            = self._random.choice((-1, 0, 0, 0, 1))
+        self.ph_current = min(max(self.ph_current + step, self.ph_setpoint - 5), self.ph_setpoint + 5)
+
+        target = self.acl_setpoint if self.output_power > 0 else 50
+        if self.acl_current != target and self._random.random() < 0.2:
+            self.acl_current += 1 if self.acl_current < target else -1
+
+    # Builds the response frame with DLE escaping and the configured faults.
+    def _encode(self, body : bytes) -> bytes:
+        unescaped = AqualinkPacket.PACKET_HEADER + body
+        checksum  = AqualinkPacket()._checksum(unescaped)
+        if self._random.random() < self.corrupt_rate:
+            checksum = bytes([(checksum[0] + 1) % 256])
+            self.corrupted += 1
+
+        escaped  = (body + checksum).replace(bytes([self.DLE]), bytes([self.DLE, 0x00]))
+        response = bytearray(AqualinkPacket.PACKET_HEADER + escaped + AqualinkPacket.PACKET_FOOTER)
+
+        if self._random.random() < self.drop_rate:
+            del response[self._random.randrange(len(response))]
+            self.dropped += 1
+
+        junk = bytes(self._random.choice(self.JUNK_BYTES) for _ in range(self._random.randint(0, self.leading_junk)))
+        return junk + bytes(response)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Simulated TRi Expert on a pseudo-terminal.")
+    parser.add_argument("--latency",      type = float, default = 0.01)
+    parser.add_argument("--jitter",       type = float, default = 0)
+    parser.add_argument("--leading-junk", type = int,   default = 0)
+    parser.add_argument("--drop-rate",    type = float, default = 0)
+    parser.add_argument("--corrupt-rate", type = float, default = 0)
+    args = parser.parse_args()
+
+    simulator = TriExpertSimulator(args.latency, args.jitter, args.leading_junk, args.drop_rate, args.corrupt_rate)
+    print(f"Simulated TRi Expert at {simulator.start()}, use it as serial_port in config.yaml. Ctrl+C to stop.")
+    try:
+        while True:
+            sleep(10)
+            print(f"commands {simulator.commands}, responses {simulator.responses}, dropped {simulator.dropped}, corrupted {simulator.corrupted}")
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,117 @@
+import argparse
+import os
+import pty
+import threading
+import tty
+from time import perf_counter, sleep
+
+from ..aqualink          import Aqualink
+from ..aqualink_protocol import *
+from ..constants         import *
+from ..metrics           import SNIFFED, SNIFFED_LOST
+from ..sniffer           import BusSniffer
+
+# Decoding of a saturated bus in listen-only mode: back-to-back traffic of a master
+# with the chlorinator and with other devices (keypads at 0x08, a pump at 0x78),
+# including escaped bytes and an ID request now and then.
+#  - decode: BusSniffer alone on the traffic in chunks, bytes/s and frames/s
+#            against what a 9600 Bd bus can carry
+#  - pty:    the traffic written to a pseudo-terminal at line rate, read and decoded
+#            like SnifferDevice does, reports what was missed
+# Run with:
+#   python3 -m zodiac-tri-expert.benchmarks.sniffer
+
+BUS_BYTES_PER_SECOND = 1 / BYTE_TIME
+
+def frame(destination : int, payload : bytes) -> bytes:
+    unescaped = AqualinkPacket.PACKET_HEADER + bytes([destination]) + payload
+    body      = unescaped[2:] + AqualinkPacket()._checksum(unescaped)
+    return AqualinkPacket.PACKET_HEADER + AqualinkPacket._escape(body) + AqualinkPacket.PACKET_FOOTER
+
+# One cycle of the master, returns its bytes and the chlorinator observations in it.
+def bus_cycle(i : int) -> tuple[bytes, int]:
+    power  = i % 102 # Passes 16 (0x10), escaped.
+    status = bytes([0x12, 35, 0x00, 0x00, 0x00, 72, 75, 70 + i % 5, 65 + i % 3])
+    data   = frame(0x08, bytes([0x02, 0x00]))                        # Keypad poll.
+    data  += frame(0x00, bytes([0x01, 0x00]))                        # Keypad ACK.
+    data  += frame(0xB0, bytes([0x11, power]))                       # Set output of the chlorinator.
+    data  += frame(0x00, status)
+    data  += frame(0x78, bytes([0x20, 0x10, 0x03]))                  # Pump, escaped bytes.
+    data  += frame(0x00, bytes([0x21, 0x00, 0x00, 0x10, 0x02]))
+    observed = 2
+    if i % 10 == 0:
+        data += frame(0xB0, bytes([0x14, 0x01]))
+        data += frame(0x00, bytes([0x03]) + b"BOTT\x00Tri Expert 1.0")
+        observed += 1
+    return data, observed
+
+def bus_traffic(cycles : int) -> tuple[bytes, int]:
+    data     = bytearray()
+    expected = 0
+    for i in range(cycles):
+        cycle, observed = bus_cycle(i)
+        data     += cycle
+        expected += observed
+    return bytes(data), expected
+
+def lost(port : str) -> int:
+    return int(SNIFFED_LOST.total(port))
+
+def run_decode(cycles : int, chunk : int):
+    data, expected = bus_traffic(cycles)
+    sniffer        = BusSniffer("decode")
+
+    observed = 0
+    start    = perf_counter()
+    for i in range(0, len(data), chunk):
+        observed += len(sniffer.feed(data[i:i + chunk]))
+    elapsed = perf_counter() - start
+
+    print(f"decode {len(data) / elapsed:>10.0f} B/s ({len(data) / elapsed / BUS_BYTES_PER_SECOND:.0f}x a saturated bus), "
+          f"{SNIFFED.total('decode') / elapsed:.0f} frames/s, {observed}/{expected} observed, {lost('decode')} lost")
+
+def run_pty(seconds : float):
+    cycles         = int(seconds * BUS_BYTES_PER_SECOND / len(bus_cycle(1)[0]))
+    data, expected = bus_traffic(cycles)
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    aqualink = Aqualink(os.ttyname(slave))
+    sniffer  = BusSniffer("pty")
+
+    # Written in pieces at 9600 Bd, as the master would.
+    def write():
+        piece = 96
+        start = perf_counter()
+        for i in range(0, len(data), piece):
+            os.write(master, data[i:i + piece])
+            delay = start + (i + piece) * BYTE_TIME - perf_counter()
+            if delay > 0:
+                sleep(delay)
+    writer = threading.Thread(target = write)
+    writer.start()
+
+    device   = aqualink.device
+    observed = 0
+    received = 0
+    while received < len(data):
+        chunk = device.read(device.in_waiting or 1)
+        if not chunk and not writer.is_alive():
+            break
+        received += len(chunk)
+        observed += len(sniffer.feed(chunk))
+    writer.join()
+
+    print(f"pty    {len(data)} B in {seconds:.0f} s at line rate, {observed}/{expected} observed, {lost('pty')} lost")
+    device.close()
+    os.close(master)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Listen-only decoding of a saturated bus.")
+    parser.add_argument("--cycles",  type = int,   default = 20000, help = "Master cycles decoded in memory.")
+    parser.add_argument("--chunk",   type = int,   default = 32,    help = "Bytes per read in memory.")
+    parser.add_argument("--seconds", type = float, default = 5,     help = "Length of the traffic on the pseudo-terminal.")
+    args = parser.parse_args()
+
+    run_decode(args.cycles, args.chunk)
+    run_pty(args.seconds)
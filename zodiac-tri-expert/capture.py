@@ -0,0 +1,154 @@
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+from time import monotonic, time
+from typing import Iterator
+
+from .constants import *
+
+_LOGGER = logging.getLogger(__name__)
+
+DIRECTION_TX    = 0 # Sent to the bus.
+DIRECTION_RX    = 1 # Received from the bus.
+DIRECTION_START = 2 # Capture (re)started, the data is the Unix time at the monotonic time of the record.
+
+MAGIC  = b"ZTC1"
+RECORD = struct.Struct("<dBI") # Monotonic time, direction, length of the bytes which follow.
+START  = struct.Struct("<d")
+
+# Records raw serial traffic to a compact binary file, see replay.py to analyse it.
+# The file is MAGIC followed by records: RECORD and the bytes as sent or received.
+# A START record is written whenever the file is opened, mapping the monotonic time
+# of the records after it to wall time. Chunks received in the same direction within
+# CAPTURE_MERGE_GAP of each other are merged into one record, so a frame usually takes
+# a single record however the port delivered it. Writes are buffered and flushed every
+# CAPTURE_FLUSH_INTERVAL, at max_size the file is rotated to <path>.1.
+class SerialCapture:
+
+    def __init__(self, path : Path, max_size : int):
+        self.path     = Path(path)
+        self.max_size = max_size
+        self._lock    = threading.Lock()
+        self._file    = None
+
+        self._pending_direction = None
+        self._pending_time      = 0
+        self._pending_last      = 0
+        self._pending           = bytearray()
+        self._open()
+
+    # Raises OSError if the file can't be opened.
+    def _open(self):
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        if size > 0:
+            with open(self.path, "rb") as file:
+                magic = file.read(len(MAGIC))
+            if magic != MAGIC:
+                _LOGGER.warning(f"{self.path} is not a capture of this version, moving it to {self.path}.1.")
+            if magic != MAGIC or size >= self.max_size:
+                os.replace(self.path, f"{self.path}.1")
+                size = 0
+
+        self._file = open(self.path, "ab")
+        if size == 0:
+            self._file.write(MAGIC)
+            size = len(MAGIC)
+        self._size    = size
+        self._flushed = monotonic()
+        self._write(DIRECTION_START, self._flushed, START.pack(time()))
+
+    def _write(self, direction : int, now : float, data : bytes):
+        self._file.write(RECORD.pack(now, direction, len(data)))
+        self._file.write(data)
+        self._size += RECORD.size + len(data)
+
+    def _write_pending(self):
+        if self._pending_direction is None:
+            return
+        self._write(self._pending_direction, self._pending_time, self._pending)
+        self._pending_direction = None
+        self._pending.clear()
+
+    # Records data sent or received at the monotonic time now.
+    def record(self, direction : int, data : bytes, now : float):
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                if (direction == self._pending_direction and now - self._pending_last <= CAPTURE_MERGE_GAP
+                        and len(self._pending) + len(data) <= CAPTURE_MAX_RECORD):
+                    self._pending     += data
+                    self._pending_last = now
+                    return
+
+                self._write_pending()
+                self._pending_direction = direction
+                self._pending_time      = now
+                self._pending_last      = now
+                self._pending          += data
+
+                if self._size >= self.max_size:
+                    self._rotate()
+                elif now - self._flushed >= CAPTURE_FLUSH_INTERVAL:
+                    self._file.flush()
+                    self._flushed = now
+            except OSError as e:
+                # Capturing is a debugging aid, it must not take the link down.
+                _LOGGER.error(f"Can't write capture file {self.path}, capture stopped: {e}")
+                self._close()
+
+    def _rotate(self):
+        pending, self._pending_direction = self._pending_direction, None
+        self._file.close()
+        os.replace(self.path, f"{self.path}.1")
+        _LOGGER.info(f"Capture rotated to {self.path}.1.")
+        self._open()
+        self._pending_direction = pending
+
+    def _close(self):
+        file, self._file = self._file, None
+        try:
+            file.close()
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                self._write_pending()
+            except OSError as e:
+                _LOGGER.error(f"Can't write capture file {self.path}: {e}")
+            self._close()
+
+# Reads the records of a capture file as (Unix time, direction, bytes), START records
+# only set the time base. A record cut short by a crash ends the capture.
+# Raises ValueError if it's not a capture file, OSError if it can't be read.
+def read_capture(path : Path) -> Iterator[tuple[float, int, bytes]]:
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a capture file of this version!")
+
+    offset = len(MAGIC)
+    base   = None # Unix time - monotonic time of the current START record.
+    unpack = RECORD.unpack_from
+    while offset + RECORD.size <= len(data):
+        now, direction, length = unpack(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        if direction == DIRECTION_START:
+            base = START.unpack_from(data, offset)[0] - now
+        elif base is not None:
+            yield now + base, direction, data[offset:offset + length]
+        offset += length
+
+    if offset < len(data):
+        _LOGGER.warning(f"{path} ends with a truncated record, ignored.")
@@ -1,3 +1,23 @@
-TIMEOUT_LIMIT = 3
-WAIT_BETWEEN_COMMANDS = 2
-CONN_DEAD_THRESH = 4
\ No newline at end of file
+WAIT_BETWEEN_COMMANDS = 2 # Seconds before the first retry, doubled per consecutive failure up to the polling retry_max.
+CONN_DEAD_THRESH = 30 # Seconds without a response before the connection is reported dead.
+MAX_LEADING_JUNK = 20 # Twenty leading zeroes should be enough.
+MQTT_CONNECT_TIMEOUT = 10
+BYTE_TIME = 10 / 9600 # Start bit, 8 data bits and stop bit at 9600 Bd.
+DEFAULT_TURNAROUND = 0.2
+INTER_BYTE_TIMEOUT = 0.03 # Leaves room for USB adapter latency timers (16 ms on FTDI).
+DIAGNOSTICS_INTERVAL = 60 # Seconds between publishes of diagnostic sensors.
+BACKLOG_CAPACITY = 200000 # Samples kept during MQTT outages, 16 B each, 23 days at 10 s refresh.
+BACKLOG_BATCH = 50 # Samples per replayed message.
+BACKLOG_BATCH_INTERVAL = 1 # Seconds between replayed messages.
+POLL_INTERVAL_GROWTH = 1.5 # Growth of the poll interval per poll while readings are stable.
+SERIAL_BY_ID_DIR = "/dev/serial/by-id" # Stable links to USB serial adapters kept by udev.
+MAX_SNIFFED_FRAME_LEN = 128 # Longest frame of any device on the bus decoded in listen-only mode.
+CAPTURE_MAX_SIZE = 64 # MB a capture file grows to before it is rotated.
+CAPTURE_FLUSH_INTERVAL = 5 # Seconds between writes of the capture buffer to the file.
+CAPTURE_MERGE_GAP = 3 * BYTE_TIME # Received chunks closer than this are captured as one record.
+CAPTURE_MAX_RECORD = 256 # Bytes merged into one capture record at most.
+API_SOCKET_MODE = 0o660 # Permissions of the local API socket, its owner and group may connect.
+API_MAX_REQUEST = 4096 # Bytes of a local API request at most.
+API_MAX_PENDING = 64 # Requests of one local API connection in progress at once.
+SHUTDOWN_TIMEOUT = 5 # Seconds to finish serial transactions and report entities offline on termination.
+SHUTDOWN_GRACE = 5 # Seconds past SHUTDOWN_TIMEOUT after which the process exits regardless.
\ No newline at end of file
@@ -0,0 +1,746 @@
+from ha_mqtt_discoverable import Settings, DeviceInfo
+from ha_mqtt_discoverable.sensors import BinarySensor, BinarySensorInfo, Sensor, SensorInfo, Number, NumberInfo
+from paho.mqtt.client import Client, MQTTMessage
+
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from time import sleep, monotonic, time
+
+from .constants         import *
+from .exceptions        import *
+from .aqualink          import Aqualink
+from .aqualink_protocol import SetOutputCommand
+from .publish_filter    import PublishFilter
+from .poll_scheduler    import PollScheduler
+from .output_controller import OutputController
+from .hotplug           import find_by_id_link
+from .telemetry_buffer  import TelemetryBuffer
+from .capture           import SerialCapture
+from .serial_worker     import SerialWorker
+from .device_state      import VersionedState
+from .phase_timer       import PhaseTimer
+from .metrics           import ROUND_TRIP, TIMEOUTS, MALFORMED, RECONNECTS
+
+_LOGGER = logging.getLogger(__name__)
+
+# One chlorinator: its serial link, HA device with entities and poll loop.
+# The bridge (ZodiacHomeAssistant) owns the shared MQTT connection and runs
+# each device's loop in its own thread, so a dead device never stalls the others.
+class ZodiacDevice:
+
+    ZODIAC_HASS_ID = "zodiac_tri_expert_chlorinator"
+
+    # Names in HA of the alarm flags of OperationalStatus.
+    ALARM_NAMES = {
+        "no_flow":         "No flow",
+        "low_salt":        "Low salt",
+        "high_salt":       "High salt",
+        "high_current":    "High current",
+        "low_voltage":     "Low voltage",
+        "low_temperature": "Low water temperature",
+        "check_pcb":       "Check PCB",
+        "general_fault":   "General fault",
+    }
+
+    # States published every poll, keys of the publish section in the config file.
+    PUBLISHED_STATES = ("connection_state", "ph_setpoint", "ph_current", "acl_setpoint", "acl_current", "salt") + tuple(ALARM_NAMES) + ("status_2", "status_3")
+
+    # Index is the position of the device in the config, the first one keeps
+    # the original name and unique IDs of the single device setup.
+    def __init__(self, bridge, config : dict, index : int):
+        self.bridge = bridge
+
+        self._power_lock     = threading.Lock()
+        self._publish_lock   = threading.Lock()
+        self._shutdown_lock  = threading.Lock()
+        self._shut_down      = False
+        self._command_future = None
+        self._replay_lock    = threading.Lock()
+        self._replaying      = False
+        self._wakeup         = threading.Event()
+        self._poll_requested = False
+        self.backlog         = None
+        self.capture         = None
+
+        self._load_config(config, index)
+        self._logger = _LOGGER.getChild(self.hass_id)
+
+    def _load_config(self, config : dict, index : int):
+        try:
+            self.serial_port = config["serial_port"]
+        except KeyError:
+            _LOGGER.error("Error loading config file, serial port path is missing!")
+            raise ConfigFileMalformed()
+
+        try:
+            self.name = str(config["name"])
+        except KeyError:
+            self.name = "Zodiac SWG" if index == 0 else f"Zodiac SWG {index + 1}"
+
+        try:
+            self.hass_id = str(config["id"])
+        except KeyError:
+            self.hass_id = self.ZODIAC_HASS_ID if index == 0 else f"{self.ZODIAC_HASS_ID}_{index + 1}"
+
+        try:
+            self.listen_only = bool(config["listen_only"])
+        except KeyError:
+            self.listen_only = False
+
+        try:
+            self.max_conn_attempts = config["max_connection_attempts"]
+        except KeyError:
+            # Set to unlimited.
+            self.max_conn_attempts = 0
+
+        try:
+            self.cache_file = config["cache_file"]
+        except KeyError:
+            self.cache_file = "zodiac_cache.yaml"
+
+        try:
+            # Explicit null disables the backlog.
+            self.backlog_file = config["backlog_file"]
+        except KeyError:
+            self.backlog_file = f"zodiac_backlog_{self.hass_id}.bin"
+
+        try:
+            self.backlog_capacity = int(config["backlog_capacity"])
+        except KeyError:
+            self.backlog_capacity = BACKLOG_CAPACITY
+        except (TypeError, ValueError):
+            _LOGGER.error("Backlog capacity should be integer > 0!")
+            raise ConfigFileMalformed()
+
+        if self.backlog_capacity <= 0:
+            _LOGGER.error("Backlog capacity should be integer > 0!")
+            raise ConfigFileMalformed()
+
+        try:
+            self.capture_file = config["capture_file"]
+        except KeyError:
+            self.capture_file = None
+
+        try:
+            self.capture_max_size = int(config["capture_max_size"]) * 1024 * 1024
+        except KeyError:
+            self.capture_max_size = CAPTURE_MAX_SIZE * 1024 * 1024
+        except (TypeError, ValueError):
+            _LOGGER.error("Capture max size should be integer in MB > 0!")
+            raise ConfigFileMalformed()
+
+        if self.capture_max_size <= 0:
+            _LOGGER.error("Capture max size should be integer in MB > 0!")
+            raise ConfigFileMalformed()
+
+        try:
+            self.turnaround = int(config["turnaround_ms"]) / 1000
+        except KeyError:
+            self.turnaround = DEFAULT_TURNAROUND
+        except (TypeError, ValueError):
+            _LOGGER.error("Turnaround should be integer in milliseconds!")
+            raise ConfigFileMalformed()
+
+        try:
+            self.refresh_interval = int(config["refresh_interval"])
+        except KeyError:
+            self.refresh_interval = self.bridge.refresh_interval
+        except (TypeError, ValueError):
+            _LOGGER.error("Refresh interval should be integer >= 10!")
+            raise ConfigFileMalformed()
+
+        if self.refresh_interval < 10:
+            _LOGGER.error("Refresh interval should be integer >= 10!")
+            raise ConfigFileMalformed()
+
+        try:
+            polling_config = config["polling"] or {}
+        except KeyError:
+            polling_config = {}
+
+        self.scheduler = PollScheduler.from_config(polling_config, self.bridge.polling_config, self.refresh_interval)
+
+        try:
+            default_output_power = int(config["default_power"])
+        except KeyError:
+            default_output_power = 70
+        except TypeError:
+            _LOGGER.error("Default output power should be integer in [0, 101]")
+            raise ConfigFileMalformed()
+
+        if default_output_power < 0 or default_output_power > 101:
+            _LOGGER.error("Default output power should be integer in [0, 101]")
+            raise ConfigFileMalformed()
+
+        self.default_output_power = default_output_power
+        self.state                = VersionedState(default_output_power)
+        self._published_power     = None
+
+        try:
+            self.controller = OutputController.from_config(config["controller"], default_output_power)
+        except KeyError:
+            self.controller = None
+
+        publish_config = self.bridge.publish_config
+        self.publish_filters = {
+            name: PublishFilter.from_config(publish_config.get(name), publish_config.get("default") or {})
+            for name in self.PUBLISHED_STATES
+        }
+
+    # Fields which only take effect when the device is set up again.
+    RESTART_FIELDS = ("serial_port", "name", "listen_only", "cache_file", "backlog_file", "backlog_capacity", "capture_file", "capture_max_size", "turnaround")
+
+    # Takes over settings from the device parsed from the reloaded config file.
+    # A changed default power is applied right away, as a restart would.
+    def reconfigure(self, staged : "ZodiacDevice"):
+        for field in self.RESTART_FIELDS:
+            if getattr(staged, field) != getattr(self, field):
+                self._logger.warning(f"Change of {field} takes effect after restart.")
+
+        self.max_conn_attempts = staged.max_conn_attempts
+        self.refresh_interval  = staged.refresh_interval
+        self.scheduler.reconfigure(staged.scheduler)
+        if (staged.controller is None) != (self.controller is None):
+            self._logger.warning("Enabling or disabling the controller takes effect after restart.")
+        elif self.controller is not None:
+            self.controller.reconfigure(staged.controller)
+        for name, publish_filter in self.publish_filters.items():
+            publish_filter.reconfigure(staged.publish_filters[name])
+
+        if staged.default_output_power == self.default_output_power:
+            return
+        power                     = staged.default_output_power
+        self.default_output_power = power
+        self._logger.info(f"Default output power changed, setting {power} %.")
+        if not hasattr(self, "n_output_power"):
+            # Not set up yet, sent with the first poll.
+            self.state.update(output_power = power)
+            return
+        self._set_output_power(power)
+        self._publish_power()
+
+    # Opens the serial link and publishes discovery, with a cached ID right away,
+    # otherwise after the handshake.
+    def setup(self):
+        timer        = PhaseTimer(f"Startup of {self.name}")
+        device_cache = self.bridge.device_cache(self.cache_file)
+        cached_id    = device_cache.get(self.serial_port)
+
+        ######################################################################
+        # Opening device communication
+        ######################################################################
+        self._open_backlog()
+        self._open_capture()
+
+        self._logger.info(f"Connecting to Zodiac at {self.serial_port}...")
+        with timer.phase("serial open"):
+            self.aqualink      = Aqualink(self.serial_port, self.turnaround, self.capture)
+            self.serial_worker = SerialWorker(self.aqualink)
+            self.serial_worker.start()
+        self._watch_port()
+
+        if cached_id is None:
+            with timer.phase("handshake"):
+                zodiac_id = self._handshake()
+            with timer.phase("discovery"):
+                self._build_sensors(zodiac_id)
+            device_cache.put(self.serial_port, zodiac_id)
+        else:
+            with timer.phase("discovery"):
+                self._build_sensors(cached_id)
+            self._logger.info(f"Using cached Zodiac ID '{cached_id}', validating in background...")
+            self._validate_id()
+
+        timer.log()
+        self.replay_backlog()
+
+    # Opens the backlog of samples taken during MQTT outages, unless disabled.
+    # Raises FatalError if the file can't be opened.
+    def _open_backlog(self):
+        if self.backlog_file is None:
+            return
+        try:
+            self.backlog = TelemetryBuffer(self.backlog_file, self.backlog_capacity)
+        except (OSError, ValueError) as e:
+            self._logger.error(f"Can't open backlog file {self.backlog_file}: {e}")
+            raise FatalError()
+
+    # Opens the capture of the serial traffic, if enabled.
+    # Raises FatalError if the file can't be opened.
+    def _open_capture(self):
+        if self.capture_file is None:
+            return
+        try:
+            self.capture = SerialCapture(self.capture_file, self.capture_max_size)
+        except OSError as e:
+            self._logger.error(f"Can't open capture file {self.capture_file}: {e}")
+            raise FatalError()
+        self._logger.info(f"Capturing serial traffic to {self.capture_file}.")
+
+    # Follows the USB adapter of the port by its stable link, so it's reopened as soon
+    # as it's plugged back in, even if under another /dev/ttyUSB* name.
+    def _watch_port(self):
+        link = find_by_id_link(self.serial_port, self.bridge.hotplug.directory)
+        if link is None:
+            return
+        self.aqualink.device_path = str(link)
+        self.bridge.hotplug.add_listener(link.name, self._hotplug)
+
+    # Called on the hotplug watcher thread.
+    def _hotplug(self, added : bool):
+        if not added:
+            self.aqualink._recover()
+        elif self.aqualink.down_since is not None:
+            self._poll_now()
+
+    # Probes the device and reads its ID, retrying until the configured attempt limit.
+    def _handshake(self) -> str:
+        connection_attempts = 0
+        while True:
+            try:
+                self.serial_worker.probe().result()
+                self._logger.info(f"Getting Zodiac ID...")
+                return self.serial_worker.get_id().result()
+            except NoResponseException:
+                connection_attempts += 1
+                self._connection_attempt_failed(connection_attempts)
+                self._wait(WAIT_BETWEEN_COMMANDS)
+                if self.bridge.shutdown.stopping.is_set():
+                    raise InterruptedError()
+
+    # Reads the ID in background and republishes discovery if it differs from the cached one.
+    def _validate_id(self):
+        self.serial_worker.get_id().add_done_callback(self._id_received)
+
+    # Called on the serial worker thread.
+    def _id_received(self, future):
+        if isinstance(future.exception(), InterruptedError):
+            return
+        if future.exception() is not None:
+            self._logger.warning("Can't validate cached Zodiac ID, retrying later.")
+            retry = threading.Timer(WAIT_BETWEEN_COMMANDS, self._validate_id)
+            retry.daemon = True
+            retry.start()
+            return
+
+        with self._publish_lock:
+            self._check_id(future.result())
+
+    # Republishes discovery if the ID differs from the one it was published with.
+    def _check_id(self, zodiac_id : str):
+        if zodiac_id == self.device_info.sw_version:
+            self._logger.info(f"Cached Zodiac ID is valid.")
+            return
+
+        self._logger.warning(f"Zodiac ID changed from '{self.device_info.sw_version}' to '{zodiac_id}', republishing discovery.")
+        self.bridge.device_cache(self.cache_file).put(self.serial_port, zodiac_id)
+        self.device_info.sw_version = zodiac_id
+        self._publish_discovery()
+
+    # Raises CantConnectToZodiac when the configured attempt limit is reached.
+    def _connection_attempt_failed(self, connection_attempts : int):
+        self._logger.warning(f"No response from Zodiac, attempt {connection_attempts}/{self.max_conn_attempts if self.max_conn_attempts != 0 else 'unlimited'}!")
+
+        if self.max_conn_attempts != 0 and connection_attempts == self.max_conn_attempts:
+            self._logger.error(f"Can't connect to Zodiac after {connection_attempts} tries!")
+            raise CantConnectToZodiac()
+
+    def _build_sensors(self, zodiac_id : str):
+        ######################################################################
+        # Build sensors
+        ######################################################################
+        self._logger.info(f"Creating sensors...")
+
+        mqtt_settings = self.bridge.mqtt_settings
+        hass_id       = self.hass_id
+
+        self.device_info = DeviceInfo(
+            name         = self.name,
+            model        = "TRi Expert",
+            identifiers  = hass_id,
+            manufacturer = "ZODIAC POOL SOLUTIONS",
+            sw_version   = zodiac_id,
+        )
+        device_info = self.device_info
+
+
+        s_connection_state_info     = BinarySensorInfo(name="Connection state", device_class="connectivity", unique_id=hass_id + "_connected", device=device_info)
+        s_connection_state_settings = Settings(mqtt=mqtt_settings, entity=s_connection_state_info)
+        self.s_connection_state     = BinarySensor(s_connection_state_settings)
+
+        s_ph_setpoint_info          = SensorInfo(name = "pH setpoint", min = 6.8, max = 7.6, state_class = "measurement", device_class = "ph", unique_id = hass_id + "_ph_setpoint", device = device_info)
+        s_ph_setpoint_settings      = Settings(mqtt = mqtt_settings, entity = s_ph_setpoint_info)
+        self.s_ph_setpoint          = Sensor(s_ph_setpoint_settings)
+
+        s_ph_current_info           = SensorInfo(name = "Current pH", min = 0, max = 14, state_class = "measurement", device_class = "ph", unique_id = hass_id + "_ph_current", device = device_info)
+        s_ph_current_settings       = Settings(mqtt = mqtt_settings, entity = s_ph_current_info)
+        self.s_ph_current           = Sensor(s_ph_current_settings)
+
+        s_acl_setpoint_info         = SensorInfo(name = "ACL setpoint", min = 600, max = 800, state_class = "measurement", unique_id = hass_id + "_acl_setpoint", device = device_info, unit_of_measurement = "mV")
+        s_acl_setpoint_settings     = Settings(mqtt = mqtt_settings, entity = s_acl_setpoint_info)
+        self.acl_setpoint           = Sensor(s_acl_setpoint_settings)
+
+        s_acl_current_info          = SensorInfo(name = "Current ACL", min = 0, max = 1000, state_class = "measurement", unique_id = hass_id + "_acl_current", device = device_info, unit_of_measurement = "mV")
+        s_acl_current_settings      = Settings(mqtt = mqtt_settings, entity = s_acl_current_info)
+        self.s_acl_current          = Sensor(s_acl_current_settings)
+
+        s_salt_info                 = SensorInfo(name = "Salt", state_class = "measurement", unique_id = hass_id + "_salt", device = device_info, unit_of_measurement = "ppm")
+        s_salt_settings             = Settings(mqtt = mqtt_settings, entity = s_salt_info)
+        self.s_salt                 = Sensor(s_salt_settings)
+
+        self.s_alarms = {}
+        for name, label in self.ALARM_NAMES.items():
+            s_alarm_info        = BinarySensorInfo(name = label, device_class = "problem", unique_id = f"{hass_id}_{name}", device = device_info)
+            s_alarm_settings    = Settings(mqtt = mqtt_settings, entity = s_alarm_info)
+            self.s_alarms[name] = BinarySensor(s_alarm_settings)
+
+        # Status bytes of unknown meaning, kept visible for troubleshooting.
+        s_status_2_info             = SensorInfo(name = "Status byte 2", entity_category = "diagnostic", unique_id = hass_id + "_status_2", device = device_info)
+        s_status_2_settings         = Settings(mqtt = mqtt_settings, entity = s_status_2_info)
+        self.s_status_2             = Sensor(s_status_2_settings)
+
+        s_status_3_info             = SensorInfo(name = "Status byte 3", entity_category = "diagnostic", unique_id = hass_id + "_status_3", device = device_info)
+        s_status_3_settings         = Settings(mqtt = mqtt_settings, entity = s_status_3_info)
+        self.s_status_3             = Sensor(s_status_3_settings)
+
+        n_output_power_info         = NumberInfo(name = "Output power", min = 0, max = 101, mode = "slider", step = 1, unique_id = hass_id + "_output_power", device = device_info, unit_of_measurement = "%")
+        n_output_power_settings     = Settings(mqtt = mqtt_settings, entity = n_output_power_info)
+        self.n_output_power         = Number(n_output_power_settings, lambda c, u, m: self.power_callback(c, m))
+        self.bridge.mqtt_subscriptions.append(self.n_output_power._command_topic)
+
+        # Entity of each field of OperationalStatus published after a poll.
+        self.status_entities = [
+            ("ph_setpoint",  self.s_ph_setpoint),
+            ("ph_current",   self.s_ph_current),
+            ("acl_setpoint", self.acl_setpoint),
+            ("acl_current",  self.s_acl_current),
+            ("salt",         self.s_salt),
+            *self.s_alarms.items(),
+            ("status_2",     self.s_status_2),
+            ("status_3",     self.s_status_3),
+        ]
+
+        self.entities = [
+            self.s_connection_state,
+            *(entity for _, entity in self.status_entities),
+            self.n_output_power,
+        ]
+        if self.bridge.diagnostic_sensors:
+            self._build_diagnostic_sensors(device_info)
+
+        # All entities share one availability topic, set offline on shutdown.
+        self.availability_topic = f"{mqtt_settings.state_prefix}/{hass_id}/availability"
+        for entity in self.entities:
+            entity.availability_topic = self.availability_topic
+        self._publish_discovery()
+        self._publish_availability(True)
+
+        self._publish_state("connection_state", self.s_connection_state, True)
+        self._publish_power()
+
+        self._logger.info(f"Setup done!")
+
+    # Link statistics from metrics, hidden among diagnostic entities in HA.
+    def _build_diagnostic_sensors(self, device_info : DeviceInfo):
+        mqtt_settings = self.bridge.mqtt_settings
+        hass_id       = self.hass_id
+
+        d_round_trip_info           = SensorInfo(name = "Poll round trip", state_class = "measurement", entity_category = "diagnostic", unique_id = hass_id + "_round_trip", device = device_info, unit_of_measurement = "ms")
+        self.d_round_trip           = Sensor(Settings(mqtt = mqtt_settings, entity = d_round_trip_info))
+
+        d_timeouts_info             = SensorInfo(name = "Timeouts", state_class = "total_increasing", entity_category = "diagnostic", unique_id = hass_id + "_timeouts", device = device_info)
+        self.d_timeouts             = Sensor(Settings(mqtt = mqtt_settings, entity = d_timeouts_info))
+
+        d_malformed_info            = SensorInfo(name = "Malformed responses", state_class = "total_increasing", entity_category = "diagnostic", unique_id = hass_id + "_malformed", device = device_info)
+        self.d_malformed            = Sensor(Settings(mqtt = mqtt_settings, entity = d_malformed_info))
+
+        d_reconnects_info           = SensorInfo(name = "Reconnects", state_class = "total_increasing", entity_category = "diagnostic", unique_id = hass_id + "_reconnects", device = device_info)
+        self.d_reconnects           = Sensor(Settings(mqtt = mqtt_settings, entity = d_reconnects_info))
+
+        self.entities += [self.d_round_trip, self.d_timeouts, self.d_malformed, self.d_reconnects]
+        self._last_diagnostics = None
+        self._last_round_trip  = (0, 0)
+
+    # Publishes diagnostic sensors every DIAGNOSTICS_INTERVAL, the round trip is
+    # the mean of polls since the last publish.
+    def _publish_diagnostics(self):
+        if not self.bridge.diagnostic_sensors:
+            return
+        now = monotonic()
+        if self._last_diagnostics is not None and now - self._last_diagnostics < DIAGNOSTICS_INTERVAL:
+            return
+        self._last_diagnostics = now
+
+        port                   = self.aqualink.port
+        count, total           = ROUND_TRIP.get(port, SetOutputCommand.NAME)
+        last_count, last_total = self._last_round_trip
+        self._last_round_trip  = (count, total)
+        if count > last_count:
+            self.d_round_trip.set_state(round((total - last_total) / (count - last_count) * 1000, 1))
+
+        self.d_timeouts.set_state(int(TIMEOUTS.total(port)))
+        self.d_malformed.set_state(int(MALFORMED.total(port)))
+        self.d_reconnects.set_state(int(RECONNECTS.total(port)))
+
+    # Publishes discovery configs of all entities at once and waits for all of them
+    # together instead of one after another.
+    def _publish_discovery(self):
+        pending = [entity.write_config() for entity in self.entities]
+        for message_info in pending:
+            message_info.wait_for_publish(MQTT_CONNECT_TIMEOUT)
+
+        mqtt_clients = {id(entity.mqtt_client) for entity in self.entities}
+        self._logger.info(f"Published discovery of {len(self.entities)} entities over {len(mqtt_clients)} MQTT connection(s), {threading.active_count()} threads running.")
+
+    # To receive number updates from HA, define a callback function:
+    def power_callback(self, client: Client, message: MQTTMessage):
+        power = int(message.payload.decode())
+        self._logger.debug(f"Received output power = {power} % from HA.")
+        if self.controller is not None:
+            self.controller.override(power, monotonic())
+        self._set_output_power(power)
+        # Send an MQTT message to confirm to HA that the number was changed
+        self._publish_power()
+
+    # Output power change from the local API, taken like one from HA.
+    # Returns a future of the status read with the new power.
+    def api_set_output(self, power : int) -> Future:
+        self._logger.debug(f"Received output power = {power} % from the local API.")
+        if self.controller is not None:
+            self.controller.override(power, monotonic())
+        future = self._set_output_power(power)
+        self._publish_power()
+        return future
+
+    # Reads the ID for the local API, requests waiting together share the transaction.
+    def api_get_id(self) -> Future:
+        return self.serial_worker.get_id()
+
+    # Sends the new output power right away, ahead of polls. While a previous change
+    # is still queued, it is replaced, so only the latest value is written.
+    # The poll loop is woken up to follow the readings closely from now on.
+    # Returns a future of the status read with the new power.
+    def _set_output_power(self, power : int) -> Future:
+        self.state.update(output_power = power)
+        future = self.serial_worker.set_output_get_info(self._output_power, SerialWorker.PRIORITY_USER)
+
+        if future is not self._command_future:
+            self._command_future = future
+            future.add_done_callback(self._command_done)
+
+        self.scheduler.output_changed()
+        self._wakeup.set()
+        return future
+
+    # Read by the serial worker when a transaction starts.
+    def _output_power(self) -> int:
+        return self.state.current.output_power
+
+    # Confirms the output power to HA. The state is read under the lock, so whichever
+    # thread changed the power, the last publish carries the latest one.
+    def _publish_power(self):
+        with self._power_lock:
+            power = self.state.current.output_power
+            if power == self._published_power or not self.bridge.mqtt_client.is_connected():
+                return
+            self._published_power = power
+            self.n_output_power.set_value(power)
+
+    def _publish_availability(self, available : bool):
+        return self.bridge.mqtt_client.publish(self.availability_topic, "online" if available else "offline", qos = 1, retain = True)
+
+    # Called on the serial worker thread when an output change from HA completes.
+    def _command_done(self, future):
+        if isinstance(future.exception(), NoResponseException):
+            self._logger.warning("No response from Zodiac to output power change!")
+            return
+        if future.exception() is not None:
+            return
+        self._keep_status(future.result())
+        with self._publish_lock:
+            self._publish_status(future.result())
+
+    # Publishes samples kept during an MQTT outage, in a background thread.
+    # Called on connect to the broker, from paho's network thread.
+    def replay_backlog(self):
+        if self.backlog is None or len(self.backlog) == 0:
+            return
+        with self._replay_lock:
+            if self._replaying:
+                return
+            self._replaying = True
+        threading.Thread(target = self._replay, name = f"replay-{self.hass_id}", daemon = True).start()
+
+    # Backlog samples are sent to their own topic with the time they were taken,
+    # as HA can't backdate states, in batches of BACKLOG_BATCH every BACKLOG_BATCH_INTERVAL.
+    def _replay(self):
+        topic    = f"{self.bridge.mqtt_settings.state_prefix}/{self.hass_id}/backlog"
+        replayed = 0
+        try:
+            while self.bridge.mqtt_client.is_connected():
+                samples = self.backlog.peek(BACKLOG_BATCH)
+                if not samples:
+                    break
+                payload = json.dumps([
+                    {"time": datetime.fromtimestamp(timestamp, timezone.utc).isoformat()} | status.as_dict()
+                    for timestamp, status in samples
+                ])
+                message_info = self.bridge.mqtt_client.publish(topic, payload, qos = 1)
+                if message_info.rc != 0:
+                    break
+                message_info.wait_for_publish(MQTT_CONNECT_TIMEOUT)
+                if not message_info.is_published():
+                    break
+                self.backlog.consume(len(samples))
+                replayed += len(samples)
+                sleep(BACKLOG_BATCH_INTERVAL)
+        finally:
+            with self._replay_lock:
+                self._replaying = False
+        self._logger.info(f"Replayed {replayed} samples to {topic}, {len(self.backlog)} left.")
+
+    # Ends the poll loop after the transaction in progress, on termination.
+    def stop(self):
+        self._stop_transport()
+        self._wakeup.set()
+
+    # Called when the device stops, on failure or when the whole process terminates.
+    # Reports all entities offline, waiting up to timeout for the broker to take it.
+    def shutdown(self, timeout : float = MQTT_CONNECT_TIMEOUT):
+        with self._shutdown_lock:
+            if self._shut_down:
+                return
+            self._shut_down = True
+
+        self._log_publish_stats()
+        self._stop_transport()
+        if self.backlog is not None:
+            self.backlog.flush()
+        if self.capture is not None:
+            self.capture.close()
+        if not hasattr(self, "availability_topic") or not self.bridge.mqtt_client.is_connected():
+            return
+
+        # Setting connection state to disconnected when shutting down the script.
+        # Publishes go out in order, once the broker has the last one it has both.
+        with self._publish_lock:
+            self.s_connection_state.off()
+            message_info = self._publish_availability(False)
+        try:
+            message_info.wait_for_publish(timeout)
+        except (RuntimeError, ValueError):
+            pass
+        if not message_info.is_published():
+            self._logger.warning("Entities not reported offline, MQTT broker did not respond in time.")
+
+    def _stop_transport(self):
+        try:
+            self.serial_worker.stop()
+        except AttributeError:
+            pass
+
+    # Forces all states to be published again, e.g. after reconnect to the broker.
+    def invalidate_states(self):
+        for publish_filter in self.publish_filters.values():
+            publish_filter.invalidate()
+        # Retained, but the broker may have lost it.
+        if hasattr(self, "availability_topic") and not self.bridge.shutdown.stopping.is_set():
+            self._publish_availability(True)
+
+    # Publishes the state unless its publish filter suppresses it.
+    def _publish_state(self, name : str, entity, state):
+        if not self.publish_filters[name].should_publish(state):
+            return
+
+        if isinstance(entity, BinarySensor):
+            if state:
+                entity.on()
+            else:
+                entity.off()
+        else:
+            entity.set_state(state)
+
+    def _log_publish_stats(self):
+        sent       = sum(f.sent       for f in self.publish_filters.values())
+        suppressed = sum(f.suppressed for f in self.publish_filters.values())
+        self._logger.info(f"State publishes sent/suppressed: {sent}/{suppressed}")
+        for name, publish_filter in self.publish_filters.items():
+            self._logger.debug(f"  {name}: {publish_filter.sent}/{publish_filter.suppressed}")
+
+    # Keeps the reading for the local API.
+    def _keep_status(self, status : Aqualink.OperationalStatus):
+        self.state.update(status = status, status_time = time())
+
+    def _publish_status(self, status : Aqualink.OperationalStatus):
+        # Publishes would be lost while the broker is unreachable, keep the sample for later.
+        if self.backlog is not None and not self.bridge.mqtt_client.is_connected():
+            self.backlog.append(time(), status)
+            return
+
+        self._publish_state("connection_state", self.s_connection_state, True)
+        for name, entity in self.status_entities:
+            self._publish_state(name, entity, getattr(status, name))
+        self._publish_diagnostics()
+
+    # Lets the controller set the output power from the reading, sent with the next poll.
+    # Runs without HA, the power is published to it when connected.
+    def _control(self, status : Aqualink.OperationalStatus):
+        if self.controller is None:
+            return
+        # A power set from HA meanwhile wins over the one computed from this snapshot.
+        state = self.state.current
+        power = self.controller.update(status, monotonic())
+        if power is not None and power != state.output_power:
+            if self.state.update_if(state, output_power = power) is not None:
+                self._logger.debug(f"Controller set output power {power} %.")
+        self._publish_power()
+
+    def _publish_no_response(self, current_fails : int, last_response : float):
+        self._logger.warning(f"No response from Zodiac! Currently {current_fails} fails.")
+
+        if monotonic() - last_response > CONN_DEAD_THRESH:
+            self._publish_state("connection_state", self.s_connection_state, False)
+
+    # Ends the current wait of the poll loop, e.g. when the lost adapter is back.
+    def _poll_now(self):
+        self._poll_requested = True
+        self._wakeup.set()
+
+    # Sleeps for the given time. An output power change restarts the wait with the
+    # interval the scheduler shortened meanwhile.
+    def _wait(self, timeout : float):
+        while self._wakeup.wait(timeout):
+            self._wakeup.clear()
+            if self._poll_requested or self.bridge.shutdown.stopping.is_set():
+                self._poll_requested = False
+                return
+            timeout = self.scheduler.interval
+
+    def loop(self):
+
+        current_fails = 0
+        last_response = monotonic()
+
+        while not self.bridge.shutdown.stopping.is_set():
+            future = self.serial_worker.set_output_get_info(self._output_power)
+            try:
+                status = future.result()
+            except InterruptedError:
+                break
+            except NoResponseException:
+                current_fails += 1
+                with self._publish_lock:
+                    self._publish_no_response(current_fails, last_response)
+                self._wait(self.scheduler.failed())
+                continue
+
+            current_fails = 0
+            last_response = monotonic()
+            self._keep_status(status)
+            with self._publish_lock:
+                self._publish_status(status)
+                self._control(status)
+            self._wait(self.scheduler.succeeded(status))
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from concurrent.futures import Future
+from time import monotonic
+
+from .constants      import *
+from .exceptions     import *
+from .aqualink       import Aqualink
+from .aqualink_async import AsyncAqualink
+from .device         import ZodiacDevice
+from .phase_timer    import PhaseTimer
+
+_LOGGER = logging.getLogger(__name__)
+
+# Asyncio variant of a device, all devices share the event loop of the bridge
+# (AsyncZodiacHomeAssistant) and its MQTT publishing thread.
+class AsyncZodiacDevice(ZodiacDevice):
+
+    def __init__(self, bridge, config : dict, index : int):
+        super().__init__(bridge, config, index)
+        self._wakeup         = asyncio.Event()
+        self._output_futures = [] # Of output power changes, resolved by the next poll.
+        self._id_future      = None
+
+    async def setup(self):
+        timer        = PhaseTimer(f"Startup of {self.name}")
+        device_cache = self.bridge.device_cache(self.cache_file)
+        cached_id    = device_cache.get(self.serial_port)
+
+        ######################################################################
+        # Opening device communication
+        ######################################################################
+        self._open_backlog()
+        self._open_capture()
+
+        self._logger.info(f"Connecting to Zodiac at {self.serial_port}...")
+        with timer.phase("serial open"):
+            self.aqualink       = Aqualink(self.serial_port, self.turnaround, self.capture)
+            self.async_aqualink = AsyncAqualink(self.aqualink)
+        self._watch_port()
+
+        if cached_id is None:
+            with timer.phase("handshake"):
+                zodiac_id = await self._handshake()
+            with timer.phase("discovery"):
+                await self.bridge._publish(self._build_sensors, zodiac_id)
+            device_cache.put(self.serial_port, zodiac_id)
+        else:
+            with timer.phase("discovery"):
+                await self.bridge._publish(self._build_sensors, cached_id)
+            self._logger.info(f"Using cached Zodiac ID '{cached_id}', validating in background...")
+            self._validation = asyncio.create_task(self._validate_id())
+
+        timer.log()
+        self.replay_backlog()
+
+    # Probes the device and reads its ID, retrying until the configured attempt limit.
+    async def _handshake(self) -> str:
+        connection_attempts = 0
+        while True:
+            try:
+                await self.async_aqualink.probe()
+                self._logger.info(f"Getting Zodiac ID...")
+                return await self.async_aqualink.get_id()
+            except NoResponseException:
+                connection_attempts += 1
+                self._connection_attempt_failed(connection_attempts)
+                await self._wait(WAIT_BETWEEN_COMMANDS)
+                if self.bridge.shutdown.stopping.is_set():
+                    raise InterruptedError()
+
+    # Reads the ID in background and republishes discovery if it differs from the cached one.
+    async def _validate_id(self):
+        while not self.bridge.shutdown.stopping.is_set():
+            try:
+                zodiac_id = await self.async_aqualink.get_id()
+            except NoResponseException:
+                self._logger.warning("Can't validate cached Zodiac ID, retrying later.")
+                await self._wait(WAIT_BETWEEN_COMMANDS)
+                continue
+            await self.bridge._publish(self._check_id, zodiac_id)
+            return
+
+    # Called on paho's network thread. The poll loop always sends the latest value,
+    # so waking it up is all that is needed. Returns a future of the status it reads.
+    def _set_output_power(self, power : int) -> Future:
+        future = Future()
+        self.state.update(output_power = power)
+        self.scheduler.output_changed()
+        self.bridge._loop.call_soon_threadsafe(self._output_requested, future)
+        return future
+
+    # Called on the event loop.
+    def _output_requested(self, future : Future):
+        self._output_futures.append(future)
+        self._wakeup.set()
+
+    # Called from the local API threads, requests waiting together share the transaction.
+    def api_get_id(self) -> Future:
+        return asyncio.run_coroutine_threadsafe(self._get_id_shared(), self.bridge._loop)
+
+    async def _get_id_shared(self) -> str:
+        if self._id_future is None:
+            self._id_future = asyncio.ensure_future(self.async_aqualink.get_id())
+            self._id_future.add_done_callback(lambda _: setattr(self, "_id_future", None))
+        return await asyncio.shield(self._id_future)
+
+    # Called from other threads, the poll loop polls whenever woken up.
+    def _poll_now(self):
+        self.bridge._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # Serial reads run on the event loop, there is no worker to stop.
+    def _stop_transport(self):
+        pass
+
+    # Called on the event loop on termination.
+    def wake(self):
+        self._wakeup.set()
+
+    # Sleeps for the given time or until woken up by a command or termination.
+    async def _wait(self, timeout : float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # Polls until the bridge is stopping.
+    async def loop(self):
+
+        current_fails = 0
+        last_response = monotonic()
+
+        while not self.bridge.shutdown.stopping.is_set():
+            self._wakeup.clear()
+            futures, self._output_futures = self._output_futures, []
+            try:
+                status = await self.async_aqualink.set_output_get_info(self.state.current.output_power)
+            except NoResponseException as e:
+                for future in futures:
+                    future.set_exception(e)
+                current_fails += 1
+                await self.bridge._publish(self._publish_no_response, current_fails, last_response)
+                await self._wait(self.scheduler.failed())
+                continue
+
+            current_fails = 0
+            last_response = monotonic()
+            self._keep_status(status)
+            for future in futures:
+                future.set_result(status)
+            await self.bridge._publish(self._publish_status, status)
+            await self.bridge._publish(self._control, status)
+            await self._wait(self.scheduler.succeeded(status))
+
+        # Changes which came too late for a poll.
+        for future in self._output_futures:
+            future.set_exception(InterruptedError())
@@ -0,0 +1,47 @@
+import logging
+import os
+import threading
+import yaml
+from pathlib import Path
+
+_LOGGER = logging.getLogger(__name__)
+
+# Persistent cache of device IDs keyed by serial port, so the HA discovery can be
+# published on startup before the device answers.
+class DeviceCache:
+
+    def __init__(self, path : Path):
+        self.path    = Path(path)
+        self._lock   = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                entries = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, yaml.YAMLError):
+            _LOGGER.warning(f"Can't read device cache at {self.path}, ignoring it.")
+            return {}
+
+        if not isinstance(entries, dict):
+            _LOGGER.warning(f"Device cache at {self.path} is malformed, ignoring it.")
+            return {}
+        return entries
+
+    def get(self, key : str) -> str | None:
+        with self._lock:
+            return self.entries.get(key)
+
+    # Stores the value, the file is replaced atomically so a crash never leaves it half written.
+    def put(self, key : str, value : str):
+        with self._lock:
+            self.entries[key] = value
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            try:
+                with open(tmp_path, 'w') as f:
+                    yaml.safe_dump(self.entries, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                _LOGGER.warning(f"Can't write device cache at {self.path}!")
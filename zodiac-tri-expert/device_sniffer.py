@@ -0,0 +1,104 @@
+import logging
+from concurrent.futures import Future
+from time import monotonic
+from paho.mqtt.client import Client, MQTTMessage
+
+from .constants   import *
+from .exceptions  import *
+from .aqualink    import Aqualink
+from .device      import ZodiacDevice
+from .phase_timer import PhaseTimer
+from .sniffer     import BusSniffer
+
+_LOGGER = logging.getLogger(__name__)
+
+# Chlorinator on a bus mastered by another controller (listen_only in the config).
+# Nothing is ever sent: the status and output power are taken from the traffic
+# between the master and the chlorinator (see BusSniffer) and published as usual.
+# The ID is learned when the master asks for it, the cached or a placeholder one
+# is used until then. Output power from HA is ignored, the master sets it.
+class SnifferDevice(ZodiacDevice):
+
+    UNKNOWN_ID = "unknown (listen-only)"
+
+    def __init__(self, bridge, config : dict, index : int):
+        super().__init__(bridge, config, index)
+        if self.controller is not None:
+            self._logger.warning("The controller can't set the output power in listen-only mode, disabled.")
+            self.controller = None
+        self._last_status = monotonic()
+        self._dead        = False
+
+    def setup(self):
+        timer        = PhaseTimer(f"Startup of {self.name}")
+        device_cache = self.bridge.device_cache(self.cache_file)
+
+        self._open_backlog()
+        self._open_capture()
+
+        self._logger.info(f"Listening to the bus at {self.serial_port}...")
+        with timer.phase("serial open"):
+            self._open_sniffer()
+        self._watch_port()
+
+        with timer.phase("discovery"):
+            self._build_sensors(device_cache.get(self.serial_port) or self.UNKNOWN_ID)
+
+        timer.log()
+        self.replay_backlog()
+
+    def _open_sniffer(self):
+        self.aqualink = Aqualink(self.serial_port, self.turnaround, self.capture)
+        self.sniffer  = BusSniffer(self.aqualink.port)
+
+    def power_callback(self, client : Client, message : MQTTMessage):
+        self._logger.warning("Listen-only, the output power is set by the bus master.")
+        self.n_output_power.set_value(self.state.current.output_power)
+
+    # Nothing is sent, the ID is the one last seen on the bus.
+    def api_get_id(self) -> Future:
+        future = Future()
+        future.set_result(self.device_info.sw_version)
+        return future
+
+    # Publishes what was seen on the bus.
+    def _observe(self, observed : list[tuple[str, object]]):
+        with self._publish_lock:
+            for kind, value in observed:
+                if kind == "status":
+                    self._last_status = monotonic()
+                    self._dead        = False
+                    self._keep_status(value)
+                    self._publish_status(value)
+                elif kind == "power":
+                    self.state.update(output_power = value)
+                    self._publish_power()
+                elif kind == "id" and value != self.device_info.sw_version:
+                    self._check_id(value)
+
+    # Reports the connection dead once no status was seen for CONN_DEAD_THRESH.
+    def _check_alive(self):
+        if self._dead or monotonic() - self._last_status <= CONN_DEAD_THRESH:
+            return
+        self._dead = True
+        self._logger.warning(f"No status of the Zodiac on the bus for {CONN_DEAD_THRESH} s!")
+        with self._publish_lock:
+            self._publish_state("connection_state", self.s_connection_state, False)
+
+    def loop(self):
+        while not self.bridge.shutdown.stopping.is_set():
+            try:
+                self.aqualink._ensure_open()
+                received_chunk = self.aqualink._read()
+            except IOError:
+                self.aqualink._recover()
+                self._wait(self.scheduler.failed())
+                continue
+
+            if received_chunk:
+                self.scheduler.recovered()
+                self.aqualink._recovered()
+            observed = self.sniffer.feed(received_chunk)
+            if observed:
+                self._observe(observed)
+            self._check_alive()
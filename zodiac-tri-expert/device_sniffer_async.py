@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+from .constants      import *
+from .exceptions     import *
+from .device_async   import AsyncZodiacDevice
+from .device_sniffer import SnifferDevice
+from .phase_timer    import PhaseTimer
+
+_LOGGER = logging.getLogger(__name__)
+
+# Asyncio variant of the listen-only device. The serial port is registered with the
+# event loop and every received chunk is decoded right away, publishing what was seen
+# is handed to the MQTT thread of the bridge like the statuses of polled devices.
+class AsyncSnifferDevice(AsyncZodiacDevice, SnifferDevice):
+
+    # Nothing is sent, the ID is the one last seen on the bus.
+    api_get_id = SnifferDevice.api_get_id
+
+    async def setup(self):
+        timer        = PhaseTimer(f"Startup of {self.name}")
+        device_cache = self.bridge.device_cache(self.cache_file)
+
+        self._open_backlog()
+        self._open_capture()
+
+        self._logger.info(f"Listening to the bus at {self.serial_port}...")
+        with timer.phase("serial open"):
+            self._open_sniffer()
+        self._watch_port()
+
+        with timer.phase("discovery"):
+            await self.bridge._publish(self._build_sensors, device_cache.get(self.serial_port) or self.UNKNOWN_ID)
+
+        timer.log()
+        self.replay_backlog()
+
+    # Called on the event loop when the port is readable.
+    def _on_readable(self):
+        try:
+            received_chunk = self.aqualink._read()
+        except IOError:
+            self.aqualink._recover()
+            self._wakeup.set()
+            return
+
+        self.scheduler.recovered()
+        self.aqualink._recovered()
+        observed = self.sniffer.feed(received_chunk)
+        if observed:
+            asyncio.ensure_future(self.bridge._publish(self._observe, observed))
+
+    # Listens until the bridge is stopping, reopening the port when it's lost.
+    async def loop(self):
+        loop = asyncio.get_running_loop()
+
+        while not self.bridge.shutdown.stopping.is_set():
+            try:
+                self.aqualink._ensure_open()
+                fd = self.aqualink.device.fileno()
+            except IOError:
+                self.aqualink._recover()
+                await self._wait(self.scheduler.failed())
+                continue
+
+            loop.add_reader(fd, self._on_readable)
+            try:
+                while not self.bridge.shutdown.stopping.is_set() and not self.aqualink._reopen_needed:
+                    self._wakeup.clear()
+                    await self._wait(1)
+                    await self.bridge._publish(self._check_alive)
+            finally:
+                loop.remove_reader(fd)
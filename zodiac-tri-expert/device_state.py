@@ -0,0 +1,36 @@
+import threading
+from typing import NamedTuple
+
+from .aqualink_protocol import OperationalStatus
+
+# What a device knows, shared by the poll loop, paho's network thread, the serial
+# worker and the local API. A snapshot is never modified, an update replaces it.
+class DeviceState(NamedTuple):
+    version      : int                       # Incremented by every update.
+    output_power : int                       # Output power to send with the next transaction.
+    status       : OperationalStatus | None  # Latest reading.
+    status_time  : float | None              # Unix time of the latest reading.
+
+# Holder of the current DeviceState. Writers replace the snapshot under a lock, readers
+# take `current` without locking and work with a consistent snapshot, whichever
+# thread updates the state meanwhile.
+class VersionedState:
+
+    def __init__(self, output_power : int):
+        self._lock   = threading.Lock()
+        self.current = DeviceState(0, output_power, None, None)
+
+    def update(self, **changes) -> DeviceState:
+        with self._lock:
+            self.current = self.current._replace(version = self.current.version + 1, **changes)
+            return self.current
+
+    # Applies the changes only if there was no other update since the base snapshot,
+    # so a decision made on a stale snapshot can't overwrite a newer one.
+    # Returns the new state, None if the base is stale.
+    def update_if(self, base : DeviceState, **changes) -> DeviceState | None:
+        with self._lock:
+            if self.current.version != base.version:
+                return None
+            self.current = self.current._replace(version = base.version + 1, **changes)
+            return self.current
@@ -1,3 +1,4 @@
+# The first argument, if given, is the reason (e.g. "checksum") counted in metrics.
 class ResponseMalformedException(BaseException):
     pass
 
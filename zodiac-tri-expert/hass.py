@@ -1,28 +1,87 @@
-from ha_mqtt_discoverable import Settings, DeviceInfo
-from ha_mqtt_discoverable.sensors import BinarySensor, BinarySensorInfo, Sensor, SensorInfo, Number, NumberInfo
-from paho.mqtt.client import Client, MQTTMessage
+from ha_mqtt_discoverable import Settings
+from paho.mqtt.client import Client
+from paho.mqtt.enums import CallbackAPIVersion
 
 import yaml
 from pathlib import Path
 import logging
-from time import sleep
 import signal
-
-from .constants  import *
-from .exceptions import *
-from .aqualink   import Aqualink
+import threading
+from time import monotonic
+
+from .constants      import *
+from .exceptions     import *
+from .device         import ZodiacDevice
+from .device_sniffer import SnifferDevice
+from .device_cache   import DeviceCache
+from .hotplug        import HotplugWatcher
+from .phase_timer    import PhaseTimer
+from .metrics        import PublishTimer, start_metrics_server
+from .profiling      import ProfilingHooks
+from .local_api      import start_local_api
+from .shutdown       import ShutdownCoordinator
 
 _LOGGER = logging.getLogger(__name__)
 
+# MQTT client which measures how long publishes take to be sent.
+class _TimedMqttClient(Client):
+
+    def __init__(self):
+        super().__init__(CallbackAPIVersion.VERSION2)
+        self.publish_timer = PublishTimer()
+        self.on_publish    = lambda client, userdata, mid, reason_code, properties: self.publish_timer.finished(mid, monotonic())
+
+    def publish(self, *args, **kwargs):
+        start        = monotonic()
+        message_info = super().publish(*args, **kwargs)
+        self.publish_timer.started(message_info.mid, start)
+        return message_info
+
 class ZodiacHomeAssistant:
 
-    ZODIAC_HASS_ID = "zodiac_tri_expert_chlorinator"
+    DEVICE_CLASS  = ZodiacDevice
+    SNIFFER_CLASS = SnifferDevice
+
+    # Fields of the bridge which only take effect after restart.
+    RESTART_FIELDS = ("metrics_port", "metrics_host", "diagnostic_sensors", "api_socket", "api_mode")
+    MQTT_FIELDS    = ("mqtt_host", "mqtt_port", "mqtt_username", "mqtt_password")
 
     def __init__(self, config_file_path : Path = "config.yaml"):
-        
-        signal.signal(signal.SIGTERM, lambda s, f: self.sigterm_handler())
-        signal.signal(signal.SIGINT,  lambda s, f: self.sigterm_handler())
 
+        # The handlers only record the request, the main thread shuts down in loop().
+        self.shutdown = ShutdownCoordinator()
+        signal.signal(signal.SIGTERM, lambda s, f: self.shutdown.request())
+        signal.signal(signal.SIGINT,  lambda s, f: self.shutdown.request())
+
+        self.config_file_path    = config_file_path
+        self._device_caches      = {}
+        self._device_caches_lock = threading.Lock()
+        self._reload_lock        = threading.Lock()
+        self.device_errors       = []
+
+        timer = PhaseTimer("Startup")
+        with timer.phase("config"):
+            self._load_config(config_file_path)
+        self._start_metrics()
+        self._start_api()
+        self._start_hotplug()
+        with timer.phase("mqtt connect"):
+            self._connect_mqtt()
+        timer.log()
+
+        # Reloads block on MQTT, out of the main thread.
+        signal.signal(signal.SIGHUP, lambda s, f: threading.Thread(target = self.reload, name = "reload", daemon = True).start())
+        signal.signal(signal.SIGUSR1, lambda s, f: self.profiling.toggle())
+        signal.signal(signal.SIGUSR2, lambda s, f: threading.Thread(target = self.profiling.dump, name = "dump", daemon = True).start())
+
+    # Devices sharing a cache file share its instance.
+    def device_cache(self, path : Path) -> DeviceCache:
+        with self._device_caches_lock:
+            if path not in self._device_caches:
+                self._device_caches[path] = DeviceCache(path)
+            return self._device_caches[path]
+
+    def _load_config(self, config_file_path : Path):
         ######################################################################
         # Load config file
         ######################################################################
@@ -32,35 +91,23 @@ class ZodiacHomeAssistant:
         
         _LOGGER.debug(f"Loaded config: {config}")
         try:
-            mqtt_host     = config["mqtt"]["host"]
+            self.mqtt_host     = config["mqtt"]["host"]
 
         except KeyError:
             _LOGGER.error("Error loading config file, host field is missing!")
             raise ConfigFileMalformed()
                                 
         try:
-            mqtt_port = int(config["port"])
+            self.mqtt_port = int(config["mqtt"]["port"])
         except KeyError:
-            mqtt_port = 1883
+            self.mqtt_port = 1883
 
         try:
-            mqtt_username = config["mqtt"]["user"]
-            mqtt_password = config["mqtt"]["password"]
+            self.mqtt_username = config["mqtt"]["user"]
+            self.mqtt_password = config["mqtt"]["password"]
         except KeyError:
-            mqtt_username = None
-            mqtt_password = None
-
-        try:
-            serial_port = config["zodiac"]["serial_port"]
-        except KeyError:
-            _LOGGER.error("Error loading config file, serial port path is missing!")
-            raise ConfigFileMalformed()
-        
-        try:
-            max_conn_attempts = config["zodiac"]["max_connection_attempts"]
-        except KeyError:
-            # Set to unlimited.
-            max_conn_attempts = 0
+            self.mqtt_username = None
+            self.mqtt_password = None
 
         try:
             self.refresh_interval = int(config["mqtt"]["refresh_interval"])
@@ -75,142 +122,259 @@ class ZodiacHomeAssistant:
             raise ConfigFileMalformed()
         
         try:
-            default_output_power = int(config["zodiac"]["default_power"])
+            publish_config = config["publish"] or {}
         except KeyError:
-            default_output_power = 70
-        except TypeError:
-            _LOGGER.error("Default output power should be integer in [0, 101]")
-            raise ConfigFileMalformed()
-    
-        if default_output_power < 0 or default_output_power > 101:
-            _LOGGER.error("Default output power should be integer in [0, 101]")
+            publish_config = {}
+
+        unknown_states = set(publish_config) - set(ZodiacDevice.PUBLISHED_STATES) - {"default"}
+        if unknown_states:
+            _LOGGER.error(f"Unknown states in publish section: {', '.join(unknown_states)}")
             raise ConfigFileMalformed()
 
-        self.current_output_power = default_output_power
+        self.publish_config = publish_config
 
-        ######################################################################
-        # Connect to MQTT broker
-        ######################################################################
-        _LOGGER.info(f"Launching MQTT client...")
-        # Configure the required parameters for the MQTT broker
-        self.mqtt_settings = Settings.MQTT(
-            host     = mqtt_host,
-            port     = mqtt_port,
-            username = mqtt_username,
-            password = mqtt_password
-        )
+        try:
+            self.polling_config = config["polling"] or {}
+        except KeyError:
+            self.polling_config = {}
 
-        ######################################################################
-        # Opening device communication
-        ######################################################################
-        _LOGGER.info(f"Connecting to Zodiac...")
-        self.aqualink = Aqualink(serial_port)
-        connection_attempts = 0
-        connected = False
+        try:
+            metrics_config = config["metrics"] or {}
+        except KeyError:
+            metrics_config = {}
 
-        while not connected:
-            try:
-                self.aqualink.probe()
-                sleep(WAIT_BETWEEN_COMMANDS)
-                _LOGGER.info(f"Getting Zodiac ID...")
-                zodiac_id = self.aqualink.get_id()
-                sleep(WAIT_BETWEEN_COMMANDS)
-            except NoResponseException:
-                connection_attempts += 1
-                _LOGGER.warning(f"No response from Zodiac, attempt {connection_attempts}/{max_conn_attempts if max_conn_attempts != 0 else 'unlimited'}!")
-
-                if max_conn_attempts != 0 and connection_attempts == max_conn_attempts:
-                    _LOGGER.error(f"Can't connect to Zodiac after {connection_attempts} tries!")
-                    raise CantConnectToZodiac()
-                else:
-                    sleep(WAIT_BETWEEN_COMMANDS)
-                    continue
-            
-            connected = True
+        try:
+            self.metrics_port       = None if metrics_config.get("port") is None else int(metrics_config["port"])
+            self.metrics_host       = str(metrics_config.get("host", "127.0.0.1"))
+            self.diagnostic_sensors = bool(metrics_config.get("diagnostic_sensors", False))
+        except (AttributeError, TypeError, ValueError):
+            _LOGGER.error("Metrics section malformed, port should be integer!")
+            raise ConfigFileMalformed()
 
-        ######################################################################
-        # Build sensors
-        ######################################################################
-        _LOGGER.info(f"Creating sensors...")
-
-        device_info = DeviceInfo(
-            name         = "Zodiac SWG",
-            model        = "TRi Expert",
-            identifiers  = self.ZODIAC_HASS_ID,
-            manufacturer = "ZODIAC POOL SOLUTIONS",
-            sw_version   = zodiac_id,
-        )
-        
+        try:
+            api_config = config["api"] or {}
+        except KeyError:
+            api_config = {}
 
-        s_connection_state_info     = BinarySensorInfo(name="Connection state", device_class="connectivity", unique_id=self.ZODIAC_HASS_ID + "_connected", device=device_info)
-        s_connection_state_settings = Settings(mqtt=self.mqtt_settings, entity=s_connection_state_info)
-        self.s_connection_state     = BinarySensor(s_connection_state_settings)
-        self.s_connection_state.on()
+        try:
+            self.api_socket = api_config.get("socket")
+            mode            = api_config.get("mode", API_SOCKET_MODE)
+            self.api_mode   = int(mode, 8) if isinstance(mode, str) else int(mode)
+        except (AttributeError, TypeError, ValueError):
+            _LOGGER.error("API section malformed, mode should be octal permissions, e.g. 660!")
+            raise ConfigFileMalformed()
+
+        try:
+            profiling_config = config["profiling"] or {}
+        except KeyError:
+            profiling_config = {}
 
-        s_ph_setpoint_info          = SensorInfo(name = "pH setpoint", min = 6.8, max = 7.6, state_class = "measurement", device_class = "ph", unique_id = self.ZODIAC_HASS_ID + "_ph_setpoint", device = device_info)
-        s_ph_setpoint_settings      = Settings(mqtt = self.mqtt_settings, entity = s_ph_setpoint_info)
-        self.s_ph_setpoint          = Sensor(s_ph_setpoint_settings)
+        self.profiling = ProfilingHooks.from_config(profiling_config)
 
-        s_ph_current_info           = SensorInfo(name = "Current pH", min = 0, max = 14, state_class = "measurement", device_class = "ph", unique_id = self.ZODIAC_HASS_ID + "_ph_current", device = device_info)
-        s_ph_current_settings       = Settings(mqtt = self.mqtt_settings, entity = s_ph_current_info)
-        self.s_ph_current           = Sensor(s_ph_current_settings)
+        # A single device, or a list of them.
+        try:
+            devices_config = config["zodiac"]
+        except KeyError:
+            _LOGGER.error("Error loading config file, zodiac section is missing!")
+            raise ConfigFileMalformed()
 
-        s_acl_setpoint_info         = SensorInfo(name = "ACL setpoint", min = 600, max = 800, state_class = "measurement", unique_id = self.ZODIAC_HASS_ID + "_acl_setpoint", device = device_info, unit_of_measurement = "mV")
-        s_acl_setpoint_settings     = Settings(mqtt = self.mqtt_settings, entity = s_acl_setpoint_info)
-        self.acl_setpoint           = Sensor(s_acl_setpoint_settings)
+        if isinstance(devices_config, dict):
+            devices_config = [devices_config]
+        if not isinstance(devices_config, list) or not devices_config or not all(isinstance(c, dict) for c in devices_config):
+            _LOGGER.error("Zodiac section should be a device or a non-empty list of devices!")
+            raise ConfigFileMalformed()
 
-        s_acl_current_info          = SensorInfo(name = "Current ACL", min = 0, max = 1000, state_class = "measurement", unique_id = self.ZODIAC_HASS_ID + "_acl_current", device = device_info, unit_of_measurement = "mV")
-        s_acl_current_settings      = Settings(mqtt = self.mqtt_settings, entity = s_acl_current_info)
-        self.s_acl_current          = Sensor(s_acl_current_settings)
+        self.devices = [
+            (self.SNIFFER_CLASS if device_config.get("listen_only") else self.DEVICE_CLASS)(self, device_config, index)
+            for index, device_config in enumerate(devices_config)
+        ]
 
-        n_output_power_info         = NumberInfo(name = "Output power", min = 0, max = 101, mode = "slider", step = 1, unique_id = self.ZODIAC_HASS_ID + "_output_power", device = device_info, unit_of_measurement = "%")
-        n_output_power_settings     = Settings(mqtt = self.mqtt_settings, entity = n_output_power_info)
-        self.n_output_power         = Number(n_output_power_settings, lambda c, u, m: self.power_callback(c, m))
-        self.n_output_power.set_value(self.current_output_power)
+        for attribute in ("serial_port", "name", "hass_id"):
+            values = [getattr(device, attribute) for device in self.devices]
+            if len(set(values)) != len(values):
+                _LOGGER.error(f"Devices should have unique {attribute}!")
+                raise ConfigFileMalformed()
 
-        _LOGGER.info(f"Setup done!")
+        backlog_files = [device.backlog_file for device in self.devices if device.backlog_file is not None]
+        if len(set(backlog_files)) != len(backlog_files):
+            _LOGGER.error("Devices should have unique backlog_file!")
+            raise ConfigFileMalformed()
 
-    # To receive number updates from HA, define a callback function:
-    def power_callback(self, client: Client, message: MQTTMessage):
-        power = int(message.payload.decode())
-        self.current_output_power = power
-        _LOGGER.debug(f"Received output power = {power} % from HA.")
-        # Send an MQTT message to confirm to HA that the number was changed
-        self.n_output_power.set_value(power)
+    # Opens the single MQTT connection shared by all entities.
+    # Raises FatalError if the broker does not accept the connection in time.
+    def _connect_mqtt(self):
+        ######################################################################
+        # Connect to MQTT broker
+        ######################################################################
+        _LOGGER.info(f"Launching MQTT client...")
+        self.mqtt_client        = _TimedMqttClient()
+        self.mqtt_subscriptions = []
+        self._mqtt_connected    = threading.Event()
+
+        def on_connect(client, userdata, flags, reason_code, properties):
+            if reason_code.is_failure:
+                _LOGGER.error(f"MQTT broker refused connection: {reason_code}")
+                return
+            # Subscriptions are lost on reconnect with a clean session, renew them.
+            for topic in self.mqtt_subscriptions:
+                client.subscribe(topic, qos = 1)
+            # The broker may have been restarted, publish all states again.
+            for device in self.devices:
+                device.invalidate_states()
+                device.replay_backlog()
+            self._mqtt_connected.set()
+
+        self.mqtt_client.on_connect = on_connect
+        self._open_mqtt()
+
+        # Configure the required parameters for the MQTT broker, entities publish through the shared client.
+        self.mqtt_settings = Settings.MQTT(
+            host     = self.mqtt_host,
+            port     = self.mqtt_port,
+            username = self.mqtt_username,
+            password = self.mqtt_password,
+            client   = self.mqtt_client
+        )
 
-    def sigterm_handler(self):
+    # Connects the client to the configured broker, paho keeps retrying in background.
+    # Raises FatalError if the broker does not accept the connection in time.
+    def _open_mqtt(self):
+        self._mqtt_connected.clear()
+        self.mqtt_client.username_pw_set(self.mqtt_username, self.mqtt_password)
+        self.mqtt_client.connect_async(self.mqtt_host, self.mqtt_port)
+        self.mqtt_client.loop_start()
+
+        if not self._mqtt_connected.wait(MQTT_CONNECT_TIMEOUT):
+            _LOGGER.error(f"Can't connect to MQTT broker at {self.mqtt_host}:{self.mqtt_port}!")
+            raise FatalError()
+
+    # Moves the client to the broker settings of the reloaded config. Entities keep
+    # the client, so nothing is rediscovered, samples go to the backlog meanwhile.
+    def _reconnect_mqtt(self):
+        _LOGGER.info(f"Reconnecting to MQTT broker at {self.mqtt_host}:{self.mqtt_port}...")
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+        try:
+            self._open_mqtt()
+        except FatalError:
+            _LOGGER.error("Reconnecting in background, readings go to the backlog meanwhile.")
+
+    # Applies changes of the config file, on SIGHUP. Poll intervals, publish filters
+    # and the default power are updated in place, the MQTT connection is rebuilt only
+    # if the broker settings changed. Serial links and HA devices stay up, changes
+    # which need them set up again are reported and left for a restart.
+    def reload(self):
+        with self._reload_lock:
+            staged = object.__new__(type(self))
+            try:
+                staged._load_config(self.config_file_path)
+            except (ConfigFileMalformed, OSError, yaml.YAMLError):
+                _LOGGER.error("Config file not reloaded, keeping the running config.")
+                return
+
+            for field in self.RESTART_FIELDS:
+                if getattr(staged, field) != getattr(self, field):
+                    _LOGGER.warning(f"Change of {field} takes effect after restart.")
+
+            staged_devices = {device.hass_id: device for device in staged.devices}
+            if set(staged_devices) != {device.hass_id for device in self.devices}:
+                _LOGGER.warning("Added or removed devices take effect after restart.")
+
+            self.refresh_interval = staged.refresh_interval
+            self.publish_config   = staged.publish_config
+            self.polling_config   = staged.polling_config
+            self.profiling.reconfigure(staged.profiling)
+            for device in self.devices:
+                if device.hass_id in staged_devices:
+                    device.reconfigure(staged_devices[device.hass_id])
+
+            mqtt_changed = [field for field in self.MQTT_FIELDS if getattr(staged, field) != getattr(self, field)]
+            for field in mqtt_changed:
+                setattr(self, field, getattr(staged, field))
+            if mqtt_changed:
+                self._reconnect_mqtt()
+
+            _LOGGER.info("Config file reloaded.")
+
+    # Serves /metrics if enabled in the config file.
+    # Raises FatalError if the port can't be bound.
+    def _start_metrics(self):
+        if self.metrics_port is None:
+            return
+        try:
+            self.metrics_server = start_metrics_server(self.metrics_host, self.metrics_port)
+        except OSError as e:
+            _LOGGER.error(f"Can't serve metrics at {self.metrics_host}:{self.metrics_port}: {e}")
+            raise FatalError()
+
+    # Serves the local API if enabled in the config file.
+    # Raises FatalError if the socket can't be created.
+    def _start_api(self):
+        self.api_server = None
+        if self.api_socket is None:
+            return
+        try:
+            self.api_server = start_local_api(self.api_socket, self.api_mode, self.devices)
+        except OSError as e:
+            _LOGGER.error(f"Can't serve the local API at {self.api_socket}: {e}")
+            raise FatalError()
+
+    # Closes the local API and removes its socket.
+    def _stop_api(self):
+        if self.api_server is not None:
+            self.api_server.close()
+
+    # Watches USB serial adapters being plugged in and out, for devices to reconnect.
+    def _start_hotplug(self):
+        self.hotplug = HotplugWatcher()
+        self.hotplug.start()
+
+    # Devices finish their serial transaction in progress and report their entities
+    # offline, the MQTT connection is closed. Bounded by the deadline of the coordinator.
+    def _shutdown(self, threads : list[threading.Thread]):
         _LOGGER.info("Terminating connection to HA...")
-        # Setting connection state to disconnected when shutting down the script.
+        self.shutdown.begin()
+        for device in self.devices:
+            device.stop()
+        for thread in threads:
+            thread.join(self.shutdown.remaining())
+        for device in self.devices:
+            device.shutdown(self.shutdown.remaining())
+        self._stop_api()
+        self._disconnect_mqtt()
+
+    def _disconnect_mqtt(self):
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+
+    # Device thread, runs until the device fails for good or the bridge is stopping.
+    def _run_device(self, device : ZodiacDevice):
         try:
-            self.s_connection_state.off()
-        except AttributeError:
+            device.setup()
+            device.loop()
+        except InterruptedError:
             pass
-        raise InterruptedError()
-
+        except (CantConnectToZodiac, FatalError) as e:
+            _LOGGER.error(f"Device {device.name} at {device.serial_port} stopped!")
+            device.shutdown()
+            self.device_errors.append(e)
+            self.shutdown.wake()
+
+    # Polls every device in its own thread until SIGTERM/SIGINT, raising InterruptedError
+    # after shutting down. Returns earlier only if all devices fail, raising the error of
+    # the first failed one.
     def loop(self):
-
-        current_fails = 0
-
-        while True:
-            try:
-                status = self.aqualink.set_output_get_info(self.current_output_power)
-            except NoResponseException:
-                current_fails += 1
-                _LOGGER.warning(f"No response from Zodiac! Currently {current_fails} fails.")
-                
-                if current_fails > CONN_DEAD_THRESH:
-                    self.s_connection_state.off()
-
-                sleep(WAIT_BETWEEN_COMMANDS)
-                continue
-            
-            current_fails = 0
-            self.s_connection_state.on()
-            self.s_ph_setpoint.set_state(status.ph_setpoint)
-            self.s_ph_current.set_state(status.ph_current)
-            self.acl_setpoint.set_state(status.acl_setpoint)
-            self.s_acl_current.set_state(status.acl_current)
-            sleep(self.refresh_interval)
-        
-            
-
+        threads = [
+            threading.Thread(target = self._run_device, args = (device,), name = f"device-{device.hass_id}", daemon = True)
+            for device in self.devices
+        ]
+        for thread in threads:
+            thread.start()
+
+        while not self.shutdown.requested and len(self.device_errors) < len(self.devices):
+            self.shutdown.wait()
+        if not self.shutdown.requested:
+            raise self.device_errors[0]
+
+        self._shutdown(threads)
+        raise InterruptedError()
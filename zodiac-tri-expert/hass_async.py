@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .constants            import *
+from .exceptions           import *
+from .hass                 import ZodiacHomeAssistant
+from .device_async         import AsyncZodiacDevice
+from .device_sniffer_async import AsyncSnifferDevice
+from .phase_timer          import PhaseTimer
+from .profiling            import format_tasks
+from .shutdown             import ShutdownCoordinator
+
+_LOGGER = logging.getLogger(__name__)
+
+# Asyncio variant of the integration. Serial communication runs on the event loop
+# (see AsyncAqualink), MQTT publishing is handed to a dedicated thread so a slow
+# broker never delays the serial link, and the poll loop is woken up as soon as
+# a new output power arrives from HA instead of waiting for the refresh interval.
+class AsyncZodiacHomeAssistant(ZodiacHomeAssistant):
+
+    DEVICE_CLASS  = AsyncZodiacDevice
+    SNIFFER_CLASS = AsyncSnifferDevice
+
+    def __init__(self, config_file_path : Path = "config.yaml"):
+        self.config_file_path    = config_file_path
+        self._device_caches      = {}
+        self._device_caches_lock = threading.Lock()
+        self._reload_lock        = threading.Lock()
+        self.device_errors       = []
+        self.shutdown            = ShutdownCoordinator()
+
+        self._startup_timer = PhaseTimer("Startup")
+        with self._startup_timer.phase("config"):
+            self._load_config(config_file_path)
+        self._start_metrics()
+        self._start_api()
+        self._start_hotplug()
+        self._mqtt_executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "mqtt")
+
+    async def setup(self):
+        self._loop = asyncio.get_running_loop()
+
+        self._loop.add_signal_handler(signal.SIGTERM, self.sigterm_handler)
+        self._loop.add_signal_handler(signal.SIGINT,  self.sigterm_handler)
+
+        timer = self._startup_timer
+        with timer.phase("mqtt connect"):
+            await self._publish(self._connect_mqtt)
+        timer.log()
+
+        # Reloads run with the MQTT publishes, which they may reconnect.
+        self._loop.add_signal_handler(signal.SIGHUP, lambda: self._loop.run_in_executor(self._mqtt_executor, self.reload))
+        self._loop.add_signal_handler(signal.SIGUSR1, lambda: self.profiling.toggle(in_event_loop = True))
+        self._loop.add_signal_handler(signal.SIGUSR2, self._dump)
+
+    # Called on the event loop, the tasks can only be read there, the rest is dumped in a thread.
+    def _dump(self):
+        threading.Thread(target = self.profiling.dump, args = (format_tasks(),), name = "dump", daemon = True).start()
+
+    # Called on the event loop, the poll loops finish their current transaction and exit,
+    # then the devices report their entities offline, within the deadline of the coordinator.
+    def sigterm_handler(self):
+        self.shutdown.begin()
+        for device in self.devices:
+            device.wake()
+
+    async def _publish(self, function, *args):
+        await self._loop.run_in_executor(self._mqtt_executor, function, *args)
+
+    # Runs until the device fails for good or the bridge is stopping.
+    async def _run_device(self, device : AsyncZodiacDevice):
+        try:
+            await device.setup()
+            await device.loop()
+        except InterruptedError:
+            pass
+        except (CantConnectToZodiac, FatalError) as e:
+            _LOGGER.error(f"Device {device.name} at {device.serial_port} stopped!")
+            self.device_errors.append(e)
+        await self._publish(device.shutdown, self.shutdown.remaining())
+
+    # Polls all devices concurrently. Returns only if all devices fail, raising
+    # the error of the first failed one.
+    async def loop(self):
+        await asyncio.gather(*(self._run_device(device) for device in self.devices))
+        self._mqtt_executor.shutdown()
+        self._stop_api()
+
+        if self.shutdown.stopping.is_set():
+            _LOGGER.info("Terminating connection to HA...")
+            self._disconnect_mqtt()
+            raise InterruptedError()
+        raise self.device_errors[0]
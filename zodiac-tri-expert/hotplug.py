@@ -0,0 +1,119 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+
+from .constants import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# The stable link udev keeps for the USB adapter behind the port, which follows
+# the adapter when it comes back under another /dev/ttyUSB* name.
+# Returns None for ports without one (built-in UARTs, pseudo-terminals).
+def find_by_id_link(serial_port : str, directory : Path) -> Path | None:
+    path = Path(serial_port)
+    if path.parent == directory:
+        return path
+    try:
+        target = path.resolve()
+        for link in directory.iterdir():
+            if link.resolve() == target:
+                return link
+    except OSError:
+        pass
+    return None
+
+# Reports USB serial adapters plugged in and out, by the names of their links in
+# /dev/serial/by-id, using inotify. udev removes the directory with the last adapter,
+# so its parents are watched too until it's back. Without inotify (not on Linux),
+# nothing is reported and unplugged adapters are only looked for on poll retries.
+class HotplugWatcher:
+
+    EVENT = struct.Struct("iIII") # Watch descriptor, mask, cookie, length of the name.
+
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_IGNORED     = 0x00008000
+    IN_CLOEXEC     = 0o2000000
+
+    MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+
+    def __init__(self, directory : Path = SERIAL_BY_ID_DIR):
+        self.directory  = Path(directory)
+        self._listeners = {} # Link name -> callbacks taking True when plugged in, False when out.
+        self._lock      = threading.Lock()
+        self._watches   = {} # Watch descriptor -> directory.
+        self._fd        = None
+
+    # Called with True when the adapter with the link name is plugged in, False when unplugged.
+    # Callbacks run on the watcher thread.
+    def add_listener(self, name : str, callback):
+        with self._lock:
+            self._listeners.setdefault(name, []).append(callback)
+
+    def start(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            self._fd   = self._libc.inotify_init1(self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            self._fd = -1
+        if self._fd < 0:
+            _LOGGER.info("inotify not available, USB adapters are looked for on retries only.")
+            return
+
+        self._add_watches()
+        threading.Thread(target = self._run, name = "hotplug", daemon = True).start()
+
+    # Watches the directory and the parents up to /dev which exist and aren't watched yet.
+    def _add_watches(self):
+        watched = set(self._watches.values())
+        for path in (self.directory, self.directory.parent, self.directory.parent.parent):
+            if path in watched or not path.is_dir():
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+            if wd < 0:
+                continue
+            self._watches[wd] = path
+            # Links created before the watch was in place.
+            if path == self.directory:
+                for link in path.iterdir():
+                    self._notify(link.name, True)
+
+    def _notify(self, name : str, added : bool):
+        with self._lock:
+            callbacks = list(self._listeners.get(name, ()))
+        if callbacks:
+            _LOGGER.info(f"USB adapter {name} {'plugged in' if added else 'unplugged'}.")
+        for callback in callbacks:
+            callback(added)
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError as e:
+                _LOGGER.error(f"Can't read inotify events: {e}")
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name   = os.fsdecode(data[offset + self.EVENT.size : offset + self.EVENT.size + length].rstrip(b"\0"))
+                offset += self.EVENT.size + length
+
+                if mask & self.IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                path = self._watches.get(wd)
+                if path == self.directory and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._notify(name, True)
+                elif path == self.directory and mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self._notify(name, False)
+                elif path != self.directory and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add_watches()
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from pathlib import Path
+from time import time
+
+from .constants  import *
+from .exceptions import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# Local status and command API on a Unix-domain socket, for tools on the same host
+# which can't open the serial port while the bridge holds it. Requests and responses
+# are JSON objects, one per line:
+#   {"id": 1, "command": "status", "device": "<id of the device in HA>"}
+#   {"id": 1, "result": {...}}  or  {"id": 1, "error": "..."}
+# The id is any value and is echoed back. The device can be left out with a single device.
+# Commands:
+#   devices              IDs and names of the devices
+#   status               latest reading of a device, from memory without any bus traffic
+#   set_output (power)   sets the output power like HA does, result is the status read with it
+#   get_id               reads the ID of the chlorinator from the bus
+# A connection may send requests without waiting for responses; commands going to the
+# serial link are queued on it with the others (see SerialWorker and AsyncZodiacDevice)
+# and answered when done, so responses may come in a different order than the requests.
+class LocalApiServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path : Path, mode : int, devices : list):
+        self.path    = Path(path)
+        self.devices = {device.hass_id: device for device in devices}
+        self._remove_stale_socket()
+        super().__init__(str(self.path), _ApiHandler)
+        os.chmod(self.path, mode)
+
+    # A socket file left by a killed instance would fail the bind, one still accepting
+    # connections belongs to a running instance.
+    # Raises OSError if the path is taken.
+    def _remove_stale_socket(self):
+        try:
+            if not stat.S_ISSOCK(self.path.stat().st_mode):
+                raise FileExistsError(f"{self.path} exists and is not a socket")
+        except FileNotFoundError:
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(self.path))
+            except ConnectionRefusedError:
+                self.path.unlink()
+                return
+        raise FileExistsError(f"{self.path} is in use by another instance")
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+    # Returns the result, or a Future of it for commands going to the serial link.
+    # Raises ValueError with the message for the client on a bad request.
+    def execute(self, request : dict) -> object:
+        command = request.get("command")
+        if command == "devices":
+            return [{"device": device.hass_id, "name": device.name} for device in self.devices.values()]
+
+        device = self._device(request.get("device"))
+        if command == "status":
+            return self._status(device)
+        if command not in ("set_output", "get_id"):
+            raise ValueError(f"unknown command {command!r}")
+
+        if not hasattr(device, "n_output_power"):
+            raise ValueError("device not set up yet")
+        if command == "get_id":
+            return device.api_get_id()
+
+        power = request.get("power")
+        if type(power) is not int or not 0 <= power <= 101:
+            raise ValueError("power should be integer in [0, 101]")
+        if device.listen_only:
+            raise ValueError("listen-only, the output power is set by the bus master")
+        return device.api_set_output(power)
+
+    def _device(self, hass_id : str | None):
+        if hass_id is None and len(self.devices) == 1:
+            return next(iter(self.devices.values()))
+        try:
+            return self.devices[hass_id]
+        except (KeyError, TypeError):
+            raise ValueError(f"unknown device {hass_id!r}, one of {', '.join(self.devices)}")
+
+    @staticmethod
+    def _status(device) -> dict:
+        device_info = getattr(device, "device_info", None)
+        state       = device.state.current
+        result = {
+            "device":       device.hass_id,
+            "name":         device.name,
+            "id":           device_info.sw_version if device_info is not None else None,
+            "output_power": state.output_power,
+            "time":         None,
+            "age":          None,
+            "status":       None,
+        }
+        if state.status is not None:
+            result["time"]   = datetime.fromtimestamp(state.status_time, timezone.utc).isoformat()
+            result["age"]    = round(time() - state.status_time, 3)
+            result["status"] = state.status.as_dict()
+        return result
+
+# One connection. This thread reads and executes requests, responses are written by
+# a writer thread from a queue, so a serial transaction completing never waits on a slow
+# client. At most API_MAX_PENDING requests of a connection are in progress at once,
+# further ones are read once responses have been sent.
+class _ApiHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self._responses = queue.SimpleQueue()
+        self._pending   = threading.BoundedSemaphore(API_MAX_PENDING)
+        self._writer    = threading.Thread(target = self._write_responses, name = "api-writer", daemon = True)
+        self._writer.start()
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(API_MAX_REQUEST + 1)
+            if not line:
+                break
+            self._pending.acquire()
+            if len(line) > API_MAX_REQUEST:
+                self._respond(None, error = f"request longer than {API_MAX_REQUEST} bytes")
+                break
+            self._handle_request(line)
+
+    def finish(self):
+        self._responses.put(None)
+        self._writer.join()
+        super().finish()
+
+    def _handle_request(self, line : bytes):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request should be a JSON object")
+        except ValueError as e:
+            self._respond(None, error = str(e))
+            return
+
+        request_id = request.get("id")
+        try:
+            result = self.server.execute(request)
+        except ValueError as e:
+            self._respond(request_id, error = str(e))
+            return
+
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self._done(request_id, future))
+        else:
+            self._respond(request_id, result)
+
+    # Called on the thread completing the transaction.
+    def _done(self, request_id, future : Future):
+        error = future.exception()
+        if error is None:
+            result = future.result()
+            self._respond(request_id, result.as_dict() if hasattr(result, "as_dict") else result)
+        elif isinstance(error, NoResponseException):
+            self._respond(request_id, error = "no response from the chlorinator")
+        elif isinstance(error, InterruptedError):
+            self._respond(request_id, error = "shutting down")
+        else:
+            self._respond(request_id, error = f"{type(error).__name__}: {error}")
+
+    def _respond(self, request_id, result = None, error : str | None = None):
+        response = {"id": request_id, "error": error} if error is not None else {"id": request_id, "result": result}
+        self._responses.put(json.dumps(response).encode() + b"\n")
+
+    def _write_responses(self):
+        connected = True
+        while (response := self._responses.get()) is not None:
+            if connected:
+                try:
+                    self.wfile.write(response)
+                except OSError:
+                    # Client gone, keep releasing the requests still completing.
+                    connected = False
+            self._pending.release()
+
+# Serves the API in a daemon thread, returns the server to allow closing it.
+# Raises OSError if the socket can't be created.
+def start_local_api(path : Path, mode : int, devices : list) -> LocalApiServer:
+    server = LocalApiServer(path, mode, devices)
+    threading.Thread(target = server.serve_forever, name = "local-api", daemon = True).start()
+    _LOGGER.info(f"Serving the local API at {path}")
+    return server
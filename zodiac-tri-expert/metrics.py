@@ -0,0 +1,182 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LOGGER = logging.getLogger(__name__)
+
+######################################################################
+# Metric types
+######################################################################
+
+# Monotonic counter, one value per combination of label values.
+class Counter:
+    TYPE = "counter"
+
+    def __init__(self, name : str, help : str, labels : tuple = ()):
+        self.name   = name
+        self.help   = help
+        self.labels = labels
+        self.values = {}
+        self._lock  = threading.Lock()
+
+    def inc(self, *label_values, amount : float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self.values.get(label_values, 0)
+
+    # Sum over all series whose label values start with the given ones.
+    def total(self, *label_prefix) -> float:
+        with self._lock:
+            return sum(value for labels, value in self.values.items() if labels[:len(label_prefix)] == label_prefix)
+
+    def _format_labels(self, label_values : tuple, extra : str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, label_values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+# Histogram with fixed buckets, observing is a bisect and a few additions.
+class Histogram(Counter):
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    class _Series:
+        def __init__(self, buckets : int):
+            self.counts = [0] * (buckets + 1) # Last one is +Inf.
+            self.sum    = 0
+            self.count  = 0
+
+    def __init__(self, name : str, help : str, labels : tuple = (), buckets : tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value : float, *label_values):
+        with self._lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = self._Series(len(self.buckets))
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.sum   += value
+            series.count += 1
+
+    # Returns (count, sum) of the series.
+    def get(self, *label_values) -> tuple[int, float]:
+        series = self.values.get(label_values)
+        return (series.count, series.sum) if series is not None else (0, 0)
+
+    def collect(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for labels, series in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series.counts):
+                    cumulative += count
+                    le          = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{self._format_labels(labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(labels)} {series.sum}")
+                lines.append(f"{self.name}_count{self._format_labels(labels)} {series.count}")
+        return lines
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name : str, help : str, labels : tuple = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name : str, help : str, labels : tuple = (), buckets : tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    # Prometheus text exposition format.
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+######################################################################
+# Metrics of the integration
+######################################################################
+
+REGISTRY = MetricsRegistry()
+
+ROUND_TRIP     = REGISTRY.histogram("zodiac_round_trip_seconds",          "Time from sending a command to a decoded response.", ("port", "command"))
+TIMEOUTS       = REGISTRY.counter("zodiac_timeouts_total",                "Commands without a complete response in time.",      ("port", "command"))
+MALFORMED      = REGISTRY.counter("zodiac_malformed_responses_total",     "Rejected responses by reason.",                      ("port", "reason"))
+JUNK_BYTES     = REGISTRY.counter("zodiac_junk_bytes_total",              "Bytes received outside of any frame.",               ("port",))
+RECONNECTS     = REGISTRY.counter("zodiac_reconnects_total",              "Recoveries of the serial port after an IO error.",   ("port",))
+RECOVERY       = REGISTRY.histogram("zodiac_recovery_seconds",            "Time from losing the serial port to the first response after reopening it.", ("port",),
+                                    buckets = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+SNIFFED        = REGISTRY.counter("zodiac_sniffed_frames_total",          "Valid frames seen on the bus in listen-only mode.",  ("port", "destination"))
+SNIFFED_LOST   = REGISTRY.counter("zodiac_sniffed_frames_lost_total",     "Frames on the bus which could not be decoded.",     ("port", "reason"))
+MQTT_PUBLISH   = REGISTRY.histogram("zodiac_mqtt_publish_seconds",        "Time from an MQTT publish call until it was sent.",
+                                    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+# Matches MQTT publish calls with their on_publish callbacks by message ID. The callback
+# may run on the network thread before publish() returns, whichever comes second observes.
+class PublishTimer:
+
+    MAX_PENDING = 1000 # Publishes dropped while disconnected never complete.
+
+    def __init__(self):
+        self._pending = {} # Message ID -> (time, is start)
+        self._lock    = threading.Lock()
+
+    def started(self, mid : int, now : float):
+        self._event(mid, now, True)
+
+    def finished(self, mid : int, now : float):
+        self._event(mid, now, False)
+
+    def _event(self, mid : int, now : float, is_start : bool):
+        with self._lock:
+            other = self._pending.pop(mid, None)
+            if other is None or other[1] == is_start:
+                if len(self._pending) >= self.MAX_PENDING:
+                    self._pending.clear()
+                self._pending[mid] = (now, is_start)
+                return
+        start, end = (now, other[0]) if is_start else (other[0], now)
+        MQTT_PUBLISH.observe(max(end - start, 0))
+
+######################################################################
+# HTTP endpoint
+######################################################################
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(format % args)
+
+# Serves /metrics in a daemon thread, returns the server to allow shutting it down.
+def start_metrics_server(host : str, port : int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, name = "metrics", daemon = True).start()
+    _LOGGER.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
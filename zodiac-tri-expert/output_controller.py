@@ -0,0 +1,114 @@
+import logging
+
+from .exceptions import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# PID controller of the output power, holding the measured ACL at the setpoint of the SWG.
+# The error is in mV (setpoint - current), the output in % of power. The derivative
+# acts on the measurement, so setpoint changes don't kick the output. Against windup,
+# the integral stops while the output is saturated in the direction of the error and
+# is kept within the output range. With boost_error set, an error at least that large
+# switches to boost (101 %) until it falls below half of it, the integral is frozen
+# meanwhile. An output power from HA overrides the controller for override_time seconds,
+# then it resumes from that power without a bump.
+class OutputController:
+
+    CONFIG_FIELDS = ("kp", "ki", "kd", "min_power", "max_power", "boost_error", "override_time", "max_dt")
+
+    BOOST_POWER = 101
+
+    def __init__(self, initial_power : int, kp : float = 0.1, ki : float = 0.0002, kd : float = 0, min_power : float = 0, max_power : float = 100,
+                 boost_error : float | None = None, override_time : float = 3600, max_dt : float = 60):
+        self.kp            = kp
+        self.ki            = ki
+        self.kd            = kd
+        self.min_power     = min_power
+        self.max_power     = max_power
+        self.boost_error   = boost_error
+        self.override_time = override_time
+        self.max_dt        = max_dt # Longer gaps between readings (outages) count as this.
+
+        self.integral       = self._clamp(initial_power)
+        self.boosting       = False
+        self.override_until = None
+        self._last_time     = None
+        self._last_acl      = None
+
+    # Builds a controller from the config section, None if the section is missing.
+    # Raises ConfigFileMalformed on invalid values.
+    @classmethod
+    def from_config(cls, section : dict | None, initial_power : int) -> "OutputController | None":
+        if section is None:
+            return None
+        if not isinstance(section, dict):
+            _LOGGER.error("Controller section should contain its fields!")
+            raise ConfigFileMalformed()
+
+        unknown = set(section) - set(cls.CONFIG_FIELDS)
+        if unknown:
+            _LOGGER.error(f"Unknown controller fields: {', '.join(unknown)}")
+            raise ConfigFileMalformed()
+        try:
+            # Null boost_error disables boost, same as leaving it out.
+            params = {name: float(value) for name, value in section.items() if not (name == "boost_error" and value is None)}
+        except (TypeError, ValueError):
+            _LOGGER.error("Controller fields should be numbers!")
+            raise ConfigFileMalformed()
+
+        controller = cls(initial_power, **params)
+        if not 0 <= controller.min_power <= controller.max_power <= 100:
+            _LOGGER.error("Controller power range should be 0 <= min_power <= max_power <= 100!")
+            raise ConfigFileMalformed()
+        if min(controller.kp, controller.ki, controller.kd, controller.override_time) < 0 or controller.max_dt <= 0:
+            _LOGGER.error("Controller gains and override_time should be >= 0, max_dt > 0!")
+            raise ConfigFileMalformed()
+        if controller.boost_error is not None and controller.boost_error <= 0:
+            _LOGGER.error("Controller boost_error should be > 0!")
+            raise ConfigFileMalformed()
+        return controller
+
+    # Takes over the settings of the controller built from the reloaded config, keeping its state.
+    def reconfigure(self, other : "OutputController"):
+        for name in self.CONFIG_FIELDS:
+            setattr(self, name, getattr(other, name))
+        self.integral = self._clamp(self.integral)
+
+    def _clamp(self, power : float) -> float:
+        return min(max(power, self.min_power), self.max_power)
+
+    # Holds the power set from HA, the controller resumes from it later.
+    def override(self, power : int, now : float):
+        self.override_until = now + self.override_time
+        self.integral       = self._clamp(power)
+        self.boosting       = False
+
+    # Returns the output power for the reading, None while overridden from HA.
+    def update(self, status, now : float) -> int | None:
+        if self.override_until is not None:
+            if now < self.override_until:
+                return None
+            _LOGGER.info("Override from HA expired, controlling the output power again.")
+            self.override_until = None
+            self._last_time     = None
+
+        dt              = 0 if self._last_time is None else min(now - self._last_time, self.max_dt)
+        last_acl        = self._last_acl
+        self._last_time = now
+        self._last_acl  = status.acl_current
+
+        error = status.acl_setpoint - status.acl_current
+        if self.boost_error is not None and (error >= self.boost_error or (self.boosting and error >= self.boost_error / 2)):
+            if not self.boosting:
+                _LOGGER.info(f"ACL {error} mV below setpoint, boosting.")
+            self.boosting = True
+            return self.BOOST_POWER
+        self.boosting = False
+
+        derivative = 0 if dt == 0 or last_acl is None else -self.kd * (status.acl_current - last_acl) / dt
+        integral   = self.integral + self.ki * error * dt
+        output     = self.kp * error + integral + derivative
+        if not ((output > self.max_power and error > 0) or (output < self.min_power and error < 0)):
+            self.integral = self._clamp(integral)
+
+        return round(self._clamp(self.kp * error + self.integral + derivative))
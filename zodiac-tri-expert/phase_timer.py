@@ -0,0 +1,26 @@
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+
+_LOGGER = logging.getLogger(__name__)
+
+# Measures durations of named phases, e.g. of the startup. Phases may run concurrently
+# in different threads, so the total may be shorter than the sum of the phases.
+class PhaseTimer:
+
+    def __init__(self, name : str):
+        self.name   = name
+        self.start  = perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name : str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, perf_counter() - start))
+
+    def log(self):
+        breakdown = ", ".join(f"{name} {elapsed:.3f} s" for name, elapsed in self.phases)
+        _LOGGER.info(f"{self.name} took {perf_counter() - self.start:.3f} s ({breakdown})")
@@ -0,0 +1,94 @@
+import logging
+import random
+
+from .constants  import *
+from .exceptions import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# Decides how long to wait before the next poll of a device.
+# Polls come every min_interval while pH or ACL move by at least ph_change/acl_change
+# between polls and right after an output power change. While the readings are
+# stable, the interval grows from refresh_interval by POLL_INTERVAL_GROWTH per poll
+# up to max_interval. Failed polls are retried after WAIT_BETWEEN_COMMANDS doubled
+# per consecutive failure up to retry_max, with jitter so devices on a shared bus
+# don't retry in lockstep.
+class PollScheduler:
+
+    CONFIG_FIELDS = ("min_interval", "max_interval", "ph_change", "acl_change", "retry_max")
+
+    def __init__(self, refresh_interval : float, min_interval : float = 2, max_interval : float = 60, ph_change : float = 0.1, acl_change : float = 10, retry_max : float = 60):
+        self.refresh_interval = refresh_interval
+        self.min_interval     = min_interval
+        self.max_interval     = max_interval
+        self.ph_change        = ph_change
+        self.acl_change       = acl_change
+        self.retry_max        = retry_max
+
+        self.interval = refresh_interval
+        self.failures = 0
+        self._last    = None # Status of the last successful poll.
+
+    # Builds a scheduler from the config section, missing fields are taken from defaults.
+    # Raises ConfigFileMalformed on invalid values.
+    @classmethod
+    def from_config(cls, section : dict | None, defaults : dict, refresh_interval : float) -> "PollScheduler":
+        params = dict(defaults)
+        params.update(section or {})
+
+        unknown = set(params) - set(cls.CONFIG_FIELDS)
+        if unknown:
+            _LOGGER.error(f"Unknown polling fields: {', '.join(unknown)}")
+            raise ConfigFileMalformed()
+        try:
+            params = {name: float(value) for name, value in params.items()}
+        except (TypeError, ValueError):
+            _LOGGER.error("Polling fields should be numbers!")
+            raise ConfigFileMalformed()
+
+        scheduler = cls(refresh_interval, **params)
+        if not 0 < scheduler.min_interval <= scheduler.refresh_interval <= scheduler.max_interval:
+            _LOGGER.error("Polling intervals should be 0 < min_interval <= refresh_interval <= max_interval!")
+            raise ConfigFileMalformed()
+        if scheduler.retry_max < WAIT_BETWEEN_COMMANDS or scheduler.ph_change < 0 or scheduler.acl_change < 0:
+            _LOGGER.error(f"Polling retry_max should be >= {WAIT_BETWEEN_COMMANDS}, ph_change and acl_change >= 0!")
+            raise ConfigFileMalformed()
+        return scheduler
+
+    # Takes over the settings of the scheduler built from the reloaded config.
+    def reconfigure(self, other : "PollScheduler"):
+        self.refresh_interval = other.refresh_interval
+        for name in self.CONFIG_FIELDS:
+            setattr(self, name, getattr(other, name))
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+
+    # Compared as received, in tenths of pH and tens of mV, to avoid rounding errors.
+    def _moving(self, status) -> bool:
+        if self._last is None:
+            return False
+        return (abs(status.ph_current_raw  - self._last.ph_current_raw)  / 10 >= self.ph_change or
+                abs(status.acl_current_raw - self._last.acl_current_raw) * 10 >= self.acl_change)
+
+    # The device responds again, retries start over from the shortest pause.
+    def recovered(self):
+        self.failures = 0
+
+    # Returns seconds until the next poll after a successful one.
+    def succeeded(self, status) -> float:
+        self.recovered()
+        if self._moving(status):
+            self.interval = self.min_interval
+        elif self._last is not None:
+            self.interval = min(self.interval * POLL_INTERVAL_GROWTH, self.max_interval)
+        self._last = status
+        return self.interval
+
+    # Returns seconds until the next poll after a failed one.
+    def failed(self) -> float:
+        self.failures += 1
+        delay = min(WAIT_BETWEEN_COMMANDS * 2 ** (self.failures - 1), self.retry_max)
+        return random.uniform(delay / 2, delay)
+
+    # The output power changed, the readings are about to follow.
+    def output_changed(self):
+        self.interval = self.min_interval
@@ -0,0 +1,301 @@
+import asyncio
+import cProfile
+import gc
+import io
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import tracemalloc
+import traceback
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from time import monotonic, thread_time
+
+from .exceptions import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# Reads the CPU time of each running thread from /proc, empty where it's not available.
+def thread_cpu_times() -> dict[int, float]:
+    times = {}
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    for thread in threading.enumerate():
+        try:
+            with open(f"/proc/self/task/{thread.native_id}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError, TypeError):
+            continue
+        # utime and stime, the 14th and 15th fields, counted from the state after the name.
+        times[thread.ident] = (int(fields[11]) + int(fields[12])) / ticks
+    return times
+
+# Samples the stacks of all threads but its own at a fixed interval, counting them as
+# folded stacks ("thread;outer;...;inner"), the input of flamegraph.pl and speedscope.
+# Blocked threads are sampled too, the CPU time of each thread tells the busy ones.
+class SamplingProfiler(threading.Thread):
+
+    def __init__(self, interval : float):
+        super().__init__(name = "profiler", daemon = True)
+        self.interval  = interval
+        self.stacks    = Counter()
+        self.samples   = 0
+        self._stopping = threading.Event()
+        self._labels   = {} # Code object -> frame label.
+
+        self.start_time = monotonic()
+        self.start_cpu  = thread_cpu_times()
+        self.cpu_time   = 0 # Taken by the sampling itself.
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+            self.samples += 1
+        self.cpu_time = thread_time()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    # Writes the folded stacks and a summary: CPU use per thread, the frames
+    # most often on top of the stack and in the stack.
+    def write(self, path : Path):
+        elapsed = monotonic() - self.start_time
+        cpu     = thread_cpu_times()
+        names   = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        with open(path.with_suffix(".folded"), "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+        # Shares of the samples of each thread.
+        own       = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            thread, *frames = stack.split(";")
+            own[f"{thread}: {frames[-1]}"] += count
+            for frame in set(frames):
+                inclusive[f"{thread}: {frame}"] += count
+
+        with open(path.with_suffix(".txt"), "w") as file:
+            file.write(f"{self.samples} samples in {elapsed:.1f} s, every {1000 * self.interval:.0f} ms, "
+                       f"the profiler took {self.cpu_time:.2f} s of CPU\n\n")
+            file.write("CPU per thread:\n")
+            for ident, seconds in sorted(cpu.items(), key = lambda item: item[1] - self.start_cpu.get(item[0], 0), reverse = True):
+                if ident == threading.get_ident():
+                    continue
+                used = seconds - self.start_cpu.get(ident, 0)
+                file.write(f"  {names.get(ident, ident):<40} {used:8.2f} s {100 * used / elapsed:6.1f} %\n")
+            file.write("\nOn top of the stack, % of the samples of the thread:\n")
+            for frame, count in own.most_common(20):
+                file.write(f"  {100 * count / max(self.samples, 1):6.1f} %  {frame}\n")
+            file.write("\nIn the stack, % of the samples of the thread:\n")
+            for frame, count in inclusive.most_common(30):
+                file.write(f"  {100 * count / max(self.samples, 1):6.1f} %  {frame}\n")
+
+# Runtime profiling toggled by SIGUSR1 and dumps of the process state on SIGUSR2,
+# written to the configured directory. Profiling samples all threads, or with cProfile
+# traces the event loop of the asyncio runtime (cProfile only sees the thread it's enabled in).
+# The first dump starts tracemalloc, every dump reports the allocations which grew and
+# the objects by type which were added since the previous one, so two dumps some time
+# apart show a slow leak. Each dump also has the stacks of all threads and asyncio tasks.
+class ProfilingHooks:
+
+    PROFILERS = ("sampling", "cprofile")
+
+    def __init__(self, directory : Path = "profiling", profiler : str = "sampling", sample_interval : float = 0.01, tracemalloc_frames : int = 1):
+        self.directory          = Path(directory)
+        self.profiler           = profiler
+        self.sample_interval    = sample_interval
+        self.tracemalloc_frames = tracemalloc_frames
+
+        self._sampler   = None
+        self._cprofile  = None
+        self._started   = None
+        self._snapshot  = None # Of tracemalloc at the previous dump.
+        self._objects   = None # Counts by type at the previous dump.
+        self._dump_lock = threading.Lock()
+
+    # Raises ConfigFileMalformed on invalid values.
+    @classmethod
+    def from_config(cls, section : dict) -> "ProfilingHooks":
+        if not isinstance(section, dict):
+            _LOGGER.error("Profiling section should contain its fields!")
+            raise ConfigFileMalformed()
+        try:
+            hooks = cls(
+                directory          = str(section.get("directory", "profiling")),
+                profiler           = str(section.get("profiler", "sampling")),
+                sample_interval    = int(section.get("sample_interval_ms", 10)) / 1000,
+                tracemalloc_frames = int(section.get("tracemalloc_frames", 1)),
+            )
+        except (TypeError, ValueError):
+            _LOGGER.error("Profiling sample_interval_ms and tracemalloc_frames should be integers!")
+            raise ConfigFileMalformed()
+        if hooks.profiler not in cls.PROFILERS:
+            _LOGGER.error(f"Profiler should be one of: {', '.join(cls.PROFILERS)}")
+            raise ConfigFileMalformed()
+        if hooks.sample_interval <= 0 or hooks.tracemalloc_frames < 1:
+            _LOGGER.error("Profiling sample_interval_ms and tracemalloc_frames should be > 0!")
+            raise ConfigFileMalformed()
+        return hooks
+
+    # Takes over the settings from the reloaded config, for the next profile and dump.
+    def reconfigure(self, other : "ProfilingHooks"):
+        self.directory          = other.directory
+        self.profiler           = other.profiler
+        self.sample_interval    = other.sample_interval
+        self.tracemalloc_frames = other.tracemalloc_frames
+
+    def _path(self, kind : str) -> Path:
+        self.directory.mkdir(parents = True, exist_ok = True)
+        return self.directory / f"{kind}-{datetime.now():%Y%m%d-%H%M%S}"
+
+    # Starts or stops profiling. Called from the signal handler, in_event_loop when
+    # that's the thread running the event loop of the asyncio runtime. The profile is
+    # written out of the calling thread.
+    def toggle(self, in_event_loop : bool = False):
+        if self._sampler is not None:
+            sampler, self._sampler = self._sampler, None
+            sampler.stop()
+            threading.Thread(target = self._write, args = (sampler.write,), name = "profile-writer", daemon = True).start()
+            return
+        if self._cprofile is not None:
+            profile, self._cprofile = self._cprofile, None
+            profile.disable()
+            started = self._started
+            threading.Thread(target = self._write, args = (lambda path: self._write_cprofile(profile, started, path),),
+                             name = "profile-writer", daemon = True).start()
+            return
+
+        if self.profiler == "cprofile" and in_event_loop:
+            self._cprofile = cProfile.Profile()
+            self._started  = monotonic()
+            self._cprofile.enable()
+            _LOGGER.info("Profiling the event loop with cProfile, send SIGUSR1 again to stop.")
+            return
+        if self.profiler == "cprofile":
+            _LOGGER.warning("cProfile would only see the main thread, sampling all threads instead.")
+        self._sampler = SamplingProfiler(self.sample_interval)
+        self._sampler.start()
+        _LOGGER.info(f"Sampling all threads every {1000 * self.sample_interval:.0f} ms, send SIGUSR1 again to stop.")
+
+    def _write(self, writer):
+        try:
+            path = self._path("profile")
+            writer(path)
+        except OSError as e:
+            _LOGGER.error(f"Can't write the profile to {self.directory}: {e}")
+            return
+        _LOGGER.info(f"Profile written to {path}.*")
+
+    def _write_cprofile(self, profile : cProfile.Profile, started : float, path : Path):
+        profile.dump_stats(path.with_suffix(".pstats"))
+        with open(path.with_suffix(".txt"), "w") as file:
+            file.write(f"Event loop profiled for {monotonic() - started:.1f} s\n\n")
+            pstats.Stats(profile, stream = file).sort_stats("cumulative").print_stats(40)
+
+    # Writes the state of the process. Runs in its own thread, tasks are
+    # the stacks of asyncio tasks formatted on the event loop.
+    def dump(self, tasks : str = ""):
+        with self._dump_lock:
+            try:
+                path = self._path("dump").with_suffix(".txt")
+                with open(path, "w") as file:
+                    self._write_dump(file, tasks)
+            except OSError as e:
+                _LOGGER.error(f"Can't write the dump to {self.directory}: {e}")
+                return
+        _LOGGER.info(f"Dump written to {path}.")
+
+    # Without what the dumps themselves allocate.
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+
+    def _write_dump(self, file, tasks : str):
+        file.write(f"Dump of PID {os.getpid()} at {datetime.now():%Y-%m-%d %H:%M:%S}\n")
+        file.write(f"Max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+        try:
+            with open("/proc/self/statm") as statm:
+                file.write(f", RSS {int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024:.1f} MB")
+        except (OSError, IndexError, ValueError):
+            pass
+        file.write("\n\n")
+
+        frames = sys._current_frames()
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            if frame is None:
+                continue
+            file.write(f"Thread {thread.name} ({thread.native_id}):\n")
+            file.write("".join(traceback.format_stack(frame)))
+            file.write("\n")
+        if tasks:
+            file.write(tasks)
+            file.write("\n")
+
+        # Growth since the previous dump.
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+            file.write("Started tracing allocations, the next dump reports what grew since this one.\n\n")
+            self._snapshot = self._take_snapshot()
+        else:
+            snapshot = self._take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            file.write(f"Traced memory {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB. Allocations grown since the previous dump:\n")
+            key = "traceback" if self.tracemalloc_frames > 1 else "lineno"
+            for stat in snapshot.compare_to(self._snapshot, key)[:25]:
+                file.write(f"  {stat}\n")
+                if key == "traceback":
+                    for line in stat.traceback.format():
+                        file.write(f"    {line}\n")
+            file.write("\n")
+            self._snapshot = snapshot
+
+        gc.collect()
+        objects = Counter(type(obj).__name__ for obj in gc.get_objects())
+        if self._objects is None:
+            file.write("Objects by type:\n")
+            for name, count in objects.most_common(25):
+                file.write(f"  {count:>9}  {name}\n")
+        else:
+            file.write("Objects by type added since the previous dump:\n")
+            growth = Counter({name: count - self._objects.get(name, 0) for name, count in objects.items()})
+            for name, count in growth.most_common(25):
+                if count <= 0:
+                    break
+                file.write(f"  {count:>+9}  {name} ({objects[name]})\n")
+        self._objects = objects
+
+# Stacks of the asyncio tasks, called on the event loop.
+def format_tasks() -> str:
+    output = io.StringIO()
+    for task in asyncio.all_tasks():
+        output.write(f"{task!r}:\n")
+        task.print_stack(file = output)
+        output.write("\n")
+    return output.getvalue()
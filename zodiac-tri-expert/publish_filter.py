@@ -0,0 +1,85 @@
+import logging
+from time import monotonic
+
+from .exceptions import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# Decides whether a new entity state is worth publishing to MQTT.
+# A state is published when it moved out of the deadband (absolute or relative to
+# the last published value) and at least min_interval seconds passed since the last
+# publish, or when heartbeat seconds passed regardless of the value.
+# Non-numeric states (e.g. binary sensor on/off) are published when they change.
+class PublishFilter:
+
+    CONFIG_FIELDS = ("deadband", "relative_deadband", "min_interval", "heartbeat")
+
+    def __init__(self, deadband : float = 0, relative_deadband : float = 0, min_interval : float = 0, heartbeat : float = 300):
+        self.deadband          = deadband
+        self.relative_deadband = relative_deadband
+        self.min_interval      = min_interval
+        self.heartbeat         = heartbeat
+
+        self.last_value     = None
+        self.last_published = None
+        self.sent           = 0
+        self.suppressed     = 0
+
+    # Builds a filter from the config section, missing fields are taken from defaults.
+    # Raises ConfigFileMalformed on invalid values.
+    @classmethod
+    def from_config(cls, section : dict | None, defaults : dict) -> "PublishFilter":
+        params = dict(defaults)
+        params.update(section or {})
+
+        unknown = set(params) - set(cls.CONFIG_FIELDS)
+        if unknown:
+            _LOGGER.error(f"Unknown publish filter fields: {', '.join(unknown)}")
+            raise ConfigFileMalformed()
+        try:
+            params = {name: float(value) for name, value in params.items()}
+        except (TypeError, ValueError):
+            _LOGGER.error("Publish filter fields should be numbers!")
+            raise ConfigFileMalformed()
+        if any(value < 0 for value in params.values()):
+            _LOGGER.error("Publish filter fields should be >= 0!")
+            raise ConfigFileMalformed()
+
+        return cls(**params)
+
+    def _changed(self, value) -> bool:
+        if not isinstance(value, (int, float)) or not isinstance(self.last_value, (int, float)):
+            return value != self.last_value
+
+        delta = abs(value - self.last_value)
+        if delta == 0:
+            return False
+        return delta > self.deadband and delta > self.relative_deadband * abs(self.last_value)
+
+    # Returns True if the value should be published and records it as published.
+    def should_publish(self, value, now : float | None = None) -> bool:
+        if now is None:
+            now = monotonic()
+
+        if self.last_published is None:
+            publish = True
+        else:
+            elapsed = now - self.last_published
+            publish = elapsed >= self.heartbeat or (elapsed >= self.min_interval and self._changed(value))
+
+        if publish:
+            self.last_value     = value
+            self.last_published = now
+            self.sent          += 1
+        else:
+            self.suppressed    += 1
+        return publish
+
+    # Takes over the settings of the filter built from the reloaded config, keeping the last published value.
+    def reconfigure(self, other : "PublishFilter"):
+        for name in self.CONFIG_FIELDS:
+            setattr(self, name, getattr(other, name))
+
+    # Forces the next value to be published, e.g. after a reconnect to the broker.
+    def invalidate(self):
+        self.last_published = None
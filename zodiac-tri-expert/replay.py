@@ -0,0 +1,405 @@
+import argparse
+import itertools
+import logging
+import sys
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .constants         import *
+from .aqualink_protocol import *
+from .capture           import read_capture, DIRECTION_TX, DIRECTION_RX
+
+_LOGGER = logging.getLogger(__name__)
+
+# Offline analysis of serial captures (see capture.py). All records of a direction
+# are joined into one stream and decoded in a batch. With NumPy the whole stream is
+# deframed, unescaped and validated (header, footer, checksum) with array operations,
+# otherwise it goes through the streaming decoder record by record and each frame through
+# AqualinkResponse.malformed. Both report the same frames. The junk bytes of broken frames
+# are counted a little differently, the streaming decoder stops a frame where it breaks.
+# Commands are paired with the frame which follows them, for sent commands as for the
+# commands of a bus master seen in listen-only mode, and decoded by the response classes.
+# Run with:
+#   python3 -m zodiac-tri-expert.replay zodiac_capture.bin.1 zodiac_capture.bin
+
+DEST_MASTER = 0x00
+REASONS     = (None,) + tuple(AqualinkResponse.ERRORS) # Reason codes of the frames, 0 is valid.
+
+COMMAND_NAMES = {command.to_bytes()[3]: command.NAME for command in (PROBE_COMMAND, ID_COMMAND, SET_OUTPUT_COMMANDS[0])}
+CMD_ID         = ID_COMMAND.to_bytes()[3]
+CMD_SET_OUTPUT = SET_OUTPUT_COMMANDS[0].to_bytes()[3]
+STATUS_LEN     = OperationalStatus.OFFSET + OperationalStatus.STRUCT.size + 3
+
+# Traffic of one direction, the records joined. Record i ends at ends[i] in data.
+class CaptureStream:
+
+    def __init__(self, times : list[float], chunks : list[bytes]):
+        self.times = times
+        self.data  = b"".join(chunks)
+        self.ends  = list(itertools.accumulate(map(len, chunks)))
+        self.size  = len(self.data)
+
+# Reads the captures in order, returns the sent and received streams.
+# Raises ValueError if a file isn't a capture, OSError if it can't be read.
+def load_captures(paths : list[Path]) -> tuple[CaptureStream, CaptureStream]:
+    times  = {DIRECTION_TX: [], DIRECTION_RX: []}
+    chunks = {DIRECTION_TX: [], DIRECTION_RX: []}
+    for path in paths:
+        tx_times, tx_chunks = times[DIRECTION_TX].append, chunks[DIRECTION_TX].append
+        rx_times, rx_chunks = times[DIRECTION_RX].append, chunks[DIRECTION_RX].append
+        for timestamp, direction, data in read_capture(path):
+            if direction == DIRECTION_RX:
+                rx_times(timestamp)
+                rx_chunks(data)
+            else:
+                tx_times(timestamp)
+                tx_chunks(data)
+    return (CaptureStream(times[DIRECTION_TX], chunks[DIRECTION_TX]),
+            CaptureStream(times[DIRECTION_RX], chunks[DIRECTION_RX]))
+
+# Frames decoded from a stream, as columns: the time of the record completing the frame,
+# the reason code (index of REASONS), destination and command (-1 if the frame is too short).
+class DecodedFrames:
+
+    def __init__(self, time, reason, destination, command, dropped : int, junk : int):
+        self.time        = time
+        self.reason      = reason
+        self.destination = destination
+        self.command     = command
+        self.dropped     = dropped # Frames the framing broke in.
+        self.junk        = junk    # Bytes outside of frames.
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+class _PythonFrames(DecodedFrames):
+
+    def __init__(self, frames : list[bytes], *args):
+        super().__init__(*args)
+        self.frames = frames
+
+    def frame(self, i : int) -> bytes:
+        return self.frames[i]
+
+class _NumpyFrames(DecodedFrames):
+
+    def __init__(self, clean, starts, lengths, *args):
+        super().__init__(*args)
+        self.clean   = clean   # The stream unescaped.
+        self.starts  = starts  # Frame i is clean[starts[i]:starts[i] + lengths[i]].
+        self.lengths = lengths
+
+    def frame(self, i : int) -> bytes:
+        return self.clean[self.starts[i]:self.starts[i] + self.lengths[i]].tobytes()
+
+def decode_python(stream : CaptureStream, max_frame_len : int) -> DecodedFrames:
+    decoder = AqualinkFrameDecoder(max_frame_len)
+    data    = stream.data
+    frames  = []
+    times   = []
+    start   = 0
+    for timestamp, end in zip(stream.times, stream.ends):
+        for frame in decoder.feed(data[start:end]):
+            frames.append(frame)
+            times.append(timestamp)
+        start = end
+
+    reasons      = [REASONS.index(AqualinkResponse.malformed(frame)) for frame in frames]
+    destinations = [frame[2] if len(frame) > 2 else -1 for frame in frames]
+    commands     = [frame[3] if len(frame) > 3 else -1 for frame in frames]
+    return _PythonFrames(frames, times, reasons, destinations, commands, decoder.dropped_frames, decoder.discarded)
+
+def decode_numpy(stream : CaptureStream, max_frame_len : int) -> DecodedFrames:
+    a = np.frombuffer(stream.data, np.uint8)
+    n = len(a)
+
+    # A 0x10 and the byte after it, of a run of 0x10 the last one. Runs only occur in broken frames.
+    dle  = a[:-1] == AqualinkFrameDecoder.DLE
+    runs = np.flatnonzero(dle & (a[1:] == AqualinkFrameDecoder.DLE))
+    ctrl = np.flatnonzero(dle & (a[1:] != AqualinkFrameDecoder.DLE))
+    code = a[ctrl + 1]
+
+    headers = ctrl[code == AqualinkFrameDecoder.STX]
+    footers = ctrl[code == AqualinkFrameDecoder.ETX]
+    escapes = ctrl[code == AqualinkFrameDecoder.NUL]
+    bad     = np.sort(np.concatenate((runs, ctrl[(code != AqualinkFrameDecoder.STX) & (code != AqualinkFrameDecoder.ETX) & (code != AqualinkFrameDecoder.NUL)])))
+
+    # Each header is closed by the first footer after it, unless another header comes first.
+    k           = np.searchsorted(footers, headers)
+    end         = np.where(k < len(footers), footers[np.minimum(k, len(footers) - 1)], n)
+    next_header = np.append(headers[1:], n)
+    closed      = end < next_header
+    end         = np.minimum(end, next_header)
+
+    bad_inside  = np.searchsorted(bad, end) - np.searchsorted(bad, headers)
+    body_len    = end - headers - 2 - (np.searchsorted(escapes, end) - np.searchsorted(escapes, headers))
+    fits        = (bad_inside == 0) & (body_len + 2 <= max_frame_len)
+    ok          = closed & fits
+    in_progress = ~closed & (next_header == n) & fits # Still being received at the end of the capture.
+    dropped     = int(len(headers) - ok.sum() - in_progress.sum())
+    junk        = int(n - (np.where(closed, end + 2, end) - headers).sum())
+
+    # Unescaped, a position moves back by the escapes before it.
+    keep = np.ones(n, bool)
+    keep[escapes + 1] = False
+    clean   = a[keep]
+    starts  = headers[ok] - np.searchsorted(escapes, headers[ok] - 1)
+    lengths = (end[ok] + 2) - np.searchsorted(escapes, end[ok] + 1) - starts
+    last    = starts + lengths - 1
+
+    # Sums of the bytes up to each position, mod 256 by the uint8 wraparound.
+    sums     = np.concatenate((np.zeros(1, np.uint8), np.cumsum(clean, dtype = np.uint8)))
+    short    = lengths < 5
+    checksum = np.where(short, 0, last - 2)
+    reason   = np.zeros(len(starts), np.int8)
+    reason[(sums[checksum] - sums[starts]) != clean[checksum]] = REASONS.index("checksum")
+    reason[(clean[last - 1] != AqualinkPacket.PACKET_FOOTER[0]) | (clean[last] != AqualinkPacket.PACKET_FOOTER[1])] = REASONS.index("footer")
+    reason[(clean[starts] != AqualinkPacket.PACKET_HEADER[0]) | (clean[starts + 1] != AqualinkPacket.PACKET_HEADER[1])] = REASONS.index("header")
+    reason[short] = REASONS.index("length")
+
+    record      = np.searchsorted(np.array(stream.ends), end[ok] + 2, side = "left")
+    times       = np.array(stream.times)[record]
+    destination = np.where(lengths > 2, clean[np.minimum(starts + 2, len(clean) - 1)].astype(np.int16), -1)
+    command     = np.where(lengths > 3, clean[np.minimum(starts + 3, len(clean) - 1)].astype(np.int16), -1)
+    return _NumpyFrames(clean, starts, lengths, times, reason, destination, command, dropped, junk)
+
+# What the captures tell about the link.
+class ReplayReport:
+
+    def __init__(self):
+        self.start          = None
+        self.end            = None
+        self.tx_bytes       = 0
+        self.rx_bytes       = 0
+        self.tx_frames      = 0
+        self.rx_frames      = 0
+        self.reasons        = {}   # Received frames by reason, "valid" included.
+        self.dropped        = 0
+        self.junk           = 0
+        self.destinations   = {}   # Valid received frames by destination.
+        self.commands       = {}   # Commands by name.
+        self.unanswered     = 0
+        self.bad_responses  = {}   # Malformed responses by reason.
+        self.round_trips    = []   # Sorted, of sent commands with a response.
+        self.statuses       = 0
+        self.flags          = {}   # Statuses with the flag set, by flag name.
+        self.lowest         = None # OperationalStatus of the lowest values of each field.
+        self.highest        = None
+        self.ids            = set()
+        self.intervals      = []   # (start, commands, unanswered, malformed responses).
+
+    def _percentile(self, q : float) -> float:
+        return self.round_trips[min(len(self.round_trips) - 1, int(q * len(self.round_trips)))]
+
+    def format(self) -> str:
+        def rate(count : int, total : int) -> str:
+            return f"{count} ({100 * count / total:.2f} %)" if total else str(count)
+
+        def date(timestamp : float) -> str:
+            return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+        if self.start is None:
+            return "Nothing captured."
+        lines = [
+            f"Captured {date(self.start)} - {date(self.end)} ({(self.end - self.start) / 3600:.1f} h), "
+            f"{self.tx_bytes} B sent, {self.rx_bytes} B received",
+            f"Received {self.rx_frames} frames, {self.dropped} broken in framing, {self.junk} junk bytes",
+        ]
+        for reason, count in self.reasons.items():
+            lines.append(f"  {reason:<10} {rate(count, self.rx_frames)}")
+        if len(self.destinations) > 1:
+            lines.append("Valid frames by destination: " + ", ".join(f"0x{destination:02x} {count}" for destination, count in sorted(self.destinations.items())))
+
+        total = sum(self.commands.values())
+        if total:
+            lines.append(f"Commands {total} (" + ", ".join(f"{name} {count}" for name, count in sorted(self.commands.items())) + ")")
+            lines.append(f"  no response {rate(self.unanswered, total)}")
+            for reason, count in sorted(self.bad_responses.items()):
+                lines.append(f"  {reason:<11} {rate(count, total)}")
+        if self.round_trips:
+            lines.append(f"Round trip p50 {1000 * self._percentile(0.5):.1f} ms, p90 {1000 * self._percentile(0.9):.1f} ms, "
+                         f"p99 {1000 * self._percentile(0.99):.1f} ms, max {1000 * self.round_trips[-1]:.1f} ms")
+        if self.statuses:
+            lines.append(f"Statuses {self.statuses}, pH {self.lowest.ph_current}-{self.highest.ph_current}, "
+                         f"ACL {self.lowest.acl_current}-{self.highest.acl_current} mV, salt {self.lowest.salt}-{self.highest.salt} ppm")
+            flags = [f"{name} {count}" for name, count in self.flags.items() if count]
+            lines.append("  alarms: " + (", ".join(flags) if flags else "none"))
+        if self.ids:
+            lines.append("IDs: " + ", ".join(sorted(self.ids)))
+
+        if len(self.intervals) > 1:
+            lines.append(f"{'interval':<19} {'commands':>8} {'no response':>12} {'malformed':>10}")
+            for start, commands, unanswered, malformed in self.intervals:
+                lines.append(f"{date(start):<19} {commands:>8} {100 * unanswered / commands:>10.2f} % {100 * malformed / commands:>8.2f} %")
+        return "\n".join(lines)
+
+def _report(tx_stream : CaptureStream, rx_stream : CaptureStream, tx : DecodedFrames, rx : DecodedFrames) -> ReplayReport:
+    report = ReplayReport()
+    times  = tx_stream.times + rx_stream.times
+    if times:
+        report.start = min(times)
+        report.end   = max(times)
+    report.tx_bytes  = tx_stream.size
+    report.rx_bytes  = rx_stream.size
+    report.tx_frames = len(tx)
+    report.rx_frames = len(rx)
+    report.dropped   = rx.dropped
+    report.junk      = rx.junk
+    return report
+
+def _status_range(rows) -> tuple[OperationalStatus, OperationalStatus]:
+    return OperationalStatus(tuple(int(value) for value in rows.min(axis = 0))), OperationalStatus(tuple(int(value) for value in rows.max(axis = 0)))
+
+def summarize_numpy(tx_stream : CaptureStream, rx_stream : CaptureStream, tx : DecodedFrames, rx : DecodedFrames,
+                    address : int, interval : float) -> ReplayReport:
+    report = _report(tx_stream, rx_stream, tx, rx)
+
+    counts         = np.bincount(rx.reason, minlength = len(REASONS))
+    report.reasons = {reason or "valid": int(count) for reason, count in zip(REASONS, counts)}
+    destinations, counts = np.unique(rx.destination[rx.reason == 0], return_counts = True)
+    report.destinations  = dict(zip(destinations.tolist(), counts.tolist()))
+
+    # All frames in order, sent before received at the same time.
+    sent        = np.concatenate((np.ones(len(tx), bool), np.zeros(len(rx), bool)))
+    times       = np.concatenate((tx.time, rx.time)).astype(float)
+    order       = np.lexsort((~sent, times))
+    sent        = sent[order]
+    times       = times[order]
+    index       = np.concatenate((np.arange(len(tx)), np.arange(len(rx))))[order]
+    reason      = np.concatenate((np.asarray(tx.reason, np.int8), rx.reason))[order]
+    destination = np.concatenate((np.asarray(tx.destination, np.int16), rx.destination))[order]
+    command     = np.concatenate((np.asarray(tx.command, np.int16), rx.command))[order]
+
+    commands  = np.flatnonzero((reason == 0) & (sent | (destination == address)))
+    following = np.minimum(commands + 1, len(order) - 1)
+    answered  = (commands + 1 < len(order)) & ~sent[following] & ((destination[following] == DEST_MASTER) | (reason[following] != 0))
+    malformed = answered & (reason[following] != 0)
+    valid     = answered & ~malformed
+
+    names, counts          = np.unique(command[commands], return_counts = True)
+    report.commands        = {COMMAND_NAMES.get(name, f"0x{name:02x}"): count for name, count in zip(names.tolist(), counts.tolist())}
+    report.unanswered      = int((~answered).sum())
+    counts                 = np.bincount(reason[following][malformed], minlength = len(REASONS))
+    report.bad_responses   = {reason: int(count) for reason, count in zip(REASONS, counts) if count}
+    measured               = valid & sent[commands]
+    report.round_trips     = np.sort(times[following][measured] - times[commands][measured]).tolist()
+
+    responses = index[following][valid & (command[commands] == CMD_SET_OUTPUT)]
+    complete  = rx.lengths[responses] >= STATUS_LEN
+    if (~complete).any():
+        report.bad_responses["length"] = report.bad_responses.get("length", 0) + int((~complete).sum())
+    responses = responses[complete]
+    if len(responses):
+        rows            = rx.clean[rx.starts[responses][:, None] + OperationalStatus.OFFSET + np.arange(OperationalStatus.STRUCT.size)]
+        flags           = rows[:, OperationalStatus.FIELDS.index("error_flags")]
+        report.statuses = len(rows)
+        report.flags    = {name: int(((flags & bit) != 0).sum()) for name, bit in OperationalStatus.FLAGS}
+        report.lowest, report.highest = _status_range(rows)
+
+    for i in index[following][valid & (command[commands] == CMD_ID)].tolist():
+        report.ids.add(IdResponse(rx.frame(i)).id)
+
+    if len(commands):
+        buckets, inverse = np.unique(np.floor(times[commands] / interval), return_inverse = True)
+        report.intervals = list(zip(
+            (buckets * interval).tolist(),
+            np.bincount(inverse).tolist(),
+            np.bincount(inverse, weights = ~answered).astype(int).tolist(),
+            np.bincount(inverse, weights = malformed).astype(int).tolist(),
+        ))
+    return report
+
+def summarize_python(tx_stream : CaptureStream, rx_stream : CaptureStream, tx : DecodedFrames, rx : DecodedFrames,
+                     address : int, interval : float) -> ReplayReport:
+    report = _report(tx_stream, rx_stream, tx, rx)
+
+    counts              = Counter(rx.reason)
+    report.reasons      = {reason or "valid": counts[code] for code, reason in enumerate(REASONS)}
+    report.destinations = dict(Counter(destination for destination, reason in zip(rx.destination, rx.reason) if reason == 0))
+
+    # All frames in order, sent before received at the same time.
+    events = sorted([(time, 0, i) for i, time in enumerate(tx.time)] + [(time, 1, i) for i, time in enumerate(rx.time)], key = lambda event: event[:2])
+
+    commands  = Counter()
+    bad       = Counter()
+    rows      = []
+    intervals = {}
+    for position, (time, received, i) in enumerate(events):
+        frames = rx if received else tx
+        if frames.reason[i] != 0 or (received and frames.destination[i] != address):
+            continue
+        command = frames.command[i]
+        commands[COMMAND_NAMES.get(command, f"0x{command:02x}")] += 1
+        bucket  = intervals.setdefault(time // interval * interval, [0, 0, 0])
+        bucket[0] += 1
+
+        response = events[position + 1] if position + 1 < len(events) else None
+        if response is None or not response[1] or not (rx.destination[response[2]] == DEST_MASTER or rx.reason[response[2]] != 0):
+            report.unanswered += 1
+            bucket[1]         += 1
+            continue
+        j = response[2]
+        if rx.reason[j] != 0:
+            bad[REASONS[rx.reason[j]]] += 1
+            bucket[2]                  += 1
+            continue
+        if not received:
+            report.round_trips.append(response[0] - time)
+
+        if command == CMD_SET_OUTPUT:
+            try:
+                rows.append(SetOutputResponse(rx.frame(j)).status)
+            except ResponseMalformedException as e:
+                bad[e.args[0]] += 1
+        elif command == CMD_ID:
+            report.ids.add(IdResponse(rx.frame(j)).id)
+
+    report.commands      = dict(commands)
+    report.bad_responses = dict(bad)
+    report.round_trips.sort()
+    report.intervals     = [(start, *counts) for start, counts in sorted(intervals.items())]
+    if rows:
+        report.statuses = len(rows)
+        report.flags    = {name: sum(1 for status in rows if status.error_flags & bit) for name, bit in OperationalStatus.FLAGS}
+        report.lowest   = OperationalStatus(tuple(min(getattr(status, field) for status in rows) for field in OperationalStatus.FIELDS))
+        report.highest  = OperationalStatus(tuple(max(getattr(status, field) for status in rows) for field in OperationalStatus.FIELDS))
+    return report
+
+# Decodes the captures and summarizes them, with NumPy if available and use_numpy.
+def replay(paths : list[Path], address : int = AqualinkPacket.PACKET_DEST_AQUALINK[0], interval : float = 3600,
+           max_frame_len : int = MAX_SNIFFED_FRAME_LEN, use_numpy : bool = True) -> ReplayReport:
+    tx_stream, rx_stream = load_captures(paths)
+    if use_numpy and np is not None:
+        tx = decode_numpy(tx_stream, max_frame_len)
+        rx = decode_numpy(rx_stream, max_frame_len)
+        return summarize_numpy(tx_stream, rx_stream, tx, rx, address, interval)
+    tx = decode_python(tx_stream, max_frame_len)
+    rx = decode_python(rx_stream, max_frame_len)
+    return summarize_python(tx_stream, rx_stream, tx, rx, address, interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog = "zodiac-tri-expert.replay", description = "Decodes serial captures and reports error rates.")
+    parser.add_argument("files", nargs = "+", type = Path, help = "capture files, oldest first (e.g. the rotated .1 before the current one)")
+    parser.add_argument("--interval", type = float, default = 3600, help = "seconds per line of the error rate table")
+    parser.add_argument("--address", type = lambda value: int(value, 0), default = AqualinkPacket.PACKET_DEST_AQUALINK[0], help = "bus address of the SWG, default 0xB0")
+    parser.add_argument("--no-numpy", dest = "use_numpy", action = "store_false", help = "decode with the streaming decoder even if NumPy is available")
+    args = parser.parse_args()
+
+    if args.use_numpy and np is None:
+        print("NumPy not available, using the streaming decoder.", file = sys.stderr)
+
+    start = perf_counter()
+    try:
+        report = replay(args.files, args.address, args.interval, use_numpy = args.use_numpy)
+    except (OSError, ValueError) as e:
+        print(e, file = sys.stderr)
+        sys.exit(1)
+    print(report.format())
+    print(f"Decoded in {perf_counter() - start:.2f} s.", file = sys.stderr)
@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+from .exceptions import *
+from .aqualink   import Aqualink
+
+_LOGGER = logging.getLogger(__name__)
+
+# Thread owning the Aqualink instance, all serial communication goes through it.
+# Requests are kept in a priority queue, so commands from the user preempt periodic
+# polls. Requests with the same coalescing key are merged while waiting in the queue:
+# the latest arguments win, the highest priority is kept and all callers get the
+# same future, resolved by the single transaction.
+class SerialWorker(threading.Thread):
+
+    PRIORITY_USER = 0
+    PRIORITY_POLL = 1
+
+    class _Request:
+        def __init__(self, priority : int, sequence : int, key : str | None, function, args : tuple):
+            self.priority   = priority
+            self.sequence   = sequence
+            self.key        = key
+            self.function   = function
+            self.args       = args
+            self.future     = Future()
+            self.superseded = False
+
+        def __lt__(self, other) -> bool:
+            return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def __init__(self, aqualink : Aqualink):
+        super().__init__(name = "serial", daemon = True)
+        self.aqualink   = aqualink
+        self._queue     = []
+        self._pending   = {} # Coalescing key -> queued request.
+        self._sequence  = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping  = False
+        self.coalesced  = 0
+
+    # Requests submitted after stop() fail right away with InterruptedError.
+    def submit(self, priority : int, key : str | None, function, *args) -> Future:
+        with self._condition:
+            request = self._Request(priority, next(self._sequence), key, function, args)
+            if self._stopping:
+                request.future.set_exception(InterruptedError())
+                return request.future
+
+            queued = self._pending.get(key) if key is not None else None
+            if queued is not None:
+                # Replace the queued request, keeping its place in the queue unless the new one is more urgent.
+                queued.superseded = True
+                if queued.priority <= request.priority:
+                    request.priority = queued.priority
+                    request.sequence = queued.sequence
+                request.future    = queued.future
+                self.coalesced   += 1
+                _LOGGER.debug(f"Coalesced request '{key}'.")
+
+            if key is not None:
+                self._pending[key] = request
+            heapq.heappush(self._queue, request)
+            self._condition.notify()
+            return request.future
+
+    def probe(self) -> Future:
+        return self.submit(self.PRIORITY_USER, "probe", self.aqualink.probe)
+
+    def get_id(self) -> Future:
+        return self.submit(self.PRIORITY_USER, "get_id", self.aqualink.get_id)
+
+    # All output changes share one key, only the latest output power is sent. The power
+    # is read when the transaction starts, so a change made while it waits is never lost.
+    def set_output_get_info(self, output_power : Callable[[], int], priority : int = PRIORITY_POLL) -> Future:
+        return self.submit(priority, "set_output", lambda: self.aqualink.set_output_get_info(output_power()))
+
+    # The transaction in progress finishes, queued requests fail with InterruptedError.
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            queued, self._queue = self._queue, []
+            self._pending.clear()
+            self._condition.notify()
+
+        for request in queued:
+            if not request.superseded:
+                request.future.set_exception(InterruptedError())
+
+    def _next_request(self) -> "_Request | None":
+        with self._condition:
+            while True:
+                if self._stopping:
+                    return None
+                while self._queue:
+                    request = heapq.heappop(self._queue)
+                    if request.superseded:
+                        continue
+                    if request.key is not None:
+                        del self._pending[request.key]
+                    return request
+                self._condition.wait()
+
+    def run(self):
+        while (request := self._next_request()) is not None:
+            try:
+                result = request.function(*request.args)
+            except BaseException as e:
+                request.future.set_exception(e)
+            else:
+                request.future.set_result(result)
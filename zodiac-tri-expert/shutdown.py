@@ -0,0 +1,65 @@
+import logging
+import os
+import select
+import threading
+from time import monotonic
+
+from .constants import *
+
+_LOGGER = logging.getLogger(__name__)
+
+# Clean shutdown of the bridge on SIGTERM/SIGINT. The signal handler only records the
+# request: request() takes no locks, so it's safe whatever the interrupted main thread
+# was doing. The main thread picks it up in wait() and shuts down in order: devices
+# finish the serial transaction in progress, queued ones are dropped, then every entity
+# is reported offline. All steps share one deadline, SHUTDOWN_TIMEOUT from begin();
+# should they overrun it by SHUTDOWN_GRACE, a watchdog ends the process anyway.
+class ShutdownCoordinator:
+
+    def __init__(self, timeout : float = SHUTDOWN_TIMEOUT):
+        self.timeout   = timeout
+        self.requested = False
+        self.stopping  = threading.Event() # Set once the shutdown began, loops exit on it.
+        self.deadline  = None
+
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_write, False)
+
+    # Called from the signal handler.
+    def request(self):
+        self.requested = True
+        self.wake()
+
+    # Ends wait() without a shutdown request, e.g. when all devices failed.
+    def wake(self):
+        try:
+            os.write(self._wake_write, b"\0")
+        except BlockingIOError:
+            pass # Woken up already.
+
+    # Blocks until request() or wake().
+    def wait(self):
+        select.select([self._wake_read], [], [])
+        os.read(self._wake_read, 4096)
+
+    # Starts the deadline and tells the loops to exit.
+    def begin(self):
+        if self.stopping.is_set():
+            return
+        self.deadline = monotonic() + self.timeout
+        self.stopping.set()
+
+        watchdog = threading.Timer(self.timeout + SHUTDOWN_GRACE, self._overrun)
+        watchdog.daemon = True
+        watchdog.start()
+
+    # Seconds left until the deadline, the whole timeout before the shutdown began.
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return self.timeout
+        return max(self.deadline - monotonic(), 0)
+
+    def _overrun(self):
+        _LOGGER.error(f"Shutdown did not finish in {self.timeout + SHUTDOWN_GRACE} s, exiting anyway!")
+        logging.shutdown()
+        os._exit(130)
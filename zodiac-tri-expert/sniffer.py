@@ -0,0 +1,74 @@
+import logging
+
+from .constants         import *
+from .aqualink_protocol import *
+from .metrics           import SNIFFED, SNIFFED_LOST, JUNK_BYTES
+
+_LOGGER = logging.getLogger(__name__)
+
+# Decodes the traffic on a bus mastered by another controller, without ever sending.
+# Every frame from all addresses goes through the streaming decoder. Commands to the
+# chlorinator address give the output power the master sets; the response to the master
+# right after them is the chlorinator's, a status or an ID. Frames which can't be decoded
+# are counted in metrics by reason, any frame of the chlorinator among them is lost.
+class BusSniffer:
+
+    DEST_MASTER = 0x00
+
+    CMD_ID         = 0x14
+    CMD_SET_OUTPUT = 0x11
+    RSP_SET_OUTPUT = 0x12
+
+    def __init__(self, port : str, address : int = AqualinkPacket.PACKET_DEST_AQUALINK[0]):
+        self.port     = port # Label in metrics.
+        self.address  = address
+        self.decoder  = AqualinkFrameDecoder(MAX_SNIFFED_FRAME_LEN)
+        self._pending = None # Command sent to the chlorinator, waiting for its response.
+
+        self._dropped   = 0
+        self._discarded = 0
+
+    # Decodes received bytes, frames may span chunks.
+    # Returns what was observed of the chlorinator, as ("power", int), ("status", OperationalStatus) or ("id", str).
+    def feed(self, data : bytes) -> list[tuple[str, object]]:
+        frames = self.decoder.feed(data)
+
+        if self.decoder.dropped_frames != self._dropped:
+            SNIFFED_LOST.inc(self.port, "framing", amount = self.decoder.dropped_frames - self._dropped)
+            self._dropped  = self.decoder.dropped_frames
+            self._pending  = None
+        if self.decoder.discarded != self._discarded:
+            JUNK_BYTES.inc(self.port, amount = self.decoder.discarded - self._discarded)
+            self._discarded = self.decoder.discarded
+
+        observed = []
+        for frame in frames:
+            reason = AqualinkResponse.malformed(frame)
+            if reason is None and len(frame) < 6:
+                reason = "length"
+            if reason is not None:
+                SNIFFED_LOST.inc(self.port, reason)
+                self._pending = None
+                continue
+
+            destination, command = frame[2], frame[3]
+            SNIFFED.inc(self.port, f"0x{destination:02x}")
+
+            if destination == self.address:
+                self._pending = command
+                if command == self.CMD_SET_OUTPUT and len(frame) >= 8:
+                    observed.append(("power", frame[4]))
+                continue
+
+            pending, self._pending = self._pending, None
+            if destination != self.DEST_MASTER or pending is None:
+                continue
+            if pending == self.CMD_SET_OUTPUT and command == self.RSP_SET_OUTPUT:
+                if len(frame) >= OperationalStatus.OFFSET + OperationalStatus.STRUCT.size + 3:
+                    observed.append(("status", OperationalStatus.unpack_from(frame, OperationalStatus.OFFSET)))
+                else:
+                    SNIFFED_LOST.inc(self.port, "length")
+            elif pending == self.CMD_ID:
+                observed.append(("id", IdResponse(frame).id))
+
+        return observed
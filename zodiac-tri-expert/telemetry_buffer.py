@@ -0,0 +1,100 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+
+from .aqualink import Aqualink
+
+_LOGGER = logging.getLogger(__name__)
+
+# Fixed-size ring buffer of operational status samples which could not be published,
+# kept in a memory-mapped file so the backlog survives restarts. Samples are stored
+# as on the wire, a timestamp and the status bytes, so the size of the file is known
+# upfront: HEADER.size + capacity * RECORD_SIZE. When full, the oldest samples are overwritten.
+class TelemetryBuffer:
+
+    MAGIC       = b"ZTB2"
+    HEADER      = struct.Struct("<4sIII") # Magic, capacity, index of the next write, number of samples.
+    TIMESTAMP   = struct.Struct("<d")     # Unix time, followed by the status.
+    RECORD_SIZE = TIMESTAMP.size + Aqualink.OperationalStatus.STRUCT.size
+
+    def __init__(self, path : Path, capacity : int):
+        self.path        = Path(path)
+        self.capacity    = capacity
+        self.overwritten = 0
+        self._lock       = threading.Lock()
+
+        self._peek_overwritten = 0
+        self._open()
+
+    def _open(self):
+        size = self.HEADER.size + self.capacity * self.RECORD_SIZE
+        fd   = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, capacity, head, count = self.HEADER.unpack_from(self._map, 0)
+        if magic == self.MAGIC and capacity == self.capacity and head < capacity and count <= capacity:
+            self._head  = head
+            self._count = count
+            if count > 0:
+                _LOGGER.info(f"{count} unpublished samples waiting in {self.path}.")
+            return
+
+        if magic == self.MAGIC:
+            _LOGGER.warning(f"Capacity of {self.path} changed, dropping its backlog.")
+        elif magic != bytes(len(self.MAGIC)):
+            _LOGGER.warning(f"Format of {self.path} changed, dropping its backlog.")
+        self._head  = 0
+        self._count = 0
+        self._write_header()
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.capacity, self._head, self._count)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp : float, status : Aqualink.OperationalStatus):
+        with self._lock:
+            offset = self.HEADER.size + self._head * self.RECORD_SIZE
+            self.TIMESTAMP.pack_into(self._map, offset, timestamp)
+            status.pack_into(self._map, offset + self.TIMESTAMP.size)
+            self._head = (self._head + 1) % self.capacity
+            if self._count == self.capacity:
+                self.overwritten += 1
+            else:
+                self._count += 1
+            self._write_header()
+
+    # Returns up to count oldest samples as (timestamp, status), without removing them.
+    def peek(self, count : int) -> list[tuple[float, Aqualink.OperationalStatus]]:
+        with self._lock:
+            self._peek_overwritten = self.overwritten
+
+            start   = (self._head - self._count) % self.capacity
+            samples = []
+            for i in range(min(count, self._count)):
+                offset     = self.HEADER.size + ((start + i) % self.capacity) * self.RECORD_SIZE
+                timestamp, = self.TIMESTAMP.unpack_from(self._map, offset)
+                samples.append((timestamp, Aqualink.OperationalStatus.unpack_from(self._map, offset + self.TIMESTAMP.size)))
+            return samples
+
+    # Removes count oldest samples, after they were peeked and published. If the buffer
+    # overflowed meanwhile, the overwritten samples were the peeked ones, so fewer are removed.
+    def consume(self, count : int):
+        with self._lock:
+            count      -= min(self.overwritten - self._peek_overwritten, count)
+            self._count = max(self._count - count, 0)
+            self._write_header()
+
+    # Writes the samples to disk, the page cache survives a crash of the process but not of the system.
+    def flush(self):
+        with self._lock:
+            self._map.flush()